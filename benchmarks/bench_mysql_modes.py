@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк pure vs C-расширения mysql-connector на пути массовой записи цен
+
+Пишет синтетические цены во временную таблицу со структурой b_catalog_price
+(реальные данные не затрагиваются) теми же запросами, что и
+BitrixIntegration.write_prices: выборка текущих цен пачками по PRODUCT_ID,
+сравнение в Python, затем executemany INSERT новых строк и executemany
+UPDATE изменившихся. Как и в b_catalog_price, уникального ключа по
+(PRODUCT_ID, CATALOG_GROUP_ID) нет — только обычный индекс.
+"""
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dotenv import load_dotenv
+
+from db_pool import ConnectionPool, DbPoolConfig, c_extension_available
+
+load_dotenv()
+
+PRICE_GROUP_ID = 1
+PRICE_TOLERANCE = 0.01
+
+CREATE_TABLE = """
+CREATE TEMPORARY TABLE bench_catalog_price (
+    ID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    PRODUCT_ID INT NOT NULL,
+    CATALOG_GROUP_ID INT NOT NULL,
+    PRICE DECIMAL(18,2) NOT NULL,
+    PRICE_SCALE DECIMAL(26,12) NULL,
+    CURRENCY CHAR(3) NOT NULL,
+    TIMESTAMP_X DATETIME NOT NULL,
+    KEY ix_product (PRODUCT_ID, CATALOG_GROUP_ID)
+)
+"""
+
+SELECT = """
+SELECT PRODUCT_ID, PRICE
+FROM bench_catalog_price
+WHERE CATALOG_GROUP_ID = %s AND PRODUCT_ID IN ({placeholders})
+"""
+
+UPDATE = """
+UPDATE bench_catalog_price
+SET PRICE = %s, PRICE_SCALE = %s, TIMESTAMP_X = NOW()
+WHERE PRODUCT_ID = %s AND CATALOG_GROUP_ID = %s
+"""
+
+INSERT = """
+INSERT INTO bench_catalog_price
+(PRODUCT_ID, CATALOG_GROUP_ID, PRICE, PRICE_SCALE, CURRENCY, TIMESTAMP_X)
+VALUES (%s, %s, %s, %s, 'RUB', NOW())
+"""
+
+
+def select_prices(cursor, product_ids: list, batch_size: int) -> dict:
+    """Текущие цены пачками, как get_current_prices"""
+    prices = {}
+    for i in range(0, len(product_ids), batch_size):
+        chunk = product_ids[i:i + batch_size]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cursor.execute(SELECT.format(placeholders=placeholders), (PRICE_GROUP_ID, *chunk))
+        for product_id, price in cursor.fetchall():
+            prices[int(product_id)] = float(price)
+    return prices
+
+
+def diff_prices(new_prices: dict, current_prices: dict):
+    """Разбиение на UPDATE/INSERT с теми же кортежами, что в write_prices"""
+    to_update = []
+    to_insert = []
+    for product_id, new_price in new_prices.items():
+        new_price = round(new_price, 2)
+        current_price = current_prices.get(product_id)
+        if current_price is None:
+            to_insert.append((product_id, PRICE_GROUP_ID, new_price, new_price))
+        elif abs(current_price - new_price) > PRICE_TOLERANCE:
+            to_update.append((new_price, new_price, product_id, PRICE_GROUP_ID))
+    return to_update, to_insert
+
+
+def write_batches(cursor, statement: str, rows: list, batch_size: int):
+    for i in range(0, len(rows), batch_size):
+        cursor.executemany(statement, rows[i:i + batch_size])
+
+
+def run_mode(use_pure: bool, rows: int, batch_size: int, changed: float) -> dict:
+    """Первый проход вставляет все цены, второй меняет долю changed из них"""
+    config = DbPoolConfig.from_env()
+    config.use_pure = use_pure
+    config.pool_size = 1
+    pool = ConnectionPool(config)
+
+    rng = random.Random(42)
+    initial = {product_id: rng.uniform(10, 10000) for product_id in range(1, rows + 1)}
+    updated = {
+        product_id: price * 1.05 if rng.random() < changed else price
+        for product_id, price in initial.items()
+    }
+    product_ids = list(initial)
+    timings = {}
+
+    with pool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS bench_catalog_price")
+        cursor.execute(CREATE_TABLE)
+
+        start = time.perf_counter()
+        current = select_prices(cursor, product_ids, batch_size)
+        timings['select'] = time.perf_counter() - start
+        to_update, to_insert = diff_prices(initial, current)
+        start = time.perf_counter()
+        write_batches(cursor, UPDATE, to_update, batch_size)
+        write_batches(cursor, INSERT, to_insert, batch_size)
+        timings['insert'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        current = select_prices(cursor, product_ids, batch_size)
+        timings['select'] += time.perf_counter() - start
+        to_update, to_insert = diff_prices(updated, current)
+        start = time.perf_counter()
+        write_batches(cursor, UPDATE, to_update, batch_size)
+        write_batches(cursor, INSERT, to_insert, batch_size)
+        timings['update'] = time.perf_counter() - start
+
+        cursor.execute("DROP TEMPORARY TABLE bench_catalog_price")
+        cursor.close()
+
+    pool.close_all()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк pure vs C mysql-connector')
+    parser.add_argument('--rows', type=int, default=20000, help='Количество строк цен')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки executemany')
+    parser.add_argument('--changed', type=float, default=0.3, help='Доля цен, изменившихся во втором проходе')
+    parser.add_argument('--repeat', type=int, default=3, help='Количество повторов')
+    args = parser.parse_args()
+
+    modes = [('pure', True)]
+    if c_extension_available():
+        modes.append(('C', False))
+    else:
+        print("⚠️  C-расширение mysql-connector недоступно, измеряем только pure")
+
+    print(f"Строк: {args.rows}, пачка: {args.batch_size}, изменено: {args.changed:.0%}, повторов: {args.repeat}")
+    print(f"{'режим':<6} {'операция':<8} {'лучшее, с':>10}")
+
+    for name, use_pure in modes:
+        best = {}
+        for _ in range(args.repeat):
+            for op, elapsed in run_mode(use_pure, args.rows, args.batch_size, args.changed).items():
+                best[op] = min(best.get(op, elapsed), elapsed)
+        for op, elapsed in best.items():
+            print(f"{name:<6} {op:<8} {elapsed:>10.3f}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк парсеров Saturn на локальной подмене сайта
+
+Поднимает HTTP-сервер, который отдаёт сгенерированные страницы поиска,
+категорий, товаров и sitemap с разметкой Saturn (h_s_list_categor_item_wrap,
+p.h_s_list_categor_item_articul "тов-...", span.js-price-value[data-price]),
+с настраиваемой задержкой ответа и долями ответов 5xx и 429. SaturnParser,
+FastSaturnParser и SaturnSitemapParser прогоняются против него по очереди,
+каждый в отдельном процессе (пиковый RSS не смешивается). Запросы считает
+сервер, найденные цены сверяются с каталогом. Для sitemap-парсера задержка
+считается на страницу категории, для остальных - на артикул.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+SITEMAP_PATHS = ('/sitemap.xml', '/sitemaps/msk.sitemap.xml')
+SEARCH_PATH = '/catalog/?sp%5Bname%5D=1&sp%5Bartikul%5D=1&search=&s='
+
+NAMES = ['Брусок строганый сухой', 'Доска обрезная', 'Рейка монтажная', 'Саморез по дереву',
+         'Краска фасадная', 'Грунтовка глубокого проникновения', 'Профиль направляющий', 'Гипсокартон влагостойкий']
+SIZES = ['20х40х3000', '50х150х6000', '4,2х76', '2,5 л', '10 л', '27х28х3000', '12,5х1200х2500']
+
+PARSERS = ('saturn', 'fast', 'sitemap')
+
+
+@dataclass
+class FakeProduct:
+    sku: str
+    name: str
+    price: float
+    category: str
+
+    @property
+    def url(self) -> str:
+        return f"/catalog/{self.category}/p-{self.sku}/"
+
+
+class FakeCatalog:
+    """Синтетический каталог: артикулы, разложенные по категориям; часть артикулов на сайте отсутствует"""
+
+    def __init__(self, products: int, category_size: int, missing_rate: float, seed: int):
+        rng = random.Random(seed)
+        self.skus = [f"{number:06d}" for number in rng.sample(range(1, 1000000), products)]
+        self.products: Dict[str, FakeProduct] = {}
+        self.categories: Dict[str, List[FakeProduct]] = {}
+        for index, sku in enumerate(self.skus):
+            if rng.random() < missing_rate:
+                continue
+            category = f"razdel-{index // (category_size * 10) + 1}/podrazdel-{index // category_size + 1}"
+            product = FakeProduct(sku, f"{rng.choice(NAMES)} {rng.choice(SIZES)}",
+                                  round(rng.uniform(5, 50000), 2), category)
+            self.products[sku] = product
+            self.categories.setdefault(category, []).append(product)
+
+
+def item_html(product: FakeProduct) -> str:
+    price_text = f"{product.price:.2f}".replace('.', ',')
+    return f"""
+<div class="h_s_list_categor_item_wrap">
+  <div class="h_s_list_categor_item_img"><a href="{product.url}"><img src="/upload/{product.sku}.jpg" alt=""></a></div>
+  <a class="h_s_list_categor_item" href="{product.url}">{product.name}</a>
+  <p class="h_s_list_categor_item_articul">тов-{product.sku}</p>
+  <p class="h_s_list_categor_item_txt">{product.name}</p>
+  <div class="h_s_list_categor_item_price">
+    <span class="shopping_cart_goods_list_item_sum_item"><span class="js-price-value" data-price="{product.price}">{price_text}</span> ₽</span>
+  </div>
+  <div class="h_s_list_categor_item_stock">В наличии</div>
+</div>"""
+
+
+class FakeSaturnServer(ThreadingHTTPServer):
+    """Подмена msk.saturn.net с задержкой и внесением ошибок"""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, catalog: FakeCatalog, latency_ms: float = 50, jitter_ms: float = 20,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, padding_kb: int = 120,
+                 search_neighbours: int = 4, seed: int = 42):
+        super().__init__(('127.0.0.1', 0), FakeSaturnHandler)
+        self.catalog = catalog
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.search_neighbours = search_neighbours
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats: Counter = Counter()
+        self._thread: Optional[threading.Thread] = None
+        # Шапка и меню реальной страницы: от их объёма зависит время разбора HTML
+        menu = []
+        while sum(map(len, menu)) < padding_kb * 1024:
+            number = len(menu) + 1
+            menu.append(f'<li class="menu_item"><a href="/catalog/razdel-{number}/">Раздел каталога {number}</a></li>\n')
+        self.menu = ''.join(menu)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-saturn", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+
+    def snapshot(self) -> Counter:
+        with self.lock:
+            return Counter(self.stats)
+
+    def fault(self) -> Optional[int]:
+        """Код внесённой ошибки или None и задержка ответа"""
+        with self.lock:
+            roll = self.rng.random()
+            delay = max(0.0, self.rng.uniform(self.latency - self.jitter, self.latency + self.jitter))
+        time.sleep(delay)
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def page(self, title: str, body: str) -> str:
+        return f"""<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<header class="header"><ul class="menu">
+{self.menu}</ul></header>
+<main class="content">
+{body}
+</main>
+<footer class="footer">© Сатурн</footer>
+</body></html>"""
+
+    def search_page(self, query: str) -> str:
+        product = self.catalog.products.get(query[len('тов-'):] if query.startswith('тов-') else query)
+        if product is None:
+            return self.page("Поиск", '<div class="search_result">По вашему запросу ничего не найдено</div>')
+        # Поиск по артикулу отдаёт и соседние товары, нужный не обязательно первый
+        neighbours = [item for item in self.catalog.categories[product.category] if item is not product]
+        items = neighbours[:self.search_neighbours] + [product]
+        random.Random(product.sku).shuffle(items)
+        body = f'<div class="search_result">Найдено: {len(items)} товаров</div>\n' + ''.join(map(item_html, items))
+        return self.page("Поиск", body)
+
+    def category_page(self, category: str) -> Optional[str]:
+        products = self.catalog.categories.get(category)
+        if products is None:
+            return None
+        return self.page(f"Раздел {category}", ''.join(map(item_html, products)))
+
+    def product_page(self, sku: str) -> Optional[str]:
+        product = self.catalog.products.get(sku)
+        if product is None:
+            return None
+        return self.page(product.name, f"""
+<h1 class="product_title">{product.name}</h1>
+<div class="product_articul">Артикул: тов-{product.sku}</div>
+<div class="product_price"><span class="js-price-value" data-price="{product.price}">{product.price}</span> ₽</div>""")
+
+    def sitemap(self) -> str:
+        # В sitemap только страницы категорий: их и разбирает SaturnSitemapParser
+        urls = ''.join(f"<url><loc>{escape(self.base_url)}/catalog/{category}/</loc></url>\n"
+                       for category in self.catalog.categories)
+        return f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n{urls}</urlset>\n'
+
+
+class FakeSaturnHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeSaturnServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        if url.path in SITEMAP_PATHS:
+            kind, content_type = 'sitemap', 'application/xml'
+        elif url.path == '/catalog/' and 's' in query:
+            kind, content_type = 'search', 'text/html'
+        elif len(parts) == 4 and parts[0] == 'catalog' and parts[3].startswith('p-'):
+            kind, content_type = 'product', 'text/html'
+        elif len(parts) == 3 and parts[0] == 'catalog':
+            kind, content_type = 'category', 'text/html'
+        else:
+            kind, content_type = 'other', 'text/html'
+
+        status = self.server.fault()
+        body = None
+        if status is None:
+            if kind == 'sitemap':
+                body = self.server.sitemap()
+            elif kind == 'search':
+                body = self.server.search_page(query['s'][0])
+            elif kind == 'product':
+                body = self.server.product_page(parts[3][len('p-'):])
+            elif kind == 'category':
+                body = self.server.category_page(f"{parts[1]}/{parts[2]}")
+            status = 200 if body is not None else 404
+        with self.server.lock:
+            self.server.stats[kind] += 1
+            self.server.stats[status] += 1
+
+        data = (body or f"<html><body>HTTP {status}</body></html>").encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def timed(obj, method: str, latencies: List[float]):
+    """Замер каждого вызова метода экземпляра"""
+    original = getattr(obj, method)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    setattr(obj, method, wrapper)
+
+
+def run_saturn(base_url: str, skus: List[str], options: Dict) -> Dict:
+    from saturn_parser import SaturnParser, logger as parser_logger
+
+    parser_logger.setLevel(logging.ERROR)
+    parser = SaturnParser()
+    parser.base_url = base_url
+    parser.request_delay = options['delay']
+    latencies: List[float] = []
+    timed(parser, 'parse_product', latencies)
+    start = time.perf_counter()
+    results = parser.parse_products(skus)
+    elapsed = time.perf_counter() - start
+    return {'elapsed': elapsed, 'latencies': latencies, 'found': {r.sku: r.price for r in results}}
+
+
+def run_fast(base_url: str, skus: List[str], options: Dict) -> Dict:
+    from fast_saturn_parser import FastSaturnParser
+
+    parser = FastSaturnParser(max_workers=options['workers'], request_delay=options['delay'])
+    parser.base_url = base_url
+    parser.search_url = base_url + SEARCH_PATH
+    latencies: List[float] = []
+    timed(parser, 'parse_single_product', latencies)
+    start = time.perf_counter()
+    results = parser.parse_products_batch(skus, None, update_bitrix=False)
+    elapsed = time.perf_counter() - start
+    return {'elapsed': elapsed, 'latencies': latencies, 'found': {r.sku: r.price for r in results}}
+
+
+def run_sitemap(base_url: str, skus: List[str], options: Dict) -> Dict:
+    from sitemap_parser import SaturnSitemapParser
+
+    parser = SaturnSitemapParser(max_workers=options['sitemap_workers'], request_delay=options['delay'])
+    parser.base_url = base_url
+    parser.sitemap_urls = [base_url + path for path in SITEMAP_PATHS]
+    latencies: List[float] = []
+    timed(parser, 'parse_category_page', latencies)
+    start = time.perf_counter()
+    results = parser.parse_products_batch(parser.get_product_urls_from_sitemap(), set(skus))
+    elapsed = time.perf_counter() - start
+    return {'elapsed': elapsed, 'latencies': latencies, 'found': {r.sku: r.price for r in results}}
+
+
+RUNNERS = {'saturn': run_saturn, 'fast': run_fast, 'sitemap': run_sitemap}
+
+
+def run_scenario(name: str, base_url: str, skus: List[str], options: Dict, results: multiprocessing.Queue):
+    """Процесс прогона одного парсера; пиковый RSS - этого процесса"""
+    # Парсеры пишут logs/ и output/ в текущий каталог
+    os.chdir(options['workdir'])
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)s - %(name)s - %(message)s')
+    result = RUNNERS[name](base_url, skus, options)
+    # ru_maxrss: Linux - КБ, macOS - байты
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    results.put(result)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def run_parser(name: str, server: FakeSaturnServer, catalog: FakeCatalog, skus: List[str], options: Dict) -> Optional[Dict]:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    server.reset_stats()
+    process = context.Process(target=run_scenario, args=(name, server.base_url, skus, options, results))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    process.join()
+    if result is None:
+        return None
+
+    stats = server.snapshot()
+    requests_total = sum(stats[kind] for kind in ('search', 'category', 'product', 'sitemap', 'other'))
+    found = result.pop('found')
+    latencies = result.pop('latencies')
+    return {
+        'parser': name,
+        'skus': len(skus),
+        'found': len(found),
+        'expected': sum(1 for sku in skus if sku in catalog.products),
+        'wrong_price': sum(1 for sku, price in found.items()
+                           if sku not in catalog.products or abs(catalog.products[sku].price - price) > 0.005),
+        'elapsed': round(result['elapsed'], 2),
+        'skus_per_sec': round(len(skus) / result['elapsed'], 2) if result['elapsed'] else 0,
+        'requests': requests_total,
+        'requests_per_sku': round(requests_total / len(skus), 2) if skus else 0,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': round(result['peak_rss_mb'], 1),
+        'throttled': stats[429],
+        'server_errors': stats[503],
+        'by_page': {kind: stats[kind] for kind in ('search', 'category', 'product', 'sitemap', 'other') if stats[kind]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк парсеров Saturn на локальной подмене сайта')
+    parser.add_argument('--parsers', nargs='+', choices=PARSERS, default=list(PARSERS), help='Какие парсеры гонять')
+    parser.add_argument('--skus', type=int, default=500, help='Количество артикулов')
+    parser.add_argument('--slow-skus', type=int, default=50,
+                        help='Артикулов для SaturnParser (последовательный, до 6 запросов на артикул)')
+    parser.add_argument('--missing-rate', type=float, default=0.05, help='Доля артикулов, которых нет на сайте')
+    parser.add_argument('--category-size', type=int, default=40, help='Товаров на странице категории')
+    parser.add_argument('--search-neighbours', type=int, default=4, help='Соседних товаров в выдаче поиска')
+    parser.add_argument('--padding-kb', type=int, default=120, help='Объём шапки и меню каждой страницы, КБ')
+    parser.add_argument('--latency-ms', type=float, default=50, help='Средняя задержка ответа, мс')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='Разброс задержки, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Доля ответов 429')
+    parser.add_argument('--workers', type=int, default=10, help='Потоков FastSaturnParser')
+    parser.add_argument('--sitemap-workers', type=int, default=20, help='Потоков SaturnSitemapParser')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Задержка между запросами в парсерах, с (0 - мерить только парсер и сеть)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Записать результаты в JSON-файл')
+    args = parser.parse_args()
+
+    catalog = FakeCatalog(args.skus, args.category_size, args.missing_rate, args.seed)
+    server = FakeSaturnServer(catalog, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                              error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                              padding_kb=args.padding_kb, search_neighbours=args.search_neighbours, seed=args.seed)
+    server.start()
+
+    print(f"Подмена Saturn: {server.base_url}, артикулов {len(catalog.skus)} (на сайте {len(catalog.products)}), "
+          f"категорий {len(catalog.categories)}")
+    print(f"Задержка {args.latency_ms:g}±{args.jitter_ms:g} мс, 503: {args.error_rate:.1%}, "
+          f"429: {args.throttle_rate:.1%}, страница ~{args.padding_kb} КБ")
+    print(f"{'парсер':<8} {'артикулов':>9} {'найдено':>9} {'неверно':>7} {'время, с':>9} {'арт/с':>7} "
+          f"{'запр/арт':>8} {'p50, мс':>8} {'p99, мс':>8} {'RSS, МБ':>8} {'429':>5} {'503':>5}")
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='bench_saturn_') as workdir:
+        options = {'delay': args.delay, 'workers': args.workers, 'sitemap_workers': args.sitemap_workers,
+                   'workdir': workdir}
+        for name in args.parsers:
+            skus = catalog.skus[:args.slow_skus] if name == 'saturn' else catalog.skus
+            row = run_parser(name, server, catalog, skus, options)
+            if row is None:
+                print(f"{name:<8} ❌ процесс парсера завершился без результата")
+                continue
+            rows.append(row)
+            print(f"{name:<8} {row['skus']:>9} {row['found']:>4}/{row['expected']:<4} {row['wrong_price']:>7} "
+                  f"{row['elapsed']:>9.2f} {row['skus_per_sec']:>7.1f} {row['requests_per_sku']:>8.2f} "
+                  f"{row['latency_p50_ms']:>8.1f} {row['latency_p99_ms']:>8.1f} {row['peak_rss_mb']:>8.1f} "
+                  f"{row['throttled']:>5} {row['server_errors']:>5}")
+    server.stop()
+    print("Задержка: на артикул, для sitemap - на страницу категории")
+
+    if args.json:
+        Path(args.json).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(args), 'results': rows}, f, ensure_ascii=False, indent=2)
+
+    return 0 if len(rows) == len(args.parsers) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк матрицы цен и слияния правил против построчного выполнения underprice
+
+Синтетический каталог (по умолчанию 100k товаров и 4 группы цен)
+собирается в SQLite в памяти с таблицами Bitrix, к которому
+UnderpriceProcessor обращается через тонкий адаптер курсора mysql-connector.
+Все режимы выполняют одну цепочку правил на одинаковых данных, результаты
+сверяются, число обращений к БД пересчитывается во время при заданном RTT.
+"""
+
+import sys
+import time
+import random
+import sqlite3
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bitrix_metadata import BitrixMetadata
+from underprice_python import UnderpriceProcessor, UnderpriceRule
+
+IBLOCK_ID = 10
+ARTICLE_PROPERTY_ID = 100
+PRICE_GROUPS = {'BASE': 1, 'RETAIL': 2, 'WHOLESALE': 3, 'VIP': 4}
+
+SCHEMA = """
+CREATE TABLE b_iblock_element (
+    ID INTEGER PRIMARY KEY, IBLOCK_ID INTEGER, IBLOCK_SECTION_ID INTEGER, ACTIVE TEXT, NAME TEXT,
+    TIMESTAMP_X TEXT
+);
+CREATE TABLE b_iblock_section (
+    ID INTEGER PRIMARY KEY, IBLOCK_ID INTEGER, IBLOCK_SECTION_ID INTEGER,
+    LEFT_MARGIN INTEGER, RIGHT_MARGIN INTEGER, DEPTH_LEVEL INTEGER, TIMESTAMP_X TEXT
+);
+CREATE TABLE b_iblock_element_property (
+    ID INTEGER PRIMARY KEY, IBLOCK_ELEMENT_ID INTEGER, IBLOCK_PROPERTY_ID INTEGER, VALUE TEXT
+);
+CREATE INDEX ix_element_property ON b_iblock_element_property (IBLOCK_ELEMENT_ID, IBLOCK_PROPERTY_ID);
+CREATE TABLE b_catalog_product (ID INTEGER PRIMARY KEY, PURCHASING_PRICE REAL, TIMESTAMP_X TEXT);
+CREATE TABLE b_catalog_price (
+    ID INTEGER PRIMARY KEY, PRODUCT_ID INTEGER, CATALOG_GROUP_ID INTEGER,
+    PRICE REAL, CURRENCY TEXT, TIMESTAMP_X TEXT
+);
+CREATE INDEX ix_product_group ON b_catalog_price (PRODUCT_ID, CATALOG_GROUP_ID);
+"""
+
+# Разделы 1..20, разделы 6 и 7 - подразделы раздела 5
+SECTION_PARENTS = {6: 5, 7: 5}
+SECTION_COUNT = 20
+
+# Цепочка правил: закупочная -> базовая -> розничная -> оптовая, базовая -> VIP
+RULES = [
+    UnderpriceRule(1, IBLOCK_ID, None, 'P', 'BASE', 25.0, 100),
+    UnderpriceRule(2, IBLOCK_ID, None, 'BASE', 'RETAIL', 10.0, 200),
+    UnderpriceRule(3, IBLOCK_ID, None, 'RETAIL', 'WHOLESALE', -7.0, 300),
+    UnderpriceRule(4, IBLOCK_ID, 5, 'BASE', 'VIP', -3.0, 400),
+]
+
+
+class BenchCursor:
+    """Курсор SQLite с интерфейсом mysql-connector (%s, dictionary, rowcount)"""
+
+    def __init__(self, owner: 'BenchConnection', dictionary: bool = False):
+        self.owner = owner
+        self.cursor = owner.db.cursor()
+        if dictionary:
+            self.cursor.row_factory = lambda c, row: {d[0]: v for d, v in zip(c.description, row)}
+
+    def execute(self, query, params=()):
+        self.owner.round_trips += 1
+        self.cursor.execute(query.replace('%s', '?'), tuple(params))
+
+    def executemany(self, query, seq_params):
+        # mysql-connector сворачивает executemany INSERT в один многострочный
+        # запрос, остальные выполняет по одному
+        seq_params = list(seq_params)
+        if query.lstrip().upper().startswith('INSERT'):
+            self.owner.round_trips += 1
+        else:
+            self.owner.round_trips += len(seq_params)
+        self.cursor.executemany(query.replace('%s', '?'), seq_params)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class BenchConnection:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.round_trips = 0
+
+    def cursor(self, dictionary: bool = False, buffered: bool = True):
+        return BenchCursor(self, dictionary)
+
+
+def section_rows():
+    """Границы вложенных множеств для разделов бенчмарка"""
+    children = {}
+    for section_id in range(1, SECTION_COUNT + 1):
+        children.setdefault(SECTION_PARENTS.get(section_id), []).append(section_id)
+
+    rows, counter = [], [0]
+
+    def visit(section_id, depth):
+        counter[0] += 1
+        left = counter[0]
+        for child in children.get(section_id, []):
+            visit(child, depth + 1)
+        counter[0] += 1
+        rows.append((section_id, IBLOCK_ID, SECTION_PARENTS.get(section_id), left, counter[0], depth))
+
+    for section_id in children[None]:
+        visit(section_id, 1)
+    return rows
+
+
+def build_catalog(products: int, seed: int) -> sqlite3.Connection:
+    db = sqlite3.connect(':memory:', isolation_level=None)
+    db.create_function('NOW', 0, lambda: datetime.now().isoformat(sep=' ', timespec='seconds'))
+    db.executescript(SCHEMA)
+
+    rng = random.Random(seed)
+    elements, properties, catalog, prices = [], [], [], []
+    for product_id in range(1, products + 1):
+        elements.append((product_id, IBLOCK_ID, rng.randint(1, 20), 'Y', f"Товар {product_id}"))
+        properties.append((product_id, ARTICLE_PROPERTY_ID, f"ST-{product_id}"))
+        catalog.append((product_id, round(rng.uniform(100, 100000), 2)))
+        # Часть целевых цен уже есть, часть будет добавлена правилами
+        for group_id in PRICE_GROUPS.values():
+            if group_id == PRICE_GROUPS['BASE'] or rng.random() < 0.6:
+                prices.append((product_id, group_id, round(rng.uniform(100, 100000), 2)))
+
+    db.execute("BEGIN")
+    db.executemany("INSERT INTO b_iblock_section VALUES (?, ?, ?, ?, ?, ?, NOW())", section_rows())
+    db.executemany("INSERT INTO b_iblock_element VALUES (?, ?, ?, ?, ?, NOW())", elements)
+    db.executemany("""
+    INSERT INTO b_iblock_element_property (IBLOCK_ELEMENT_ID, IBLOCK_PROPERTY_ID, VALUE) VALUES (?, ?, ?)
+    """, properties)
+    db.executemany("INSERT INTO b_catalog_product VALUES (?, ?, NOW())", catalog)
+    db.executemany("""
+    INSERT INTO b_catalog_price (PRODUCT_ID, CATALOG_GROUP_ID, PRICE, CURRENCY, TIMESTAMP_X)
+    VALUES (?, ?, ?, 'RUB', NOW())
+    """, prices)
+    db.execute("COMMIT")
+    return db
+
+
+def make_processor(connection: BenchConnection, mode: str) -> UnderpriceProcessor:
+    processor = UnderpriceProcessor(mode=mode)
+    processor.purchasing_rules = True
+    processor.connection = connection
+    processor.metadata = BitrixMetadata(
+        fingerprint='bench',
+        properties={IBLOCK_ID: {'CML2_ARTICLE': ARTICLE_PROPERTY_ID}},
+        catalog_groups=dict(PRICE_GROUPS),
+        base_group_id=PRICE_GROUPS['BASE']
+    )
+    return processor
+
+
+def resolve(processor: UnderpriceProcessor):
+    return [
+        (rule, processor.resolve_price_group(rule.price_code_from), processor.resolve_price_group(rule.price_code_to))
+        for rule in RULES
+    ]
+
+
+def run_rows(db: sqlite3.Connection) -> BenchConnection:
+    connection = BenchConnection(db)
+    processor = make_processor(connection, 'rows')
+    for rule, price_from_id, price_to_id in resolve(processor):
+        processor.process_rule_rows(rule, price_from_id, price_to_id)
+    return connection
+
+
+def run_fused(db: sqlite3.Connection) -> BenchConnection:
+    connection = BenchConnection(db)
+    processor = make_processor(connection, 'rows')
+    processor.process_rules_fused(resolve(processor))
+    return connection
+
+
+def run_matrix(db: sqlite3.Connection) -> BenchConnection:
+    connection = BenchConnection(db)
+    processor = make_processor(connection, 'matrix')
+    processor.process_rules_matrix(resolve(processor))
+    return connection
+
+
+def price_state(db: sqlite3.Connection) -> dict:
+    state = dict(((product_id, None), price) for product_id, price in
+                 db.execute("SELECT ID, PURCHASING_PRICE FROM b_catalog_product"))
+    state.update(((product_id, group_id), price) for product_id, group_id, price in db.execute("""
+    SELECT PRODUCT_ID, CATALOG_GROUP_ID, MIN(PRICE) FROM b_catalog_price GROUP BY PRODUCT_ID, CATALOG_GROUP_ID
+    """))
+    return state
+
+
+def states_match(left: dict, right: dict) -> bool:
+    # Построчный режим пишет неокруглённую цену, матрица - округлённую до копеек
+    # (как хранит DECIMAL(18,2)), поэтому сравнение с допуском в копейку
+    return left.keys() == right.keys() and all(abs(left[k] - right[k]) <= 0.011 for k in left)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк матрицы цен underprice')
+    parser.add_argument('--products', type=int, default=100000, help='Количество товаров')
+    parser.add_argument('--rtt-ms', type=float, default=0.3, help='Сетевая задержка до MySQL для оценки, мс')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"Товаров: {args.products}, групп цен: {len(PRICE_GROUPS)}, правил: {len(RULES)}")
+    print(f"{'режим':<8} {'время, с':>10} {'запросов':>10} {'оценка с RTT, с':>16}")
+
+    states = {}
+    for name, runner in (('rows', run_rows), ('fused', run_fused), ('matrix', run_matrix)):
+        db = build_catalog(args.products, args.seed)
+        start = time.perf_counter()
+        connection = runner(db)
+        elapsed = time.perf_counter() - start
+        estimate = elapsed + connection.round_trips * args.rtt_ms / 1000
+        print(f"{name:<8} {elapsed:>10.2f} {connection.round_trips:>10} {estimate:>16.2f}")
+        states[name] = price_state(db)
+        db.close()
+
+    if not all(states_match(states['rows'], states[name]) for name in ('fused', 'matrix')):
+        print("❌ Результаты режимов различаются")
+        return 1
+    print("✅ Результаты режимов совпадают")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,19 +3,32 @@
 Bitrix Integration - Интеграция с системой Bitrix
 """
 
-import mysql.connector
+import sys
 from mysql.connector import Error
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from dataclasses import dataclass, field
 import logging
 from pathlib import Path
 import csv
 import requests
 import json
+import time
 from datetime import datetime
 
+from bitrix_metadata import BitrixMetadata, get_metadata
+from db_pool import DbPoolConfig, PoolTimeoutError, get_pool
+from metrics import CACHE_REQUESTS, DB_STATEMENT_SECONDS, ROWS_WRITTEN
+from section_tree import SectionTree, get_section_tree
+from tracing import TRACER
+
 logger = logging.getLogger(__name__)
 
+# Размер пачки потоковых выборок из b_iblock_element
+STREAM_CHUNK_SIZE = 5000
+
+# Размер IN-списка и пачки executemany при массовой записи цен
+WRITE_CHUNK_SIZE = 1000
+
 
 @dataclass
 class BitrixConfig:
@@ -30,6 +43,12 @@ class BitrixConfig:
     # Настройки модуля underprice
     underprice_url: Optional[str] = None
     underprice_password: Optional[str] = None
+    
+    # Явный ID свойства артикула (по умолчанию определяется из метаданных)
+    article_property_id: Optional[int] = None
+    
+    # Изменения цены не больше допуска (руб.) не записываются
+    price_tolerance: float = 0.005
 
 
 @dataclass
@@ -55,12 +74,53 @@ class BitrixProduct:
     active: bool
 
 
+@dataclass
+class PriceWriteStats:
+    """Итог массовой записи цен"""
+    changed: int = 0
+    unchanged: int = 0
+    inserted: int = 0
+    failed: int = 0
+    # ID товаров, цены которых были записаны (изменены или созданы)
+    written_ids: List[int] = field(default_factory=list)
+    # ID товаров, запись цен которых не удалась
+    failed_ids: List[int] = field(default_factory=list)
+    
+    @property
+    def written(self) -> int:
+        return self.changed + self.inserted
+    
+    def merge(self, other: 'PriceWriteStats'):
+        self.changed += other.changed
+        self.unchanged += other.unchanged
+        self.inserted += other.inserted
+        self.failed += other.failed
+        self.written_ids.extend(other.written_ids)
+        self.failed_ids.extend(other.failed_ids)
+    
+    def __str__(self) -> str:
+        return (f"изменено {self.changed}, без изменений {self.unchanged}, "
+                f"новых {self.inserted}, ошибок {self.failed}")
+
+
+class ProductRow(NamedTuple):
+    """Компактная строка товара для потоковых выборок"""
+    id: int
+    name: str
+    article: str
+    section_id: Optional[int]
+
+
 class BitrixClient:
     """Клиент для работы с Bitrix"""
     
     def __init__(self, config: BitrixConfig):
         self.config = config
         self.connection = None
+        self.pool = None
+        self.metadata: Optional[BitrixMetadata] = None
+        self.section_tree: Optional[SectionTree] = None
+        self.markup_rules: Optional[List[Dict]] = None
         self.logger = logging.getLogger(__name__)
         
         if not self.logger.handlers:
@@ -71,40 +131,21 @@ class BitrixClient:
             self.logger.setLevel(logging.INFO)
     
     def connect(self):
-        """Подключение к MySQL Bitrix"""
+        """Подключение к MySQL Bitrix (соединение берётся из общего пула)"""
         try:
-            # Принудительно используем IPv4 для избежания проблем с ::1
-            connection_config = {
-                'host': self.config.mysql_host,
-                'port': self.config.mysql_port,
-                'database': self.config.mysql_database,
-                'user': self.config.mysql_username,
-                'password': self.config.mysql_password,
-                'charset': 'utf8mb4',
-                'use_unicode': True,
-                'autocommit': True,
-                # Принудительно используем только IPv4
-                'force_ipv6': False,
-                'use_pure': True  # Использовать чистый Python коннектор
-            }
-            
-            # Если host localhost, принудительно используем 127.0.0.1
-            if self.config.mysql_host.lower() in ['localhost', '::1']:
-                connection_config['host'] = '127.0.0.1'
-                logger.debug("Принудительно используем IPv4 (127.0.0.1) вместо localhost")
-            
-            self.connection = mysql.connector.connect(**connection_config)
-            logger.info(f"Подключение к Bitrix MySQL установлено: {connection_config['host']}:{self.config.mysql_port}")
+            self.pool = get_pool(DbPoolConfig.from_bitrix_config(self.config))
+            self.connection = self.pool.acquire()
             return True
-        except Error as e:
+        except (Error, PoolTimeoutError) as e:
             logger.error(f"Ошибка подключения к MySQL: {e}")
             return False
     
     def disconnect(self):
-        """Отключение от MySQL"""
-        if self.connection and self.connection.is_connected():
-            self.connection.close()
-            logger.info("Подключение к MySQL закрыто")
+        """Возврат соединения в пул"""
+        if self.connection and self.pool:
+            self.pool.release(self.connection)
+            self.connection = None
+            logger.debug("Соединение с MySQL возвращено в пул")
     
     def __enter__(self):
         self.connect()
@@ -113,111 +154,196 @@ class BitrixClient:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.disconnect()
     
-    def get_products_by_prefix(self) -> List[BitrixProduct]:
-        """Получение товаров с префиксом Saturn"""
+    def get_metadata(self, force: bool = False) -> BitrixMetadata:
+        """Метаданные схемы Bitrix (ID свойств, инфоблоков, групп цен)"""
         if not self.connection:
             raise RuntimeError("Нет подключения к базе данных")
         
-        cursor = self.connection.cursor(dictionary=True)
+        if self.metadata is None or force:
+            self.metadata = get_metadata(self.connection, force=force)
+        return self.metadata
+    
+    def get_section_tree(self) -> SectionTree:
+        """Индекс дерева разделов (вложенные множества b_iblock_section)"""
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
         
-        # Сначала проверим, какие поля артикулов используются
-        check_query = """
-        SELECT DISTINCT p.CODE, COUNT(*) as count
-        FROM b_iblock_property p
-        WHERE p.IBLOCK_ID = %s 
-        AND p.CODE IN ('CML2_ARTICLE', 'CML2_TRAIT_ARTIKUL', 'ARTICLE', 'SKU')
-        GROUP BY p.CODE
-        ORDER BY count DESC
-        """
+        if self.section_tree is None:
+            self.section_tree = get_section_tree(self.connection)
+        return self.section_tree
+    
+    def get_article_property_id(self) -> int:
+        """ID свойства артикула в каталоге"""
+        if self.config.article_property_id:
+            return self.config.article_property_id
         
-        cursor.execute(check_query, (self.config.iblock_id,))
-        article_fields = cursor.fetchall()
+        property_id = self.get_metadata().article_property_id(self.config.iblock_id)
+        if not property_id:
+            raise RuntimeError(f"Свойство артикула не найдено в инфоблоке {self.config.iblock_id}")
+        return property_id
+    
+    def get_base_price_group_id(self) -> int:
+        """ID базовой группы цен (BASE)"""
+        return self.get_metadata().price_group_id('BASE') or 1
+    
+    def iter_products_by_prefix(self, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[List[ProductRow]]:
+        """Потоковая выборка товаров Saturn пачками (keyset-пагинация по e.ID)
+        
+        У множественного свойства артикула на товар несколько строк свойства -
+        группировка по e.ID оставляет одну строку на товар (наименьший артикул),
+        иначе граница пачки разрезала бы строки товара и он терялся или дублировался.
+        """
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
         
-        # Выбираем наиболее подходящее поле для артикулов
-        article_field = 'CML2_ARTICLE'  # по умолчанию
-        if article_fields:
-            article_field = article_fields[0]['CODE']
-            logger.info(f"Используем поле артикула: {article_field}")
+        article_property_id = self.get_article_property_id()
         
         query = """
         SELECT 
             e.ID,
             e.NAME,
-            e.ACTIVE,
-            p_article.VALUE as ARTICLE
+            MIN(p_article.VALUE) as ARTICLE,
+            e.IBLOCK_SECTION_ID
         FROM b_iblock_element e
-        LEFT JOIN b_iblock_element_property p_article ON 
-            e.ID = p_article.IBLOCK_ELEMENT_ID AND p_article.IBLOCK_PROPERTY_ID = 112
+        JOIN b_iblock_element_property p_article ON 
+            e.ID = p_article.IBLOCK_ELEMENT_ID AND p_article.IBLOCK_PROPERTY_ID = %s
         WHERE e.IBLOCK_ID = %s 
             AND e.ACTIVE = 'Y'
+            AND e.ID > %s
             AND p_article.VALUE LIKE %s
+        GROUP BY e.ID
         ORDER BY e.ID
+        LIMIT %s
         """
         
-        cursor.execute(query, (
-            self.config.iblock_id,
-            f"{self.config.supplier_prefix}%"
-        ))
+        last_id = 0
+        total = 0
+        while True:
+            # Небуферизованный курсор: строки читаются с сервера по мере обхода,
+            # соединение освобождается до yield, поэтому между пачками его можно
+            # использовать для записи
+            cursor = self.connection.cursor(buffered=False)
+            try:
+                with DB_STATEMENT_SECONDS.time(statement='select_products'):
+                    cursor.execute(query, (
+                        article_property_id,
+                        self.config.iblock_id,
+                        last_id,
+                        f"{self.config.supplier_prefix}%",
+                        chunk_size
+                    ))
+                    chunk = [ProductRow(row[0], row[1], row[2], row[3]) for row in cursor]
+            finally:
+                cursor.close()
+            
+            if not chunk:
+                break
+            
+            last_id = chunk[-1].id
+            total += len(chunk)
+            yield chunk
+            
+            if len(chunk) < chunk_size:
+                break
+        
+        logger.info(f"Найдено товаров Saturn: {total}")
+    
+    def get_sales_by_sku(self, days: int = 30) -> Dict[str, float]:
+        """Проданное количество товаров Saturn за days дней (по корзинам оформленных заказов)
+        
+        Ключ - артикул без префикса поставщика. Без модуля магазина (нет b_sale_basket) - ошибка MySQL.
+        """
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
         
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT p_article.VALUE, SUM(b.QUANTITY)
+                FROM b_sale_basket b
+                JOIN b_iblock_element_property p_article ON
+                    b.PRODUCT_ID = p_article.IBLOCK_ELEMENT_ID AND p_article.IBLOCK_PROPERTY_ID = %s
+                WHERE b.ORDER_ID IS NOT NULL
+                    AND b.DATE_INSERT >= NOW() - INTERVAL %s DAY
+                    AND p_article.VALUE LIKE %s
+                GROUP BY p_article.VALUE
+            """, (self.get_article_property_id(), days, f"{self.config.supplier_prefix}%"))
+            prefix_length = len(self.config.supplier_prefix)
+            return {article[prefix_length:]: float(quantity or 0) for article, quantity in cursor.fetchall()}
+        finally:
+            cursor.close()
+    
+    def get_products_by_prefix(self) -> List[BitrixProduct]:
+        """Получение товаров с префиксом Saturn"""
         products = []
-        for row in cursor.fetchall():
-            products.append(BitrixProduct(
-                id=row['ID'],
-                name=row['NAME'],
-                article=row['ARTICLE'],
-                section_id=None,
-                active=row['ACTIVE'] == 'Y'
-            ))
+        for chunk in self.iter_products_by_prefix():
+            for row in chunk:
+                products.append(BitrixProduct(
+                    id=row.id,
+                    name=row.name,
+                    article=row.article,
+                    section_id=row.section_id,
+                    active=True
+                ))
+        return products
+    
+    def get_products_by_articles(self, articles: List[str]) -> Dict[str, BitrixProduct]:
+        """Поиск активных товаров по списку артикулов (запрос на пачку)"""
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
         
-        cursor.close()
-        logger.info(f"Найдено товаров Saturn: {len(products)}")
+        article_property_id = self.get_article_property_id()
+        products = {}
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(articles), WRITE_CHUNK_SIZE):
+                chunk = articles[i:i + WRITE_CHUNK_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                with DB_STATEMENT_SECONDS.time(statement='select_products_by_articles'):
+                    cursor.execute(f"""
+                    SELECT e.ID, e.NAME, p_article.VALUE, e.IBLOCK_SECTION_ID
+                    FROM b_iblock_element_property p_article
+                    JOIN b_iblock_element e ON e.ID = p_article.IBLOCK_ELEMENT_ID
+                    WHERE p_article.IBLOCK_PROPERTY_ID = %s
+                        AND e.IBLOCK_ID = %s
+                        AND e.ACTIVE = 'Y'
+                        AND p_article.VALUE IN ({placeholders})
+                    """, (article_property_id, self.config.iblock_id, *chunk))
+                    rows = cursor.fetchall()
+                for product_id, name, article, section_id in rows:
+                    products.setdefault(article, BitrixProduct(
+                        id=product_id,
+                        name=name,
+                        article=article,
+                        section_id=section_id,
+                        active=True
+                    ))
+        finally:
+            cursor.close()
         return products
     
-    def get_markup_rule_for_product(self, product_id: int) -> Optional[Dict]:
-        """Получение правила наценки для товара"""
+    def get_product_by_article(self, article: str) -> Optional[BitrixProduct]:
+        """Поиск активного товара по артикулу"""
+        return self.get_products_by_articles([article]).get(article)
+    
+    def get_markup_rules(self, force: bool = False) -> List[Dict]:
+        """Активные правила наценок в порядке SORT (загружаются один раз на клиента)"""
         if not self.connection:
             raise RuntimeError("Нет подключения к базе данных")
         
-        cursor = self.connection.cursor(dictionary=True)
+        if self.markup_rules is not None and not force:
+            CACHE_REQUESTS.inc(cache='markup_rules', result='hit')
+            return self.markup_rules
+        CACHE_REQUESTS.inc(cache='markup_rules', result='miss')
         
-        # Поиск информационного блока с наценками
-        cursor.execute("""
-        SELECT ID FROM b_iblock 
-        WHERE ACTIVE = 'Y' 
-        AND (NAME LIKE '%наценк%' OR CODE LIKE '%markup%' OR CODE LIKE '%price%')
-        ORDER BY ID DESC
-        LIMIT 1
-        """)
-        
-        iblock_row = cursor.fetchone()
-        if not iblock_row:
+        metadata = self.get_metadata()
+        markup_iblock_id = metadata.markup_iblock_id
+        if not markup_iblock_id:
             logger.warning("Информационный блок с наценками не найден")
-            return None
-        
-        markup_iblock_id = iblock_row['ID']
-        logger.info(f"Используем информационный блок наценок: {markup_iblock_id}")
+            self.markup_rules = []
+            return self.markup_rules
         
-        article_query = """
-        SELECT p_article.VALUE as ARTICLE
-        FROM b_iblock_element e
-        LEFT JOIN b_iblock_element_property p_article ON 
-            e.ID = p_article.IBLOCK_ELEMENT_ID AND p_article.IBLOCK_PROPERTY_ID = 112
-        WHERE e.ID = %s
-        """
-        
-        cursor.execute(article_query, (product_id,))
-        article_row = cursor.fetchone()
-        if not article_row:
-            logger.warning(f"Не найден артикул для товара {product_id}")
-            return None
-        
-        article = article_row['ARTICLE']
-        
-        rule_patterns = {
-            'pattern': article,
-            'price_code': 'BASE',
-            'extra': 0
-        }
+        cursor = self.connection.cursor(dictionary=True)
         
         query = """
         SELECT 
@@ -231,25 +357,13 @@ class BitrixClient:
             p3.VALUE as MARKUP_PERCENT
         FROM b_iblock_element e
         LEFT JOIN b_iblock_element_property p1 ON (
-            e.ID = p1.IBLOCK_ELEMENT_ID 
-            AND p1.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PRICE_CODE'
-            )
+            e.ID = p1.IBLOCK_ELEMENT_ID AND p1.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p2 ON (
-            e.ID = p2.IBLOCK_ELEMENT_ID 
-            AND p2.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PRICE_CODE_TO'
-            )
+            e.ID = p2.IBLOCK_ELEMENT_ID AND p2.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p3 ON (
-            e.ID = p3.IBLOCK_ELEMENT_ID 
-            AND p3.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PERCENT'
-            )
+            e.ID = p3.IBLOCK_ELEMENT_ID AND p3.IBLOCK_PROPERTY_ID = %s
         )
         WHERE e.IBLOCK_ID = %s 
         AND e.ACTIVE = 'Y'
@@ -257,7 +371,10 @@ class BitrixClient:
         """
         
         cursor.execute(query, (
-            markup_iblock_id, markup_iblock_id, markup_iblock_id, markup_iblock_id
+            metadata.property_id(markup_iblock_id, 'PRICE_CODE'),
+            metadata.property_id(markup_iblock_id, 'PRICE_CODE_TO'),
+            metadata.property_id(markup_iblock_id, 'PERCENT'),
+            markup_iblock_id
         ))
         
         rules = []
@@ -279,26 +396,57 @@ class BitrixClient:
         
         cursor.close()
         
-        for rule in rules:
-            if self.is_markup_rule_applicable(rule, article):
+        self.markup_rules = rules
+        return rules
+    
+    def get_markup_rule(self, article: str, section_id: Optional[int]) -> Optional[Dict]:
+        """Первое по SORT правило наценки, применимое к товару (без запросов к БД)"""
+        for rule in self.get_markup_rules():
+            if self.is_markup_rule_applicable(rule, article, section_id):
                 return rule
-        
         return None
     
-    def is_markup_rule_applicable(self, rule: Dict, article: str) -> bool:
-        """Проверка применимости правила наценки"""
+    def get_markup_rule_for_product(self, product_id: int) -> Optional[Dict]:
+        """Получение правила наценки для товара"""
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
+        
+        cursor = self.connection.cursor(dictionary=True)
+        
+        article_query = """
+        SELECT p_article.VALUE as ARTICLE, e.IBLOCK_SECTION_ID as SECTION_ID
+        FROM b_iblock_element e
+        LEFT JOIN b_iblock_element_property p_article ON 
+            e.ID = p_article.IBLOCK_ELEMENT_ID AND p_article.IBLOCK_PROPERTY_ID = %s
+        WHERE e.ID = %s
+        """
+        
+        cursor.execute(article_query, (self.get_article_property_id(), product_id))
+        article_row = cursor.fetchone()
+        cursor.close()
+        if not article_row:
+            logger.warning(f"Не найден артикул для товара {product_id}")
+            return None
+        
+        return self.get_markup_rule(article_row['ARTICLE'], article_row['SECTION_ID'])
+    
+    def is_markup_rule_applicable(self, rule: Dict, article: str, section_id: Optional[int] = None) -> bool:
+        """Проверка применимости правила наценки
+        
+        Правило с разделом применяется к товарам этого раздела и всех его
+        подразделов (по индексу дерева разделов).
+        """
         if rule['section_id'] is None:
             return True
         
-        # TODO: реализовать логику проверки применимости правила
-        
-        return False
+        return self.get_section_tree().contains(int(rule['section_id']), section_id)
     
     def update_product_price(self, product_id: int, new_price: float, old_price: float = None) -> bool:
         """Обновление цены товара в Bitrix"""
         if not self.connection:
             raise RuntimeError("Нет подключения к базе данных")
         
+        price_group_id = self.get_base_price_group_id()
         cursor = self.connection.cursor()
         
         try:
@@ -306,21 +454,23 @@ class BitrixClient:
                 SELECT cp.PRICE 
                 FROM b_catalog_price cp
                 WHERE cp.PRODUCT_ID = %s 
-                    AND cp.CATALOG_GROUP_ID = 1
+                    AND cp.CATALOG_GROUP_ID = %s
                 ORDER BY cp.ID DESC
                 LIMIT 1
             """
             
-            cursor.execute(query, (product_id,))
+            cursor.execute(query, (product_id, price_group_id))
             existing_price = cursor.fetchone()
             
-            if existing_price:
+            if existing_price and abs(float(existing_price[0]) - new_price) <= self.config.price_tolerance:
+                logger.debug(f"Цена товара {product_id} не изменилась: {new_price} руб.")
+            elif existing_price:
                 update_query = """
                     UPDATE b_catalog_price 
                     SET PRICE = %s, PRICE_SCALE = %s
-                    WHERE PRODUCT_ID = %s AND CATALOG_GROUP_ID = 1
+                    WHERE PRODUCT_ID = %s AND CATALOG_GROUP_ID = %s
                 """
-                cursor.execute(update_query, (new_price, new_price, product_id))
+                cursor.execute(update_query, (new_price, new_price, product_id, price_group_id))
                 logger.debug(f"Обновлена цена для товара {product_id}: {old_price} → {new_price} руб.")
             else:
                 if cursor.rowcount == 0:
@@ -329,7 +479,7 @@ class BitrixClient:
                         (PRODUCT_ID, CATALOG_GROUP_ID, PRICE, CURRENCY, TIMESTAMP_X)
                         VALUES (%s, %s, %s, 'RUB', NOW())
                     """
-                    cursor.execute(insert_query, (product_id, 1, new_price))
+                    cursor.execute(insert_query, (product_id, price_group_id, new_price))
                     logger.debug(f"Создана новая цена для товара {product_id}: {new_price} руб.")
             
             # autocommit=True уже установлен, commit() не нужен
@@ -342,17 +492,119 @@ class BitrixClient:
         finally:
             cursor.close()
     
-    def trigger_underprice_module(self, product_id: int):
-        """Запуск модуля underprice для пересчета скидок"""
+    def get_current_prices(self, product_ids: List[int], price_group_id: int) -> Dict[int, float]:
+        """Текущие цены группы для набора товаров (запрос на пачку ID)"""
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
+        
+        prices = {}
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(product_ids), WRITE_CHUNK_SIZE):
+                chunk = product_ids[i:i + WRITE_CHUNK_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                with DB_STATEMENT_SECONDS.time(statement='select_prices'):
+                    cursor.execute(f"""
+                        SELECT PRODUCT_ID, PRICE
+                        FROM b_catalog_price
+                        WHERE CATALOG_GROUP_ID = %s AND PRODUCT_ID IN ({placeholders})
+                    """, (price_group_id, *chunk))
+                    rows = cursor.fetchall()
+                for product_id, price in rows:
+                    prices[int(product_id)] = float(price)
+        finally:
+            cursor.close()
+        return prices
+    
+    def write_prices(self, new_prices: Dict[int, float]) -> PriceWriteStats:
+        """Массовая запись базовых цен: пишутся только изменившиеся и новые строки"""
+        if not self.connection:
+            raise RuntimeError("Нет подключения к базе данных")
+        
+        stats = PriceWriteStats()
+        if not new_prices:
+            return stats
+        
+        price_group_id = self.get_base_price_group_id()
+        current_prices = self.get_current_prices(list(new_prices), price_group_id)
+        
+        to_update = []
+        to_insert = []
+        for product_id, new_price in new_prices.items():
+            new_price = round(new_price, 2)
+            current_price = current_prices.get(product_id)
+            if current_price is None:
+                to_insert.append((product_id, price_group_id, new_price, new_price))
+            elif abs(current_price - new_price) > self.config.price_tolerance:
+                to_update.append((new_price, new_price, product_id, price_group_id))
+            else:
+                stats.unchanged += 1
+        
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(to_update), WRITE_CHUNK_SIZE):
+                chunk = to_update[i:i + WRITE_CHUNK_SIZE]
+                try:
+                    with DB_STATEMENT_SECONDS.time(statement='update_prices'):
+                        cursor.executemany("""
+                            UPDATE b_catalog_price 
+                            SET PRICE = %s, PRICE_SCALE = %s, TIMESTAMP_X = NOW()
+                            WHERE PRODUCT_ID = %s AND CATALOG_GROUP_ID = %s
+                        """, chunk)
+                    ROWS_WRITTEN.inc(len(chunk), table='b_catalog_price', operation='update')
+                    stats.changed += len(chunk)
+                    stats.written_ids.extend(row[2] for row in chunk)
+                except Error as e:
+                    logger.error(f"Ошибка массового обновления цен: {e}")
+                    stats.failed += len(chunk)
+                    stats.failed_ids.extend(row[2] for row in chunk)
+            
+            for i in range(0, len(to_insert), WRITE_CHUNK_SIZE):
+                chunk = to_insert[i:i + WRITE_CHUNK_SIZE]
+                try:
+                    with DB_STATEMENT_SECONDS.time(statement='insert_prices'):
+                        cursor.executemany("""
+                            INSERT INTO b_catalog_price 
+                            (PRODUCT_ID, CATALOG_GROUP_ID, PRICE, PRICE_SCALE, CURRENCY, TIMESTAMP_X)
+                            VALUES (%s, %s, %s, %s, 'RUB', NOW())
+                        """, chunk)
+                    ROWS_WRITTEN.inc(len(chunk), table='b_catalog_price', operation='insert')
+                    stats.inserted += len(chunk)
+                    stats.written_ids.extend(row[0] for row in chunk)
+                except Error as e:
+                    logger.error(f"Ошибка массовой вставки цен: {e}")
+                    stats.failed += len(chunk)
+                    stats.failed_ids.extend(row[0] for row in chunk)
+        finally:
+            cursor.close()
+        
+        logger.info(f"Запись цен: {stats}")
+        return stats
+    
+    def trigger_underprice_module(self, product_ids: Union[int, Iterable[int], None] = None):
+        """Запуск модуля underprice для пересчета скидок
+        
+        product_ids ограничивает пересчёт этими товарами, None - весь каталог.
+        """
         try:
             # Используем новый Python модуль underprice вместо HTTP запроса
             from underprice_python import UnderpriceProcessor
             
+            if isinstance(product_ids, int):
+                product_ids = [product_ids]
+            
             logger.info("Запускаем Python модуль underprice...")
             processor = UnderpriceProcessor()
             processor.connect()
-            processor.process_underprice_rules()
-            processor.disconnect()
+            try:
+                processor.process_underprice_rules(product_ids)
+            finally:
+                processor.disconnect()
+            
+            # Частичный пересчёт - не успех: вызывающий должен повторить его
+            if processor.failures:
+                logger.warning(f"Модуль underprice выполнен с ошибками: {processor.failures}")
+                return False
             
             logger.info("Модуль underprice успешно выполнен")
             return True
@@ -395,12 +647,12 @@ class MarkupProcessor:
     
     def load_markup_rules(self):
         """Загрузка правил наценок"""
-        self.markup_rules = self.bitrix_client.get_markup_rules()
+        self.markup_rules = self.bitrix_client.get_markup_rules(force=True)
     
     def apply_markup(self, product: BitrixProduct, original_price: float) -> Tuple[float, float]:
         """Применение наценки к цене товара"""
-        # Ищем правило наценки в инфоблоке Bitrix
-        markup_rule = self.bitrix_client.get_markup_rule_for_product(product.id)
+        # Ищем правило наценки в инфоблоке Bitrix (правила и дерево разделов кэшированы в клиенте)
+        markup_rule = self.bitrix_client.get_markup_rule(product.article, product.section_id)
         
         if markup_rule:
             markup_percent = markup_rule['markup_percent']
@@ -447,32 +699,44 @@ def process_saturn_prices(input_csv: str, config: BitrixConfig, output_csv: str
     logger.info(f"Загружено цен Saturn: {len(saturn_prices)}")
     
     bitrix_client = BitrixClient(config)
+    if not bitrix_client.connect():
+        logger.error("Не удалось подключиться к Bitrix")
+        return False
     
-    # Загрузка товаров
-    products = bitrix_client.get_products_by_prefix()
-    
-    # Обработка товаров
+    # Обработка товаров потоком: пачки из Bitrix сразу сопоставляются с ценами Saturn
     processed_count = 0
-    updated_count = 0
+    write_stats = PriceWriteStats()
+    written_skus = {}
     results = []
     
-    for product in products:
-        # Удаляем префикс для поиска в Saturn
-        saturn_sku = product.article.replace(config.supplier_prefix, '')
+    for chunk in bitrix_client.iter_products_by_prefix():
+        chunk_prices = {}
+        chunk_skus = {}
         
-        if saturn_sku in saturn_prices:
+        for row in chunk:
+            # Удаляем префикс для поиска в Saturn
+            saturn_sku = row.article.replace(config.supplier_prefix, '')
+            
+            if saturn_sku not in saturn_prices:
+                continue
+            
+            product = BitrixProduct(
+                id=row.id,
+                name=row.name,
+                article=row.article,
+                section_id=row.section_id,
+                active=True
+            )
             saturn_data = saturn_prices[saturn_sku]
             original_price = saturn_data['price']
             
             # Применение наценки
-            final_price, markup_percent = MarkupProcessor(bitrix_client).apply_markup(product, original_price)
+            with TRACER.span('markup', sku=saturn_sku):
+                final_price, markup_percent = MarkupProcessor(bitrix_client).apply_markup(product, original_price)
             
-            # Обновление цены в Bitrix
-            if bitrix_client.update_product_price(product.id, final_price, original_price):
-                updated_count += 1
-                logger.info(f"✅ {product.article}: {original_price} → {final_price:.2f} руб.")
-            else:
-                logger.error(f"❌ Ошибка обновления цены для {product.article}")
+            chunk_prices[product.id] = final_price
+            chunk_skus[product.id] = saturn_sku
+            logger.debug(f"{product.article}: {original_price} → {final_price:.2f} руб.")
             
             # Сохранение результата
             results.append({
@@ -486,6 +750,13 @@ def process_saturn_prices(input_csv: str, config: BitrixConfig, output_csv: str
             })
             
             processed_count += 1
+        
+        # Обновление цен в Bitrix: одна выборка текущих цен на пачку, запись только изменившихся
+        start, started = time.time(), time.perf_counter()
+        chunk_stats = bitrix_client.write_prices(chunk_prices)
+        TRACER.record(chunk_skus.values(), 'write', start, time.perf_counter() - started, batch=len(chunk_prices))
+        write_stats.merge(chunk_stats)
+        written_skus.update((product_id, chunk_skus[product_id]) for product_id in chunk_stats.written_ids)
     
     # Сохранение результатов в CSV
     if output_csv and results:
@@ -495,14 +766,21 @@ def process_saturn_prices(input_csv: str, config: BitrixConfig, output_csv: str
             writer.writerows(results)
         logger.info(f"Результаты сохранены: {output_csv}")
     
-    # Запуск модуля скидок
-    if updated_count > 0:
-        logger.info("Запускаем пересчет скидок...")
-        for product in products:
-            bitrix_client.trigger_underprice_module(product.id)
+    # Запуск модуля скидок один раз на синхронизацию и только для изменённых товаров
+    underprice_ok = True
+    if write_stats.written > 0:
+        logger.info(f"Запускаем пересчет скидок для {len(write_stats.written_ids)} товаров...")
+        start, started = time.time(), time.perf_counter()
+        underprice_ok = bitrix_client.trigger_underprice_module(write_stats.written_ids)
+        TRACER.record(written_skus.values(), 'underprice', start, time.perf_counter() - started,
+                      products=len(written_skus))
+    
+    bitrix_client.disconnect()
     
-    logger.info(f"Обработка завершена. Обработано: {processed_count}, обновлено: {updated_count}")
-    return updated_count > 0
+    logger.info(f"Обработка завершена. Обработано: {processed_count}, цены: {write_stats}")
+    if not underprice_ok:
+        logger.warning("Пересчет скидок не завершен, обработка считается неуспешной")
+    return processed_count > 0 and write_stats.failed == 0 and underprice_ok
 
 
 def main():
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Bitrix Metadata - кэш метаданных схемы Bitrix
+
+Один раз разрешает ID свойств, ID инфоблоков наценок и underprice,
+XML_ID значений списков и группы цен, сохраняет их на диск вместе
+с отпечатком схемы и отдаёт горячим запросам готовые целые ID.
+"""
+
+import json
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = Path("cache") / "bitrix_metadata.json"
+
+# Как часто (сек) перепроверять отпечаток схемы для кэша в памяти
+FINGERPRINT_CHECK_INTERVAL = 300
+
+# Коды свойств артикула в порядке приоритета
+ARTICLE_PROPERTY_CODES = ('CML2_ARTICLE', 'CML2_TRAIT_ARTIKUL', 'ARTICLE', 'SKU')
+
+# Запросы, по агрегатам которых считается отпечаток схемы
+FINGERPRINT_QUERIES = (
+    "SELECT COUNT(*), MAX(ID), MAX(TIMESTAMP_X) FROM b_iblock",
+    "SELECT COUNT(*), MAX(ID), MAX(TIMESTAMP_X) FROM b_iblock_property",
+    # b_iblock_property_enum без TIMESTAMP_X: правка XML_ID видна только по
+    # содержимому, поэтому хэшируются значения, которые попадают в enum_xml_ids
+    """
+    SELECT COUNT(*), MAX(pe.ID), SUM(CRC32(CONCAT_WS(':', pe.ID, pe.XML_ID)))
+    FROM b_iblock_property_enum pe
+    JOIN b_iblock_property p ON p.ID = pe.PROPERTY_ID
+    WHERE p.IBLOCK_ID = (
+        SELECT MAX(VALUE) FROM b_option WHERE MODULE_ID = 'mcart.underprice' AND NAME = 'SETTINGS_IBLOCK_ID'
+    )
+    """,
+    "SELECT COUNT(*), MAX(ID), MAX(TIMESTAMP_X) FROM b_catalog_group",
+    "SELECT MAX(VALUE) FROM b_option WHERE MODULE_ID = 'mcart.underprice' AND NAME = 'SETTINGS_IBLOCK_ID'",
+)
+
+
+@dataclass
+class BitrixMetadata:
+    """Разрешённые метаданные схемы Bitrix"""
+    fingerprint: str
+    # IBLOCK_ID -> CODE свойства -> ID свойства
+    properties: Dict[int, Dict[str, int]] = field(default_factory=dict)
+    markup_iblock_id: Optional[int] = None
+    underprice_iblock_id: Optional[int] = None
+    # ID значения списка -> XML_ID (для свойств инфоблока настроек underprice)
+    enum_xml_ids: Dict[int, str] = field(default_factory=dict)
+    # NAME группы цен (BASE, RETAIL, ...) -> ID
+    catalog_groups: Dict[str, int] = field(default_factory=dict)
+    base_group_id: Optional[int] = None
+    loaded_at: Optional[str] = None
+
+    def property_id(self, iblock_id: int, code: str) -> Optional[int]:
+        return self.properties.get(iblock_id, {}).get(code)
+
+    def article_property_id(self, iblock_id: int) -> Optional[int]:
+        for code in ARTICLE_PROPERTY_CODES:
+            property_id = self.property_id(iblock_id, code)
+            if property_id:
+                return property_id
+        return None
+
+    def price_group_id(self, code: str) -> Optional[int]:
+        if code in self.catalog_groups:
+            return self.catalog_groups[code]
+        if code == 'BASE':
+            return self.base_group_id
+        return None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'BitrixMetadata':
+        # JSON хранит ключи словарей строками - возвращаем им тип int
+        return cls(
+            fingerprint=data['fingerprint'],
+            properties={
+                int(iblock_id): {code: int(pid) for code, pid in codes.items()}
+                for iblock_id, codes in data.get('properties', {}).items()
+            },
+            markup_iblock_id=data.get('markup_iblock_id'),
+            underprice_iblock_id=data.get('underprice_iblock_id'),
+            enum_xml_ids={int(k): v for k, v in data.get('enum_xml_ids', {}).items()},
+            catalog_groups={k: int(v) for k, v in data.get('catalog_groups', {}).items()},
+            base_group_id=data.get('base_group_id'),
+            loaded_at=data.get('loaded_at')
+        )
+
+
+class BitrixMetadataCache:
+    """Кэш метаданных: память процесса -> файл на диске -> MySQL"""
+
+    def __init__(self, cache_file: Path = DEFAULT_CACHE_FILE):
+        self.cache_file = Path(cache_file)
+        self.lock = threading.Lock()
+        self._metadata: Optional[BitrixMetadata] = None
+        self._checked_at = 0.0
+
+    def get(self, connection, force: bool = False) -> BitrixMetadata:
+        """Возвращает метаданные, перезагружая их только при смене схемы"""
+        with self.lock:
+            now = time.monotonic()
+            if (not force and self._metadata
+                    and now - self._checked_at < FINGERPRINT_CHECK_INTERVAL):
+                CACHE_REQUESTS.inc(cache='metadata', result='hit')
+                return self._metadata
+
+            fingerprint = compute_schema_fingerprint(connection)
+            self._checked_at = now
+
+            if not force and self._metadata and self._metadata.fingerprint == fingerprint:
+                CACHE_REQUESTS.inc(cache='metadata', result='hit')
+                return self._metadata
+
+            if not force:
+                cached = self._read_file()
+                if cached and cached.fingerprint == fingerprint:
+                    logger.debug("Метаданные Bitrix загружены из кэша")
+                    CACHE_REQUESTS.inc(cache='metadata', result='hit')
+                    self._metadata = cached
+                    return cached
+
+            CACHE_REQUESTS.inc(cache='metadata', result='miss')
+            logger.info("Загрузка метаданных схемы Bitrix...")
+            self._metadata = load_metadata_from_db(connection, fingerprint)
+            self._write_file(self._metadata)
+            return self._metadata
+
+    def invalidate(self):
+        with self.lock:
+            self._metadata = None
+            self._checked_at = 0.0
+
+    def _read_file(self) -> Optional[BitrixMetadata]:
+        if not self.cache_file.exists():
+            return None
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return BitrixMetadata.from_dict(json.load(f))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logger.warning(f"Не удалось прочитать кэш метаданных {self.cache_file}: {e}")
+            return None
+
+    def _write_file(self, metadata: BitrixMetadata):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix('.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(metadata.to_dict(), f, ensure_ascii=False, indent=2)
+            tmp_file.replace(self.cache_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш метаданных {self.cache_file}: {e}")
+
+
+def compute_schema_fingerprint(connection) -> str:
+    """Отпечаток схемы по дешёвым агрегатам служебных таблиц"""
+    cursor = connection.cursor()
+    digest = hashlib.sha1()
+    try:
+        for query in FINGERPRINT_QUERIES:
+            cursor.execute(query)
+            digest.update(repr(cursor.fetchall()).encode('utf-8'))
+    finally:
+        cursor.close()
+    return digest.hexdigest()
+
+
+def load_metadata_from_db(connection, fingerprint: str) -> BitrixMetadata:
+    """Полная загрузка метаданных - несколько запросов на весь процесс"""
+    cursor = connection.cursor(dictionary=True)
+    metadata = BitrixMetadata(fingerprint=fingerprint, loaded_at=datetime.now().isoformat())
+
+    try:
+        cursor.execute("""
+        SELECT ID, IBLOCK_ID, CODE FROM b_iblock_property
+        WHERE CODE IS NOT NULL AND CODE <> ''
+        ORDER BY ID
+        """)
+        for row in cursor.fetchall():
+            # При дублях кода выигрывает первое (наименьшее) свойство
+            metadata.properties.setdefault(int(row['IBLOCK_ID']), {}).setdefault(row['CODE'], int(row['ID']))
+
+        cursor.execute("""
+        SELECT ID FROM b_iblock
+        WHERE ACTIVE = 'Y'
+        AND (NAME LIKE '%наценк%' OR CODE LIKE '%markup%' OR CODE LIKE '%price%')
+        ORDER BY ID DESC
+        LIMIT 1
+        """)
+        row = cursor.fetchone()
+        metadata.markup_iblock_id = int(row['ID']) if row else None
+
+        cursor.execute("""
+        SELECT VALUE FROM b_option
+        WHERE MODULE_ID = 'mcart.underprice' AND NAME = 'SETTINGS_IBLOCK_ID'
+        """)
+        row = cursor.fetchone()
+        metadata.underprice_iblock_id = int(row['VALUE']) if row and row['VALUE'] else None
+
+        if metadata.underprice_iblock_id:
+            cursor.execute("""
+            SELECT pe.ID, pe.XML_ID
+            FROM b_iblock_property_enum pe
+            JOIN b_iblock_property p ON p.ID = pe.PROPERTY_ID
+            WHERE p.IBLOCK_ID = %s
+            """, (metadata.underprice_iblock_id,))
+            metadata.enum_xml_ids = {int(row['ID']): row['XML_ID'] for row in cursor.fetchall()}
+
+        cursor.execute("SELECT ID, NAME, BASE FROM b_catalog_group ORDER BY SORT, ID")
+        for row in cursor.fetchall():
+            metadata.catalog_groups.setdefault(row['NAME'], int(row['ID']))
+            if row['BASE'] == 'Y' and metadata.base_group_id is None:
+                metadata.base_group_id = int(row['ID'])
+    finally:
+        cursor.close()
+
+    logger.info(
+        f"Метаданные Bitrix: свойств {sum(len(p) for p in metadata.properties.values())}, "
+        f"инфоблок наценок {metadata.markup_iblock_id}, инфоблок underprice {metadata.underprice_iblock_id}, "
+        f"групп цен {len(metadata.catalog_groups)}"
+    )
+    return metadata
+
+
+_default_cache = BitrixMetadataCache()
+
+
+def get_metadata(connection, force: bool = False) -> BitrixMetadata:
+    """Метаданные через общий для процесса кэш"""
+    return _default_cache.get(connection, force=force)
+
+
+def invalidate_metadata():
+    _default_cache.invalidate()
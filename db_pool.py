@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+DB Pool - общий пул соединений MySQL для всех пользователей базы Bitrix
+
+BitrixClient, UnderpriceProcessor и служебные скрипты берут соединения
+из одного пула вместо того, чтобы открывать свои. Перед выдачей соединение,
+простоявшее дольше health_check_interval, проверяется ping'ом.
+
+По умолчанию используется чистый Python коннектор (use_pure=True), режим
+C-расширения mysql-connector включается через BITRIX_MYSQL_C_EXTENSION=1.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import mysql.connector
+from mysql.connector import Error
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(RuntimeError):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+@dataclass
+class DbPoolConfig:
+    host: str
+    port: int
+    database: str
+    user: str
+    password: str
+    pool_size: int = 5
+    use_pure: bool = True
+    health_check_interval: float = 30.0
+    acquire_timeout: float = 60.0
+
+    @property
+    def key(self) -> Tuple:
+        return (self.host, self.port, self.database, self.user, self.use_pure)
+
+    @classmethod
+    def from_env(cls) -> 'DbPoolConfig':
+        return cls(
+            host=os.getenv('BITRIX_MYSQL_HOST', '127.0.0.1'),
+            port=int(os.getenv('BITRIX_MYSQL_PORT', 3306)),
+            database=os.getenv('BITRIX_MYSQL_DATABASE', 'sitemanager'),
+            user=os.getenv('BITRIX_MYSQL_USERNAME', 'bitrix_sync'),
+            password=os.getenv('BITRIX_MYSQL_PASSWORD', ''),
+            **_pool_options_from_env()
+        )
+
+    @classmethod
+    def from_bitrix_config(cls, config) -> 'DbPoolConfig':
+        return cls(
+            host=config.mysql_host,
+            port=config.mysql_port,
+            database=config.mysql_database,
+            user=config.mysql_username,
+            password=config.mysql_password,
+            **_pool_options_from_env()
+        )
+
+
+def _pool_options_from_env() -> Dict:
+    return {
+        'pool_size': int(os.getenv('BITRIX_MYSQL_POOL_SIZE', 5)),
+        'use_pure': os.getenv('BITRIX_MYSQL_C_EXTENSION', '0').lower() not in ('1', 'true', 'yes'),
+        'health_check_interval': float(os.getenv('BITRIX_MYSQL_HEALTH_CHECK_INTERVAL', 30)),
+    }
+
+
+def c_extension_available() -> bool:
+    try:
+        return bool(mysql.connector.HAVE_CEXT)
+    except AttributeError:
+        return False
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с ограничением размера и проверкой живости"""
+
+    def __init__(self, config: DbPoolConfig):
+        self.config = config
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config.pool_size)
+        self.created_count = 0
+        # Выданные и ещё не возвращённые соединения
+        self.in_use = 0
+        self.closed = False
+
+        self.use_pure = config.use_pure
+        if not self.use_pure and not c_extension_available():
+            logger.warning("C-расширение mysql-connector недоступно, используем чистый Python коннектор")
+            self.use_pure = True
+
+    def _open(self):
+        # Принудительно используем IPv4 для избежания проблем с ::1
+        host = self.config.host
+        if host.lower() in ['localhost', '::1']:
+            host = '127.0.0.1'
+            logger.debug("Принудительно используем IPv4 (127.0.0.1) вместо localhost")
+
+        connection = mysql.connector.connect(
+            host=host,
+            port=self.config.port,
+            database=self.config.database,
+            user=self.config.user,
+            password=self.config.password,
+            charset='utf8mb4',
+            use_unicode=True,
+            autocommit=True,
+            force_ipv6=False,
+            use_pure=self.use_pure
+        )
+
+        with self._lock:
+            self.created_count += 1
+        mode = 'pure' if self.use_pure else 'C'
+        logger.info(f"Подключение к Bitrix MySQL установлено: {host}:{self.config.port} ({mode})")
+        return connection
+
+    def _is_healthy(self, connection, released_at: float) -> bool:
+        if time.monotonic() - released_at < self.config.health_check_interval:
+            return True
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Error as e:
+            logger.debug(f"Соединение из пула не прошло проверку: {e}")
+            return False
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    @property
+    def free(self) -> int:
+        """Сколько соединений можно получить сейчас без ожидания"""
+        with self._lock:
+            return self.config.pool_size - self.in_use
+
+    def acquire(self, timeout: Optional[float] = None):
+        """Получение соединения; блокируется, пока пул исчерпан"""
+        if self.closed:
+            raise RuntimeError("Пул соединений закрыт")
+
+        wait = self.config.acquire_timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=wait):
+            raise PoolTimeoutError(f"Нет свободных соединений в пуле (размер {self.config.pool_size})")
+
+        with self._lock:
+            self.in_use += 1
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._open()
+
+                connection, released_at = item
+                if self._is_healthy(connection, released_at):
+                    return connection
+                self._close_quietly(connection)
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        """Возврат соединения в пул"""
+        if connection is None:
+            return
+        try:
+            if self.closed or not connection.is_connected():
+                self._close_quietly(connection)
+                return
+            if connection.in_transaction:
+                connection.rollback()
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        except Error:
+            self._close_quietly(connection)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close_all(self):
+        self.closed = True
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, _ in idle:
+            self._close_quietly(connection)
+        logger.info("Пул соединений MySQL закрыт")
+
+
+_pools: Dict[Tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config: Optional[DbPoolConfig] = None) -> ConnectionPool:
+    """Общий для процесса пул для заданных параметров подключения"""
+    config = config or DbPoolConfig.from_env()
+    with _pools_lock:
+        pool = _pools.get(config.key)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(config)
+            _pools[config.key] = pool
+        return pool
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
@@ -4,26 +4,24 @@
 """
 
 import os
-import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
 
+from db_pool import DbPoolConfig, get_pool
+
 # Загружаем переменные окружения
 load_dotenv()
 
 def check_database():
     """Проверка базы данных и поиск товаров Saturn"""
     
+    pool = get_pool(DbPoolConfig.from_env())
+    connection = None
+    cursor = None
+    
     try:
         # Подключение к базе данных
-        connection = mysql.connector.connect(
-            host=os.getenv('BITRIX_MYSQL_HOST', '127.0.0.1'),
-            port=int(os.getenv('BITRIX_MYSQL_PORT', 3306)),
-            database=os.getenv('BITRIX_MYSQL_DATABASE', 'sitemanager'),
-            user=os.getenv('BITRIX_MYSQL_USERNAME', 'bitrix_sync'),
-            password=os.getenv('BITRIX_MYSQL_PASSWORD', ''),
-            charset='utf8mb4'
-        )
+        connection = pool.acquire()
         
         cursor = connection.cursor(dictionary=True)
         print(f"✅ Подключение к базе данных установлено")
@@ -132,9 +130,11 @@ def check_database():
         print(f"❌ Ошибка базы данных: {e}")
     
     finally:
-        if connection and connection.is_connected():
+        if cursor:
             cursor.close()
-            connection.close()
+        if connection:
+            pool.release(connection)
+            pool.close_all()
             print(f"\n✅ Соединение с базой данных закрыто")
 
 if __name__ == "__main__":
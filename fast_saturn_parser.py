@@ -7,7 +7,7 @@ import requests
 import csv
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
 from dataclasses import dataclass
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
@@ -15,6 +15,11 @@ from bs4 import BeautifulSoup
 import threading
 from dotenv import load_dotenv
 
+from metrics import HTTP_REQUEST_SECONDS, PARSE_SECONDS, SKUS_TOTAL
+from price_history import PriceHistory
+from sync_journal import FAILED, PENDING, SCRAPED, SyncJournal
+from tracing import TRACER
+
 load_dotenv()
 
 @dataclass
@@ -29,11 +34,12 @@ class ProductPrice:
 
 class FastSaturnParser:
     
-    def __init__(self, max_workers: int = 10, request_delay: float = 0.1):
+    def __init__(self, max_workers: int = 10, request_delay: float = 0.1, db_writers: int = 1):
         self.base_url = "https://msk.saturn.net"
         self.search_url = f"{self.base_url}/catalog/?sp%5Bname%5D=1&sp%5Bartikul%5D=1&search=&s="
         self.max_workers = max_workers
         self.request_delay = request_delay
+        self.db_writers = db_writers
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -43,18 +49,62 @@ class FastSaturnParser:
             'Connection': 'keep-alive',
             'Upgrade-Insecure-Requests': '1',
         })
+        # Пул соединений по числу потоков, иначе часть потоков открывает соединения заново
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # Установленное событие прекращает выдачу новых задач (остановка демона)
+        self.stop_event: Optional[threading.Event] = None
+        # Срок (unix-время): к нему невыполненные задачи снимаются, задачи идут в порядке подачи
+        self.deadline: Optional[float] = None
+        # Вызывается перед каждым HTTP-запросом (общий лимит запросов между процессами)
+        self.rate_limiter: Optional[Callable[[], None]] = None
         
         self.log_lock = threading.Lock()
         self.logger = logging.getLogger(__name__)
+        # Счётчики прогона меняются только под stats_lock
+        self.stats_lock = threading.Lock()
         self.processed_count = 0
         self.success_count = 0
         self.error_count = 0
     
+    def _count(self, success: Optional[bool]) -> int:
+        """Учёт обработанного артикула (None - ошибка); возвращает число обработанных"""
+        with self.stats_lock:
+            self.processed_count += 1
+            if success:
+                self.success_count += 1
+            else:
+                self.error_count += 1
+            processed = self.processed_count
+        SKUS_TOTAL.inc(result='found' if success else 'not_found' if success is not None else 'error')
+        return processed
+    
+    def _get(self, url: str, page: str = 'search'):
+        if self.rate_limiter is not None:
+            self.rate_limiter()
+        with TRACER.span(f"fetch_{page}") as span, \
+                HTTP_REQUEST_SECONDS.time(page=page, status='error') as labels:
+            response = self.session.get(url, timeout=10)
+            labels['status'] = span['status'] = response.status_code
+        return response
+    
+    def _parsed(self, start: float, method: str, result: Optional[ProductPrice]) -> Optional[ProductPrice]:
+        PARSE_SECONDS.observe(time.perf_counter() - start, method=method)
+        TRACER.annotate(method=method)
+        return result
+    
+    def _traced_parse(self, sku: str) -> Optional[ProductPrice]:
+        with TRACER.activate(sku), TRACER.span('parse'):
+            return self.parse_single_product(sku)
+    
     def parse_single_product(self, sku: str) -> Optional[ProductPrice]:
+        start = time.perf_counter()
         try:
             # Сначала пробуем прямой поиск на странице поиска
             url = f"{self.search_url}{sku}"
-            response = self.session.get(url, timeout=10)
+            response = self._get(url)
             response.raise_for_status()
             soup = BeautifulSoup(response.content, 'html.parser')
             
@@ -77,7 +127,7 @@ class FastSaturnParser:
                 if price_elem and price_elem.get('data-price'):
                     try:
                         price = float(price_elem.get('data-price'))
-                        return ProductPrice(
+                        return self._parsed(start, 'search_list', ProductPrice(
                             sku=sku,
                             name=name,
                             price=price,
@@ -85,7 +135,7 @@ class FastSaturnParser:
                             availability="В наличии",
                             url=url,
                             parsed_at=datetime.now()
-                        )
+                        ))
                     except ValueError:
                         continue
             
@@ -110,7 +160,7 @@ class FastSaturnParser:
                             product_url = href
                         
                         # Переходим на страницу товара
-                        product_response = self.session.get(product_url, timeout=10)
+                        product_response = self._get(product_url, page='product')
                         if product_response.status_code != 200:
                             continue
                         
@@ -142,7 +192,7 @@ class FastSaturnParser:
                                 if not name:
                                     name = link.get_text(strip=True)
                                 
-                                return ProductPrice(
+                                return self._parsed(start, 'product_page', ProductPrice(
                                     sku=sku,
                                     name=name,
                                     price=price,
@@ -150,7 +200,7 @@ class FastSaturnParser:
                                     availability="В наличии",
                                     url=product_url,
                                     parsed_at=datetime.now()
-                                )
+                                ))
                                 
                             except (ValueError, TypeError):
                                 continue
@@ -176,7 +226,7 @@ class FastSaturnParser:
                             price_value = price_elements[0].get('data-price')
                             price = float(price_value)
                             
-                            return ProductPrice(
+                            return self._parsed(start, 'text_fallback', ProductPrice(
                                 sku=sku,
                                 name=f"Товар {sku}",
                                 price=price,
@@ -184,32 +234,51 @@ class FastSaturnParser:
                                 availability="В наличии",
                                 url=url,
                                 parsed_at=datetime.now()
-                            )
+                            ))
                         except (ValueError, TypeError):
                             continue
                     
                     current = current.parent
             
-            return None
+            return self._parsed(start, 'not_found', None)
             
         except requests.exceptions.RequestException as e:
             with self.log_lock:
                 self.logger.warning(f"Ошибка запроса для {sku}: {e}")
-            return None
+            return self._parsed(start, 'request_error', None)
         except Exception as e:
             with self.log_lock:
                 self.logger.error(f"Ошибка парсинга {sku}: {e}")
-            return None
+            return self._parsed(start, 'error', None)
     
-    def parse_products_batch(self, skus: List[str], output_file: str = None, update_bitrix: bool = True) -> List[ProductPrice]:
+    def parse_products_batch(self, skus: List[str], output_file: str = None, update_bitrix: bool = True,
+                             journal: Optional[SyncJournal] = None,
+                             history: Optional[PriceHistory] = None) -> List[ProductPrice]:
         start_time = time.time()
         results = []
+        with self.stats_lock:
+            self.processed_count = 0
+            self.success_count = 0
+            self.error_count = 0
         
-        # Подключение к Bitrix для обновления цен
-        bitrix_client = None
+        # Продолжение прогона по журналу: готовые артикулы пропускаются,
+        # спарсенные, но не записанные цены дописываются без запроса к Saturn
+        resumed = []
+        if journal:
+            skus, scraped = journal.plan(skus)
+            resumed = [
+                ProductPrice(sku=entry.sku, name=entry.name, price=entry.price,
+                             availability=entry.availability, url=entry.url)
+                for entry in scraped
+            ]
+            journal.record_many((sku, PENDING, None, None, None, None, None) for sku in skus)
+        
+        # Стадия записи в Bitrix: результаты уходят в очередь, БД пишут отдельные потоки
+        price_writer = None
         if update_bitrix:
             try:
-                from bitrix_integration import BitrixClient, BitrixConfig
+                from bitrix_integration import BitrixConfig
+                from price_writer import PriceWriter
                 config = BitrixConfig(
                     mysql_host=os.getenv('BITRIX_MYSQL_HOST', '127.0.0.1'),
                     mysql_port=int(os.getenv('BITRIX_MYSQL_PORT', 3306)),
@@ -219,98 +288,91 @@ class FastSaturnParser:
                     iblock_id=int(os.getenv('BITRIX_IBLOCK_ID', 11)),
                     supplier_prefix=os.getenv('SUPPLIER_PREFIX', 'тов-')
                 )
-                bitrix_client = BitrixClient(config)
-                bitrix_client.connect()
-                self.logger.info("Подключение к Bitrix установлено для обновления цен")
+                price_writer = PriceWriter(config, workers=self.db_writers, journal=journal)
+                price_writer.start()
+                self.logger.info("Запись цен в Bitrix запущена в фоне")
             except Exception as e:
-                self.logger.warning(f"Не удалось подключиться к Bitrix: {e}")
+                self.logger.warning(f"Не удалось запустить запись в Bitrix: {e}")
                 update_bitrix = False
         
         self.logger.info(f"Начинаем быстрый парсинг {len(skus)} товаров ({self.max_workers} потоков)")
         
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_sku = {
-                executor.submit(self.parse_single_product, sku): sku 
-                for sku in skus
-            }
+        try:
+            results.extend(resumed)
+            if price_writer:
+                for result in resumed:
+                    price_writer.submit(result)
             
-            for future in as_completed(future_to_sku):
-                sku = future_to_sku[future]
-                self.processed_count += 1
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='saturn-parse') as executor:
+                future_to_sku = {
+                    executor.submit(self._traced_parse, sku): sku 
+                    for sku in skus
+                }
                 
-                try:
-                    result = future.result()
-                    if result:
-                        results.append(result)
-                        self.success_count += 1
-                        
-                        # Обновляем цену в Bitrix напрямую с применением наценки
-                        if update_bitrix and bitrix_client:
-                            try:
-                                article_with_prefix = f"тов-{sku}"
-                                product = bitrix_client.get_product_by_article(article_with_prefix)
-                                if product:
-                                    # Применяем наценку к цене
-                                    from bitrix_integration import MarkupProcessor
-                                    markup_processor = MarkupProcessor(bitrix_client)
-                                    final_price, markup_percent = markup_processor.apply_markup(product, result.price)
-                                    
-                                    # Обновляем финальную цену с наценкой
-                                    success = bitrix_client.update_product_price(product.id, final_price)
-                                    if success:
-                                        with self.log_lock:
-                                            self.logger.info(f"✅ Обновлен {sku}: {result.price} → {final_price:.2f} руб. (+{markup_percent:.1f}%)")
-                                        
-                                        # Запускаем модуль underprice для пересчета скидок
-                                        try:
-                                            bitrix_client.trigger_underprice_module(product.id)
-                                        except Exception as underprice_error:
-                                            with self.log_lock:
-                                                self.logger.warning(f"Ошибка underprice для {sku}: {underprice_error}")
-                                    else:
-                                        with self.log_lock:
-                                            self.logger.warning(f"❌ Ошибка обновления {sku} в Bitrix")
-                                else:
-                                    with self.log_lock:
-                                        self.logger.warning(f"⚠️ Товар {sku} не найден в Bitrix")
-                            except Exception as e:
+                for future in as_completed(future_to_sku):
+                    stopping = self.stop_event is not None and self.stop_event.is_set()
+                    # Запись в Bitrix остановилась - дальше парсить незачем, ошибку поднимет close()
+                    writer_failed = price_writer is not None and price_writer.failed.is_set()
+                    if stopping or writer_failed or (self.deadline is not None and time.time() >= self.deadline):
+                        cancelled = sum(f.cancel() for f in future_to_sku)
+                        reason = ("Остановка парсинга" if stopping else
+                                  "Запись в Bitrix остановлена" if writer_failed else "Срок прогона")
+                        self.logger.warning(f"{reason}: отменено задач {cancelled}")
+                        break
+                    
+                    sku = future_to_sku[future]
+                    
+                    try:
+                        result = future.result()
+                        processed = self._count(bool(result))
+                        if result:
+                            results.append(result)
+                            if journal:
+                                journal.record(sku, SCRAPED, result.price, result.name, result.availability, result.url)
+                            
+                            if price_writer:
+                                # Блокируется только при заполненной очереди записи
+                                price_writer.submit(result)
+                            else:
                                 with self.log_lock:
-                                    self.logger.error(f"Ошибка обновления {sku} в Bitrix: {e}")
+                                    self.logger.info(f"Найден {sku}: {result.price} руб.")
                         else:
+                            if journal:
+                                journal.record(sku, FAILED, error="не найден")
                             with self.log_lock:
-                                self.logger.info(f"Найден {sku}: {result.price} руб.")
-                    else:
-                        self.error_count += 1
-                        with self.log_lock:
-                            self.logger.warning(f"Не найден {sku}")
-                    
-                    if self.processed_count % 50 == 0:
-                        progress = (self.processed_count / len(skus)) * 100
-                        elapsed = time.time() - start_time
-                        rate = self.processed_count / elapsed if elapsed > 0 else 0
+                                self.logger.warning(f"Не найден {sku}")
                         
+                        if processed % 50 == 0:
+                            progress = (processed / len(skus)) * 100
+                            elapsed = time.time() - start_time
+                            rate = processed / elapsed if elapsed > 0 else 0
+                            
+                            with self.log_lock:
+                                self.logger.info(f"Прогресс: {processed}/{len(skus)} ({progress:.1f}%) - {rate:.1f} товаров/сек")
+                    
+                    except Exception as e:
+                        self._count(None)
+                        if journal:
+                            journal.record(sku, FAILED, error=str(e))
                         with self.log_lock:
-                            self.logger.info(f"Прогресс: {self.processed_count}/{len(skus)} ({progress:.1f}%) - {rate:.1f} товаров/сек")
-                
-                except Exception as e:
-                    self.error_count += 1
-                    with self.log_lock:
-                        self.logger.error(f"Ошибка обработки {sku}: {e}")
-                
-                if self.request_delay > 0:
-                    time.sleep(self.request_delay)
-        
-        # Закрываем подключение к Bitrix
-        if bitrix_client:
-            try:
-                bitrix_client.disconnect()
-                self.logger.info("Подключение к Bitrix закрыто")
-            except:
-                pass
+                            self.logger.error(f"Ошибка обработки {sku}: {e}")
+                    
+                    if self.request_delay > 0:
+                        time.sleep(self.request_delay)
+        finally:
+            # Дожидаемся записи всего, что уже в очереди
+            if price_writer:
+                price_writer.close()
         
         if output_file and results:
             self.save_results(results, output_file)
         
+        if history and results:
+            try:
+                history.record(results)
+            except Exception as e:
+                self.logger.error(f"Ошибка записи истории цен: {e}")
+        
         elapsed = time.time() - start_time
         rate = len(skus) / elapsed if elapsed > 0 else 0
         
@@ -361,6 +423,9 @@ def main():
     parser.add_argument('--workers', type=int, default=10, help='Количество потоков')
     parser.add_argument('--delay', type=float, default=0.1, help='Задержка между запросами (сек)')
     parser.add_argument('--batch-size', type=int, help='Ограничить количество товаров')
+    parser.add_argument('--db-writers', type=int, default=1, help='Количество потоков записи в Bitrix')
+    parser.add_argument('--profile', action='store_true',
+                        help='Профилировать парсинг: collapsed-стеки и таблица функций по стадиям в output/profile')
     
     args = parser.parse_args()
     
@@ -387,8 +452,11 @@ def main():
         )
         
         with BitrixClient(config) as bitrix:
-            products = bitrix.get_products_by_prefix()
-            skus = [p.article.replace(config.supplier_prefix, '') for p in products]
+            skus = [
+                row.article.replace(config.supplier_prefix, '')
+                for chunk in bitrix.iter_products_by_prefix()
+                for row in chunk
+            ]
     
     if not skus:
         print("Нет артикулов для парсинга")
@@ -397,8 +465,12 @@ def main():
     if args.batch_size:
         skus = skus[:args.batch_size]
     
-    parser = FastSaturnParser(max_workers=args.workers, request_delay=args.delay)
-    results = parser.parse_products_batch(skus, args.output, update_bitrix=True)
+    parser = FastSaturnParser(max_workers=args.workers, request_delay=args.delay, db_writers=args.db_writers)
+    if args.profile:
+        from profiler import run_profiled
+        results = run_profiled(parser.parse_products_batch, skus, args.output, update_bitrix=True)
+    else:
+        results = parser.parse_products_batch(skus, args.output, update_bitrix=True)
     
     return 0 if results else 1
 
@@ -4,6 +4,8 @@ import os
 import sys
 import time
 import json
+import itertools
+import threading
 from pathlib import Path
 from datetime import datetime
 import logging
@@ -14,17 +16,44 @@ load_dotenv()
 
 from saturn_parser import SaturnParser, ProcessLock, load_skus_from_file
 from bitrix_integration import BitrixClient, BitrixConfig, process_saturn_prices
+from metrics import REGISTRY, export_metrics
+from price_history import PriceHistory
+from refresh_scheduler import RefreshScheduler
+from run_budget import RUN_BUDGET_MAX_WORKERS, PriorityPlanner, RunBudget, load_sales_ranks, parse_deadline
+from sync_journal import SyncJournal
+from tracing import SYNC_TRACE, TRACER, finish_run_trace
 
 logger = logging.getLogger(__name__)
 
 class FullSyncManager:
     
     def __init__(self, config_file: str = None):
+        self.config_file = config_file
         self.config = self._load_config(config_file)
         self.output_dir = Path("output")
         self.output_dir.mkdir(exist_ok=True)
         self.raw_prices_file = self.output_dir / "saturn_raw_prices.csv"
         self.processed_prices_file = self.output_dir / "saturn_processed_prices.csv"
+        self.journal: Optional[SyncJournal] = None
+        self.resuming = False
+        self.history = PriceHistory()
+        self.scheduler = RefreshScheduler(self.history)
+        # Адаптивный режим: парсятся только артикулы, которым пора по расписанию
+        self.adaptive = False
+        self.nothing_due = False
+        # Срок прогона: время 'ЧЧ:ММ'/ISO и/или бюджет в минутах, срок пересчитывается на каждый прогон
+        self.deadline_at: Optional[str] = None
+        self.time_budget: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self.shed_count = 0
+        # Трассы артикулов по стадиям и отчёт о самых медленных в конце прогона
+        self.trace = SYNC_TRACE
+        self.started_at = int(time.time())
+        # Парсеры переиспользуются между прогонами демона (тёплые HTTP-сессии)
+        self._fast_parsers = {}
+        self._saturn_parser: Optional[SaturnParser] = None
+        # Остановка (SIGTERM демона): новые артикулы не выдаются, начатое дописывается
+        self.stop_event = threading.Event()
         
     def _load_config(self, config_file: str = None) -> BitrixConfig:
         if config_file and Path(config_file).exists():
@@ -44,6 +73,102 @@ class FullSyncManager:
                 underprice_password=os.getenv('SATURN_UNDERPRICE_PASSWORD')
             )
     
+    def reload_config(self):
+        """Перечитывание .env/JSON конфигурации и сброс кэшей правил и метаданных"""
+        from db_pool import close_all_pools
+        from bitrix_metadata import invalidate_metadata
+        from section_tree import invalidate_section_tree
+        from underprice_python import invalidate_rules_cache
+        
+        load_dotenv(override=True)
+        self.config = self._load_config(self.config_file)
+        close_all_pools()
+        invalidate_metadata()
+        invalidate_section_tree()
+        invalidate_rules_cache()
+        logger.info("Конфигурация перечитана, кэши правил и метаданных сброшены")
+    
+    def get_fast_parser(self, workers: int, request_delay: float):
+        from fast_saturn_parser import FastSaturnParser
+        key = (workers, request_delay)
+        if key not in self._fast_parsers:
+            parser = FastSaturnParser(max_workers=workers, request_delay=request_delay)
+            parser.stop_event = self.stop_event
+            self._fast_parsers[key] = parser
+        return self._fast_parsers[key]
+    
+    def get_saturn_parser(self) -> SaturnParser:
+        if self._saturn_parser is None:
+            self._saturn_parser = SaturnParser()
+        return self._saturn_parser
+    
+    def prioritize(self, items, key=lambda item: item) -> list:
+        """Артикулы по убыванию приоритета (изменчивость, продажи, давность проверки)"""
+        return PriorityPlanner(self.scheduler, load_sales_ranks(self.config)).order(items, key=key)
+    
+    def _until_stopped(self, items):
+        for item in items:
+            if self.stop_event.is_set():
+                logger.warning("Остановка: выдача новых артикулов прекращена")
+                return
+            yield item
+    
+    def start_run_observability(self, trace: bool = True):
+        """Начало прогона: метрики с нуля, новый файл трасс"""
+        REGISTRY.reset()
+        if self.trace and trace:
+            TRACER.start()
+    
+    def finish_run_observability(self):
+        """Конец прогона: выгрузка метрик и отчёт трассировки"""
+        export_metrics()
+        finish_run_trace()
+    
+    def run(self, mode: str, batch_size: int = None, skus_file: str = None, use_fast_parser: bool = True,
+            write_csv: bool = True, db_writers: int = 1, changes_only: bool = False, resume: bool = False) -> bool:
+        """Один прогон синхронизации в режиме full, stream, parse или process"""
+        self.start_run_observability()
+        if mode == 'process':
+            try:
+                return self.stage2_process_markups()
+            finally:
+                self.finish_run_observability()
+        
+        self.open_journal(mode, resume=resume)
+        self.deadline = parse_deadline(self.deadline_at, self.time_budget)
+        self.shed_count = 0
+        success = False
+        try:
+            if mode == 'parse':
+                success = self.stage1_parse_prices(batch_size=batch_size, use_fast_parser=use_fast_parser)
+            elif mode == 'stream':
+                success = self.run_streaming_sync(
+                    batch_size=batch_size,
+                    skus_file=skus_file,
+                    use_fast_parser=use_fast_parser,
+                    write_csv=write_csv,
+                    db_writers=db_writers,
+                    changes_only=changes_only
+                )
+            else:
+                success = self.run_full_sync(
+                    batch_size=batch_size,
+                    skus_file=skus_file,
+                    use_fast_parser=use_fast_parser
+                )
+            if self.stop_event.is_set():
+                # Прерванный прогон остаётся незавершённым и продолжится по журналу
+                logger.warning("Прогон прерван остановкой")
+                success = False
+        finally:
+            self.close_journal(success)
+            # После сбоя расписание не сдвигается: недоставленные артикулы остаются к проверке
+            if success:
+                self.update_refresh_schedule()
+            self.compact_history()
+            self.finish_run_observability()
+        return success
+    
     def get_saturn_skus(self) -> List[str]:
         logger.info("Получение списка артикулов Saturn из Bitrix...")
         bitrix_client = BitrixClient(self.config)
@@ -52,12 +177,10 @@ class FullSyncManager:
                 logger.error("Не удалось подключиться к Bitrix")
                 return []
             
-            products = bitrix_client.get_products_by_prefix()
-            
             skus = []
-            for product in products:
-                saturn_sku = product.article.replace(self.config.supplier_prefix, '')
-                skus.append(saturn_sku)
+            for chunk in bitrix_client.iter_products_by_prefix():
+                for row in chunk:
+                    skus.append(row.article.replace(self.config.supplier_prefix, ''))
             
             logger.info(f"Найдено артикулов Saturn: {len(skus)}")
             return skus
@@ -68,6 +191,43 @@ class FullSyncManager:
         finally:
             bitrix_client.disconnect()
     
+    def open_journal(self, mode: str, resume: bool = False) -> SyncJournal:
+        """Журнал прогона; при resume - продолжение последнего незавершённого"""
+        self.started_at = int(time.time())
+        self.nothing_due = False
+        self.journal = SyncJournal()
+        self.resuming = bool(resume and self.journal.resume_run(mode))
+        if not self.resuming:
+            if resume:
+                logger.info("Незавершённых прогонов в журнале нет, начинаем новый")
+            self.journal.start_run(mode)
+        return self.journal
+    
+    def close_journal(self, success: bool):
+        if self.journal:
+            self.journal.finish_run('completed' if success else 'failed')
+            self.journal.close()
+            self.journal = None
+    
+    def update_refresh_schedule(self):
+        """Расписание перепарсинга по артикулам, проверенным в этом прогоне"""
+        try:
+            self.scheduler.update_checked_since(self.started_at)
+        except Exception as e:
+            logger.error(f"Ошибка обновления расписания: {e}")
+    
+    def compact_history(self):
+        """Удаление устаревших точек истории цен (срок - PRICE_HISTORY_RETENTION_DAYS)"""
+        try:
+            self.history.compact()
+        except Exception as e:
+            logger.error(f"Ошибка очистки истории цен: {e}")
+    
+    def commit_price_changes(self, up_to: int):
+        """Изменения истории до up_to доставлены в Bitrix (для --changes-only)"""
+        from sync_pipeline import BITRIX_FEED
+        self.history.feed(BITRIX_FEED).commit(up_to)
+    
     def stage1_parse_prices(self, skus: List[str] = None, batch_size: int = None, use_fast_parser: bool = True) -> bool:
         logger.info("=== ЭТАП 1: Парсинг цен с Saturn ===")
         
@@ -78,21 +238,48 @@ class FullSyncManager:
             logger.error("Нет артикулов для парсинга")
             return False
         
+        if self.adaptive:
+            skus = self.scheduler.due(skus)
+            if not skus:
+                logger.info("Все цены свежие, парсить нечего")
+                self.nothing_due = True
+                return True
+        
+        budget = None
+        if self.deadline:
+            skus = self.prioritize(skus)
+        
         if batch_size and len(skus) > batch_size:
             logger.info(f"Ограничиваем до {batch_size} товаров")
             skus = skus[:batch_size]
         
+        if self.deadline:
+            # Запас до срока остаётся на этап 2
+            budget = RunBudget(self.deadline, len(skus))
+            logger.info(f"Прогон к сроку: {budget.describe()}")
+        
         start_time = time.time()
         
         try:
             if use_fast_parser:
-                from fast_saturn_parser import FastSaturnParser
                 workers = min(20, max(5, len(skus) // 100))
                 logger.info(f"Используем быстрый парсер с {workers} потоками")
-                fast_parser = FastSaturnParser(max_workers=workers, request_delay=0.05)
-                results = fast_parser.parse_products_batch(skus, str(self.raw_prices_file))
+                fast_parser = self.get_fast_parser(workers, 0.05)
+                fast_parser.deadline = budget.cutoff if budget else None
+                try:
+                    results = fast_parser.parse_products_batch(
+                        skus, str(self.raw_prices_file), journal=self.journal, history=self.history
+                    )
+                finally:
+                    fast_parser.deadline = None
+                if budget:
+                    self.shed_count = max(0, len(skus) - fast_parser.processed_count)
             else:
-                saturn_parser = SaturnParser()
+                if self.journal:
+                    logger.warning("Медленный парсер не ведёт журнал прогона, --resume начнёт парсинг заново")
+                if budget:
+                    logger.warning("Медленный парсер не соблюдает срок прогона, только порядок по приоритету")
+                saturn_parser = self.get_saturn_parser()
                 results = saturn_parser.parse_products(skus, str(self.raw_prices_file))
             
             elapsed = time.time() - start_time
@@ -100,7 +287,8 @@ class FullSyncManager:
             logger.info(f"Этап 1 завершен за {elapsed:.1f}с")
             logger.info(f"Спарсено товаров: {len(results)}/{len(skus)}")
             
-            return len(results) > 0
+            # При продолжении все артикулы могли быть записаны ещё в прошлом прогоне
+            return len(results) > 0 or self.resuming
             
         except Exception as e:
             logger.error(f"Ошибка парсинга: {e}")
@@ -146,10 +334,21 @@ class FullSyncManager:
                 logger.error("Ошибка на этапе парсинга")
                 return False
             
+            if self.nothing_due:
+                # CSV прошлого прогона не перезаписан - повторно его не обрабатываем
+                return True
+            
+            if self.stop_event.is_set():
+                return False
+            
             if not self.stage2_process_markups():
                 logger.error("Ошибка на этапе обработки наценок")
                 return False
             
+            # Полный прогон записал все цены - лента изменений доставлена целиком
+            if not batch_size and not skus_file and not self.shed_count:
+                self.commit_price_changes(self.history.max_id())
+            
             elapsed = time.time() - start_time
             logger.info(f"✅ Полная синхронизация завершена за {elapsed:.1f}с")
             
@@ -159,6 +358,213 @@ class FullSyncManager:
             logger.error(f"Критическая ошибка синхронизации: {e}")
             return False
     
+    def run_streaming_sync(self, batch_size: int = None, skus_file: str = None, use_fast_parser: bool = True,
+                           write_csv: bool = True, db_writers: int = 1, changes_only: bool = False) -> bool:
+        """Потоковая синхронизация: парсинг, наценка и запись в Bitrix одновременно"""
+        from sync_pipeline import SyncPipeline, iter_bitrix_skus
+        
+        logger.info("🚀 Запуск потоковой синхронизации Saturn → Bitrix")
+        
+        try:
+            if skus_file:
+                skus = load_skus_from_file(skus_file)
+                if batch_size:
+                    skus = skus[:batch_size]
+                logger.info(f"Загружено артикулов из файла: {len(skus)}")
+                items = ((sku, None) for sku in skus)
+            else:
+                items = iter_bitrix_skus(self.config, limit=None if self.adaptive else batch_size)
+            
+            if self.adaptive:
+                items = self.scheduler.iter_due(items, key=lambda item: item[0])
+                if batch_size:
+                    items = itertools.islice(items, batch_size)
+            
+            budget = None
+            if self.deadline:
+                items = self.prioritize(items, key=lambda item: item[0])
+                budget = RunBudget(self.deadline, len(items))
+                logger.info(f"Прогон к сроку: {budget.describe()}")
+            
+            items = self._until_stopped(items)
+            
+            if use_fast_parser:
+                workers = 20
+                # HTTP-пул парсера - на предельную параллельность при наращивании
+                parse_func = self.get_fast_parser(RUN_BUDGET_MAX_WORKERS if budget else workers, 0).parse_single_product
+            else:
+                workers = 1
+                parse_func = self.get_saturn_parser().parse_product
+            
+            pipeline = SyncPipeline(
+                self.config,
+                parse_func=parse_func,
+                parse_workers=workers,
+                db_writers=db_writers,
+                raw_csv=str(self.raw_prices_file) if write_csv else None,
+                processed_csv=str(self.processed_prices_file) if write_csv else None,
+                journal=self.journal,
+                history=self.history,
+                changes_only=changes_only,
+                budget=budget
+            )
+            stats = pipeline.run(items)
+            self.shed_count = stats.shed
+            
+            writer_stats = stats.writer
+            success = ((stats.parsed > 0 or self.resuming) and writer_stats.errors == 0
+                       and writer_stats.prices.failed == 0 and stats.history_errors == 0)
+            # Курсор ленты сдвигается только после полного прогона без ошибок записи,
+            # иначе недоставленные изменения уйдут в Bitrix в следующий раз
+            if success and not batch_size and not skus_file and not stats.shed:
+                self.commit_price_changes(self.history.max_id())
+            if success:
+                logger.info(f"✅ Потоковая синхронизация завершена за {stats.elapsed:.1f}с")
+            else:
+                logger.error("Потоковая синхронизация завершена с ошибками")
+            return success
+            
+        except Exception as e:
+            logger.error(f"Критическая ошибка синхронизации: {e}")
+            return False
+    
+    def run_sharded_sync(self, shards: int, run_key: str = None, node_id: str = None, lease_store: str = None,
+                         skus_file: str = None, use_fast_parser: bool = True, db_writers: int = 1,
+                         write_csv: bool = True) -> bool:
+        """Шардированный потоковый прогон: узел берёт шарды из таблицы аренд, пока они есть"""
+        from sku_sharding import (SHARD_LEASE_STORE, SHARD_LEASE_TTL, SHARD_MAX_ATTEMPTS, LeaseKeeper,
+                                  ShardRing, default_node_id, open_lease_store)
+        from sync_pipeline import SyncPipeline, iter_bitrix_skus
+        
+        run_key = run_key or datetime.now().strftime('%Y-%m-%d')
+        node_id = node_id or default_node_id()
+        store = open_lease_store(lease_store or SHARD_LEASE_STORE, self.config)
+        ring = ShardRing(shards)
+        shard_dir = self.output_dir / "shards" / run_key
+        
+        logger.info(f"🚀 Шардированная синхронизация: прогон {run_key}, шардов {shards}, узел {node_id}")
+        store.init_run(run_key, shards)
+        
+        if skus_file:
+            catalog = [(sku, None) for sku in load_skus_from_file(skus_file)]
+        else:
+            catalog = list(iter_bitrix_skus(self.config))
+        
+        if use_fast_parser:
+            workers = 20
+            parse_func = self.get_fast_parser(workers, 0).parse_single_product
+        else:
+            workers = 1
+            parse_func = self.get_saturn_parser().parse_product
+        
+        processed = failed = 0
+        self.start_run_observability()
+        # Шарды, которые этот узел не смог обработать: в этом прогоне их повторяют другие узлы
+        given_up = set()
+        try:
+            while not self.stop_event.is_set():
+                shard = store.claim(run_key, node_id, SHARD_LEASE_TTL, exclude=given_up)
+                if shard is None:
+                    break
+                
+                items = [item for item in catalog if ring.shard_of(item[0]) == shard]
+                logger.info(f"Шард {shard}: артикулов {len(items)}")
+                pipeline = SyncPipeline(
+                    self.config,
+                    parse_func=parse_func,
+                    parse_workers=workers,
+                    db_writers=db_writers,
+                    raw_csv=str(shard_dir / f"raw_{shard}.csv") if write_csv else None,
+                    processed_csv=str(shard_dir / f"processed_{shard}.csv") if write_csv else None,
+                    history=self.history
+                )
+                
+                stats = None
+                with LeaseKeeper(store, run_key, shard, node_id, SHARD_LEASE_TTL) as keeper:
+                    try:
+                        stats = pipeline.run(self._until_stopped(keeper.guard(items)))
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки шарда {shard}: {e}")
+                
+                ok = (stats is not None and not keeper.lost.is_set() and not self.stop_event.is_set()
+                      and stats.writer.errors == 0 and stats.writer.prices.failed == 0)
+                if ok and store.complete(run_key, shard, node_id, {
+                    'skus': stats.skus, 'parsed': stats.parsed, 'not_found': stats.not_found,
+                    'parse_errors': stats.parse_errors, 'written': stats.writer.prices.written,
+                    'unchanged': stats.writer.prices.unchanged, 'elapsed': round(stats.elapsed, 1),
+                }):
+                    processed += 1
+                else:
+                    failed += 1
+                    given_up.add(shard)
+                    # Остановка узла - не неудача шарда: его сразу возьмёт другой узел
+                    if self.stop_event.is_set():
+                        store.release(run_key, shard, node_id)
+                    elif not keeper.lost.is_set():
+                        store.fail(run_key, shard, node_id)
+            
+            merged = store.merged_stats(run_key)
+            logger.info(f"Узел {node_id}: обработано шардов {processed}, неудачно {failed}")
+            logger.info(f"Прогон {run_key}: готово шардов {merged['done']}/{merged['shards']}, "
+                        f"не обработано за {SHARD_MAX_ATTEMPTS} попыток {merged['failed']}; "
+                        f"спарсено {merged.get('parsed', 0)}, записано {merged.get('written', 0)}, "
+                        f"не найдено {merged.get('not_found', 0)}")
+            if merged['done'] == merged['shards'] and write_csv:
+                self.merge_shard_outputs(shard_dir, shards)
+            return failed == 0
+        finally:
+            store.close()
+            self.finish_run_observability()
+    
+    def run_multiprocess_sync(self, processes: int, rate: float = None, batch_size: int = None,
+                              skus_file: str = None, db_writers: int = 1, write_csv: bool = True) -> bool:
+        """Потоковый прогон в N процессах с общим лимитом запросов к Saturn"""
+        from process_runner import SATURN_RATE_LIMIT, ProcessRunner
+        from sync_pipeline import iter_bitrix_skus
+        
+        if skus_file:
+            items = [(sku, None) for sku in load_skus_from_file(skus_file)]
+        else:
+            items = iter_bitrix_skus(self.config)
+        if self.adaptive:
+            items = self.scheduler.iter_due(items, key=lambda item: item[0])
+        items = list(itertools.islice(items, batch_size) if batch_size else items)
+        
+        self.started_at = int(time.time())
+        self.deadline = parse_deadline(self.deadline_at, self.time_budget)
+        runner = ProcessRunner(self, processes, rate=SATURN_RATE_LIMIT if rate is None else rate,
+                               db_writers=db_writers, write_csv=write_csv, trace=self.trace)
+        # Метрики исполнителей сводятся в реестр этого процесса, трассы пишет каждый исполнитель
+        self.start_run_observability(trace=False)
+        try:
+            success = runner.run(items)
+            if success:
+                self.update_refresh_schedule()
+        finally:
+            self.compact_history()
+            self.finish_run_observability()
+        return success
+    
+    def merge_shard_outputs(self, shard_dir: Path, shards: int):
+        """Объединение CSV шардов в общие файлы (если каталог output общий для узлов)"""
+        for prefix, target in (('raw', self.raw_prices_file), ('processed', self.processed_prices_file)):
+            parts = [shard_dir / f"{prefix}_{shard}.csv" for shard in range(shards)]
+            present = [part for part in parts if part.exists()]
+            if len(present) < len(parts):
+                logger.warning(f"CSV {prefix}: найдено {len(present)} из {len(parts)} шардов "
+                               f"(каталог {shard_dir} не общий?), объединяем найденные")
+            if not present:
+                continue
+            with open(target, 'w', encoding='utf-8', newline='') as out:
+                for index, part in enumerate(present):
+                    with open(part, 'r', encoding='utf-8') as f:
+                        header = f.readline()
+                        if index == 0:
+                            out.write(header)
+                        for line in f:
+                            out.write(line)
+            logger.info(f"Объединены CSV шардов: {target}")
+    
     def cleanup_old_files(self, days: int = 7):
         logger.info(f"Очистка файлов старше {days} дней...")
         
@@ -186,6 +592,32 @@ def main():
     parser.add_argument('--cleanup', action='store_true', help='Очистка старых файлов')
     parser.add_argument('--test-mode', action='store_true', help='Тестовый режим (ограниченное количество товаров)')
     parser.add_argument('--slow-parser', action='store_true', help='Использовать медленный парсер вместо быстрого')
+    parser.add_argument('--stream', action='store_true', help='Потоковый режим: парсинг и запись в Bitrix одновременно')
+    parser.add_argument('--no-csv', action='store_true', help='Потоковый режим без записи CSV')
+    parser.add_argument('--db-writers', type=int, default=1, help='Количество потоков записи в Bitrix (потоковый режим)')
+    parser.add_argument('--resume', action='store_true', help='Продолжить последний незавершённый прогон по журналу')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Парсить только артикулы, которым пора по адаптивному расписанию')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Режим демона: синхронизация по расписанию в одном процессе')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='Демон: интервал между прогонами, мин (SYNC_DAEMON_INTERVAL_MINUTES, 60)')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Шардированный прогон на несколько узлов: число шардов')
+    parser.add_argument('--node-id', help='Шарды: идентификатор узла (по умолчанию хост-PID)')
+    parser.add_argument('--run-key', help='Шарды: ключ общего прогона (по умолчанию текущая дата)')
+    parser.add_argument('--lease-store', help="Шарды: 'mysql' или 'sqlite:путь' (SHARD_LEASE_STORE)")
+    parser.add_argument('--changes-only', action='store_true',
+                        help='Потоковый режим: писать в Bitrix только цены, изменившиеся по истории цен')
+    parser.add_argument('--deadline', help="Срок прогона: 'ЧЧ:ММ' (ближайшее) или ISO-дата/время")
+    parser.add_argument('--time-budget', type=float, default=None, help='Бюджет времени прогона, мин')
+    parser.add_argument('--no-trace', action='store_true', help='Не писать трассы артикулов (SYNC_TRACE=0)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Потоковый прогон в N процессах (по части артикулов на процесс)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Процессы: общий лимит запросов к Saturn в секунду (SATURN_RATE_LIMIT, 20; 0 - без лимита)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Профилировать прогон: collapsed-стеки и таблица функций по стадиям в output/profile')
     
     args = parser.parse_args()
     
@@ -198,7 +630,20 @@ def main():
         args.batch_size = min(args.batch_size, 10)
         logger.info("🧪 ТЕСТОВЫЙ РЕЖИМ: ограничено 10 товарами")
     
+    if args.profile:
+        from profiler import run_profiled
+        return run_profiled(run_command, args)
+    return run_command(args)
+
+
+def run_command(args) -> int:
+    """Выполнение синхронизации по аргументам командной строки"""
     lock_file = "/tmp/saturn_full_sync.lock" if os.name != 'nt' else "saturn_full_sync.lock"
+    if args.shards:
+        # Узлы шардированного прогона координируются арендами, на одной машине их может быть несколько
+        from sku_sharding import default_node_id
+        args.node_id = args.node_id or default_node_id()
+        lock_file = lock_file.replace('.lock', f".{args.node_id}.lock")
     
     try:
         with ProcessLock(lock_file):
@@ -208,20 +653,71 @@ def main():
                 sync_manager.cleanup_old_files()
             
             use_fast_parser = not args.slow_parser
+            sync_manager.adaptive = args.adaptive
+            sync_manager.deadline_at = args.deadline
+            sync_manager.time_budget = args.time_budget
+            if args.no_trace:
+                sync_manager.trace = False
             
             if args.parse_only:
-                success = sync_manager.stage1_parse_prices(
-                    batch_size=args.batch_size, 
-                    use_fast_parser=use_fast_parser
-                )
+                mode = 'parse'
             elif args.process_only:
-                success = sync_manager.stage2_process_markups()
+                mode = 'process'
+            elif args.stream:
+                mode = 'stream'
             else:
-                success = sync_manager.run_full_sync(
+                mode = 'full'
+            
+            if args.shards:
+                success = sync_manager.run_sharded_sync(
+                    args.shards,
+                    run_key=args.run_key,
+                    node_id=args.node_id,
+                    lease_store=args.lease_store,
+                    skus_file=args.skus_file,
+                    use_fast_parser=use_fast_parser,
+                    db_writers=args.db_writers,
+                    write_csv=not args.no_csv
+                )
+                return 0 if success else 1
+            
+            if args.processes:
+                success = sync_manager.run_multiprocess_sync(
+                    args.processes,
+                    rate=args.rate,
                     batch_size=args.batch_size,
                     skus_file=args.skus_file,
-                    use_fast_parser=use_fast_parser
+                    db_writers=args.db_writers,
+                    write_csv=not args.no_csv
                 )
+                return 0 if success else 1
+            
+            if args.daemon:
+                from sync_daemon import SyncDaemon
+                return SyncDaemon(
+                    sync_manager,
+                    mode=mode,
+                    interval_minutes=args.interval,
+                    run_kwargs=dict(
+                        batch_size=args.batch_size,
+                        skus_file=args.skus_file,
+                        use_fast_parser=use_fast_parser,
+                        write_csv=not args.no_csv,
+                        db_writers=args.db_writers,
+                        changes_only=args.changes_only
+                    )
+                ).run()
+            
+            success = sync_manager.run(
+                mode,
+                batch_size=args.batch_size,
+                skus_file=args.skus_file,
+                use_fast_parser=use_fast_parser,
+                write_csv=not args.no_csv,
+                db_writers=args.db_writers,
+                changes_only=args.changes_only,
+                resume=args.resume
+            )
             
             return 0 if success else 1
             
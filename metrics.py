@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Metrics - реестр метрик синхронизации
+
+Потокобезопасные счётчики, измерители и гистограммы с метками, в которые
+пишут все модули: HTTP-запросы к Saturn по типу страницы и статусу, время
+парсинга по способу, глубина очередей конвейера, время SQL-запросов,
+записанные строки и обращения к кэшам. По итогам прогона реестр
+выгружается текстовым файлом Prometheus (для textfile collector
+node_exporter, запись атомарная через временный файл) и JSON-сводкой
+с квантилями и долями попаданий в кэш.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Файл для textfile collector, например /var/lib/node_exporter/textfile_collector/saturn_sync.prom
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE')
+METRICS_SUMMARY_FILE = Path(os.getenv('METRICS_SUMMARY_FILE', Path("output") / "run_metrics.json"))
+
+METRIC_PREFIX = 'saturn_sync_'
+
+# Границы корзин гистограмм времени, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """Метрика с набором меток; значения по кортежу значений меток"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = METRIC_PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _pairs(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    def reset(self):
+        with self.lock:
+            self._values.clear()
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        samples = self.samples()
+        if not samples:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{_format_labels(pairs)} {value:g}" for name, pairs, value in samples)
+        return lines
+
+    def summary(self) -> Dict:
+        raise NotImplementedError
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], object]]:
+        """Значения для передачи из процесса-исполнителя (pickle)"""
+        with self.lock:
+            return [(key, self._copy(value)) for key, value in self._values.items()]
+
+    def merge(self, items: List[Tuple[Tuple[str, ...], object]]):
+        """Сведение снимка другого процесса в эту метрику"""
+        with self.lock:
+            for key, value in items:
+                current = self._values.get(key)
+                self._values[key] = self._copy(value) if current is None else self._combine(current, value)
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _combine(current, value):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self.lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self._pairs(key), value) for key, value in sorted(self._values.items())]
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {','.join(key): value for key, value in sorted(self._values.items())}
+
+    @staticmethod
+    def _combine(current, value):
+        return current + value
+
+
+class Gauge(Metric):
+    """Текущее значение и максимум за прогон (для глубины очередей)"""
+
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            _, peak = self._values.get(key, (0, value))
+            self._values[key] = (value, max(peak, value))
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self._pairs(key), value) for key, (value, _) in sorted(self._values.items())]
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self.lock:
+            peaks = [(self._pairs(key), peak) for key, (_, peak) in sorted(self._values.items())]
+        if peaks:
+            # Максимум - отдельное семейство, у каждого семейства свои HELP и TYPE
+            lines.append(f"# HELP {self.name}_max {self.help}, максимум за прогон")
+            lines.append(f"# TYPE {self.name}_max gauge")
+            lines.extend(f"{self.name}_max{_format_labels(pairs)} {peak:g}" for pairs, peak in peaks)
+        return lines
+
+    def summary(self) -> Dict:
+        with self.lock:
+            return {','.join(key): {'value': value, 'max': peak} for key, (value, peak) in sorted(self._values.items())}
+
+    @staticmethod
+    def _combine(current, value):
+        # Очереди у процессов свои: сводится наибольшая глубина
+        return max(current[0], value[0]), max(current[1], value[1])
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счётчики по корзинам (последняя - +Inf), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            else:
+                state[0][-1] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[Dict]:
+        """Замер блока; метки можно дополнить внутри блока через возвращённый словарь"""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        """Оценка квантиля по корзинам линейной интерполяцией (как histogram_quantile)"""
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index >= len(self.buckets):
+                    return self.buckets[-1]
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        result = []
+        for key, (counts, total_sum, count) in items:
+            pairs = self._pairs(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                result.append((self.name + '_bucket', pairs + [('le', f"{bound:g}")], cumulative))
+            result.append((self.name + '_bucket', pairs + [('le', '+Inf')], count))
+            result.append((self.name + '_sum', pairs, total_sum))
+            result.append((self.name + '_count', pairs, count))
+        return result
+
+    def summary(self) -> Dict:
+        with self.lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        return {
+            ','.join(key): {
+                'count': count,
+                'sum': round(total_sum, 3),
+                'avg': round(total_sum / count, 4) if count else 0,
+                'p50': round(self._quantile(counts, count, 0.5), 4),
+                'p95': round(self._quantile(counts, count, 0.95), 4),
+                'p99': round(self._quantile(counts, count, 0.99), 4),
+            }
+            for key, (counts, total_sum, count) in items
+        }
+
+    @staticmethod
+    def _copy(value):
+        return [[*value[0]], value[1], value[2]]
+
+    @staticmethod
+    def _combine(current, value):
+        return [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+        self.started_at = time.time()
+
+    def _register(self, cls, name: str, *args, **kwargs) -> Metric:
+        with self.lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def metrics(self) -> List[Metric]:
+        with self.lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> Dict[str, List]:
+        """Значения всех метрик для передачи в родительский процесс"""
+        with self.lock:
+            metrics = dict(self._metrics)
+        return {name: metric.snapshot() for name, metric in metrics.items()}
+
+    def merge(self, snapshot: Dict[str, List]):
+        """Сведение снимка процесса-исполнителя (метрики с тем же именем уже объявлены)"""
+        with self.lock:
+            metrics = dict(self._metrics)
+        for name, items in snapshot.items():
+            metric = metrics.get(name)
+            if metric is None:
+                logger.warning(f"Метрика {name} из снимка процесса не объявлена, пропущена")
+                continue
+            metric.merge(items)
+
+    def reset(self):
+        """Обнуление перед прогоном: выгрузка описывает один прогон (демон)"""
+        for metric in self.metrics():
+            metric.reset()
+        self.started_at = time.time()
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        lines.append(f"# TYPE {METRIC_PREFIX}last_run_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}last_run_timestamp_seconds {time.time():.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: Path):
+        """Атомарная запись: textfile collector не должен увидеть файл недописанным"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus())
+        os.replace(temp, path)
+
+    def summary(self) -> Dict:
+        result: Dict = {
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'elapsed': round(time.time() - self.started_at, 1),
+        }
+        for metric in self.metrics():
+            values = metric.summary()
+            if values:
+                result[metric.name[len(METRIC_PREFIX):]] = values
+
+        hits: Dict[str, Dict[str, float]] = {}
+        for key, value in CACHE_REQUESTS.summary().items():
+            cache, outcome = key.split(',')
+            hits.setdefault(cache, {})[outcome] = value
+        result['cache_hit_ratio'] = {
+            cache: round(counts.get('hit', 0) / sum(counts.values()), 3) for cache, counts in hits.items()
+        }
+        return result
+
+    def write_summary(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('http_request_seconds', 'Время HTTP-запроса к Saturn', ('page', 'status'))
+PARSE_SECONDS = REGISTRY.histogram('parse_seconds', 'Время парсинга артикула по способу', ('method',))
+SKUS_TOTAL = REGISTRY.counter('skus_total', 'Артикулы по итогу парсинга', ('result',))
+QUEUE_DEPTH = REGISTRY.gauge('queue_depth', 'Глубина очередей конвейера', ('queue',))
+DB_STATEMENT_SECONDS = REGISTRY.histogram('db_statement_seconds', 'Время SQL-запросов к Bitrix', ('statement',))
+ROWS_WRITTEN = REGISTRY.counter('rows_written_total', 'Строки, записанные в Bitrix', ('table', 'operation'))
+CACHE_REQUESTS = REGISTRY.counter('cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+
+
+def export_metrics(textfile: Optional[str] = METRICS_TEXTFILE, summary_file: Optional[Path] = METRICS_SUMMARY_FILE):
+    """Выгрузка метрик прогона; ошибки выгрузки не роняют синхронизацию"""
+    try:
+        if textfile:
+            REGISTRY.write_textfile(Path(textfile))
+        if summary_file:
+            REGISTRY.write_summary(Path(summary_file))
+            logger.info(f"Метрики прогона: {summary_file}")
+    except OSError as e:
+        logger.error(f"Ошибка выгрузки метрик: {e}")
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Price History - локальная история цен Saturn с лентой изменений
+
+Наблюдения парсера (цена, наличие, URL) пишутся в SQLite компактно:
+новая точка появляется только при изменении цены или наличия, цена
+хранится в копейках, URL - только когда он поменялся. Таблица latest
+держит последнюю точку по каждому артикулу, индексы по (sku, id) и ts
+отвечают на «последняя цена» и «изменилось с T». Лента изменений -
+точки по возрастанию id с курсором на каждого потребителя, так что
+запись в Bitrix и отчёты обрабатывают только изменения. compact()
+удаляет точки старше срока хранения, оставляя по артикулу последнюю
+точку до срока - от неё считается прежняя цена первого изменения.
+"""
+
+import os
+import sys
+import sqlite3
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FILE = Path(os.getenv('PRICE_HISTORY_FILE', Path("cache") / "price_history.db"))
+# Сколько ждать блокировку файла, который пишут несколько процессов (--processes), сек
+BUSY_TIMEOUT = float(os.getenv('PRICE_HISTORY_BUSY_TIMEOUT', 60))
+# Точки старше этого срока удаляются при compact() (0 - хранить всю историю), дней
+RETENTION_DAYS = float(os.getenv('PRICE_HISTORY_RETENTION_DAYS', 180))
+
+QUERY_CHUNK_SIZE = 500
+FEED_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS price_points (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sku TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    price INTEGER,
+    availability TEXT,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_points_sku ON price_points (sku, id);
+CREATE INDEX IF NOT EXISTS ix_points_ts ON price_points (ts);
+CREATE TABLE IF NOT EXISTS latest (
+    sku TEXT PRIMARY KEY,
+    point_id INTEGER NOT NULL,
+    price INTEGER,
+    availability TEXT,
+    url TEXT,
+    changed_at INTEGER NOT NULL,
+    checked_at INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feed_cursors (
+    consumer TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+"""
+
+
+class PricePoint(NamedTuple):
+    sku: str
+    price: Optional[float]
+    availability: Optional[str]
+    url: Optional[str]
+    ts: int
+    id: int
+
+
+class PriceChange(NamedTuple):
+    """Изменение цены: точка истории и предыдущая цена (None для нового артикула)"""
+    id: int
+    sku: str
+    ts: int
+    old_price: Optional[float]
+    price: Optional[float]
+    availability: Optional[str]
+
+
+def _to_kopecks(price: Optional[float]) -> Optional[int]:
+    return None if price is None else int(round(float(price) * 100))
+
+
+def _to_rubles(kopecks: Optional[int]) -> Optional[float]:
+    return None if kopecks is None else kopecks / 100
+
+
+class PriceHistory:
+    """Хранилище истории цен по артикулам"""
+
+    def __init__(self, path: Path = DEFAULT_HISTORY_FILE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(self, results: Iterable, ts: Optional[int] = None) -> Dict[str, int]:
+        """Запись наблюдений (объекты с sku, price, availability, url)
+
+        Возвращает ID последней точки каждого артикула: новая точка, если
+        цена или наличие изменились, иначе прежняя.
+        """
+        ts = int(ts if ts is not None else time.time())
+        observations = {result.sku: result for result in results}
+        if not observations:
+            return {}
+
+        with self.lock:
+            latest = self._latest_rows(list(observations))
+            point_ids: Dict[str, int] = {}
+            changed = 0
+            try:
+                for sku, result in observations.items():
+                    price = _to_kopecks(result.price)
+                    availability = getattr(result, 'availability', None)
+                    url = getattr(result, 'url', None)
+                    previous = latest.get(sku)
+
+                    if previous and previous[1] == price and previous[2] == availability:
+                        point_ids[sku] = previous[0]
+                        self.connection.execute(
+                            "UPDATE latest SET checked_at = ?, url = ? WHERE sku = ?", (ts, url, sku)
+                        )
+                        continue
+
+                    # URL в точке только при смене - остальное восстанавливается из предыдущих
+                    point_url = url if not previous or previous[3] != url else None
+                    cursor = self.connection.execute(
+                        "INSERT INTO price_points (sku, ts, price, availability, url) VALUES (?, ?, ?, ?, ?)",
+                        (sku, ts, price, availability, point_url)
+                    )
+                    point_ids[sku] = cursor.lastrowid
+                    changed += 1
+                    self.connection.execute("""
+                    INSERT OR REPLACE INTO latest (sku, point_id, price, availability, url, changed_at, checked_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (sku, cursor.lastrowid, price, availability, url, ts, ts))
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+
+        logger.debug(f"История цен: наблюдений {len(observations)}, изменений {changed}")
+        return point_ids
+
+    def _latest_rows(self, skus: List[str]) -> Dict[str, tuple]:
+        rows = {}
+        for i in range(0, len(skus), QUERY_CHUNK_SIZE):
+            chunk = skus[i:i + QUERY_CHUNK_SIZE]
+            for row in self.connection.execute(f"""
+            SELECT sku, point_id, price, availability, url FROM latest
+            WHERE sku IN ({', '.join(['?'] * len(chunk))})
+            """, chunk):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def latest(self, skus: Iterable[str]) -> Dict[str, PricePoint]:
+        """Последняя цена по артикулам"""
+        result = {}
+        skus = list(skus)
+        with self.lock:
+            for i in range(0, len(skus), QUERY_CHUNK_SIZE):
+                chunk = skus[i:i + QUERY_CHUNK_SIZE]
+                for sku, point_id, price, availability, url, changed_at in self.connection.execute(f"""
+                SELECT sku, point_id, price, availability, url, changed_at FROM latest
+                WHERE sku IN ({', '.join(['?'] * len(chunk))})
+                """, chunk):
+                    result[sku] = PricePoint(sku, _to_rubles(price), availability, url, changed_at, point_id)
+        return result
+
+    def history(self, sku: str, since: Optional[int] = None) -> List[PricePoint]:
+        """Все точки артикула по времени (URL протянут из предыдущих точек)"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, ts, price, availability, url FROM price_points WHERE sku = ? ORDER BY id", (sku,)
+            ).fetchall()
+
+        points, url = [], None
+        for point_id, ts, price, availability, point_url in rows:
+            url = point_url or url
+            if since is None or ts >= since:
+                points.append(PricePoint(sku, _to_rubles(price), availability, url, ts, point_id))
+        return points
+
+    def compact(self, retention_days: float = RETENTION_DAYS, now: Optional[int] = None) -> int:
+        """Удаление точек старше retention_days, возвращает число удалённых
+
+        По каждому артикулу остаётся последняя точка до срока: это либо
+        точка из latest, либо база для old_price первого изменения в сроке.
+        URL, протянутый из удаляемых точек, переносится в оставшуюся.
+        Недоставленные в ленту изменения старше срока тоже удаляются.
+        """
+        if retention_days <= 0:
+            return 0
+        cutoff = int((now if now is not None else time.time()) - retention_days * 86400)
+        keep = "SELECT MAX(id) FROM price_points WHERE ts < ? GROUP BY sku"
+        with self.lock:
+            try:
+                self.connection.execute(f"""
+                UPDATE price_points SET url = (
+                    SELECT prev.url FROM price_points prev
+                    WHERE prev.sku = price_points.sku AND prev.id < price_points.id AND prev.url IS NOT NULL
+                    ORDER BY prev.id DESC LIMIT 1
+                )
+                WHERE url IS NULL AND id IN ({keep})
+                """, (cutoff,))
+                deleted = self.connection.execute(
+                    f"DELETE FROM price_points WHERE ts < ? AND id NOT IN ({keep})", (cutoff, cutoff)
+                ).rowcount
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+        if deleted:
+            logger.info(f"История цен: удалено точек старше {retention_days:g} дн.: {deleted}")
+        return deleted
+
+    def max_id(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM price_points").fetchone()[0]
+
+    def iter_changes(self, after_id: int = 0, since: Optional[int] = None,
+                     page_size: int = FEED_PAGE_SIZE) -> Iterator[PriceChange]:
+        """Изменения по возрастанию id (после after_id и/или с момента since)"""
+        condition, params = "p.id > ?", [after_id]
+        if since is not None:
+            condition += " AND p.ts >= ?"
+            params.append(since)
+
+        last_id = after_id
+        while True:
+            with self.lock:
+                params[0] = last_id
+                rows = self.connection.execute(f"""
+                SELECT p.id, p.sku, p.ts, (
+                    SELECT prev.price FROM price_points prev
+                    WHERE prev.sku = p.sku AND prev.id < p.id ORDER BY prev.id DESC LIMIT 1
+                ), p.price, p.availability
+                FROM price_points p
+                WHERE {condition}
+                ORDER BY p.id
+                LIMIT ?
+                """, [*params, page_size]).fetchall()
+
+            for point_id, sku, ts, old_price, price, availability in rows:
+                yield PriceChange(point_id, sku, ts, _to_rubles(old_price), _to_rubles(price), availability)
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+
+    def changed_since(self, since: int) -> Iterator[PriceChange]:
+        return self.iter_changes(since=since)
+
+    def feed(self, consumer: str) -> 'ChangeFeed':
+        return ChangeFeed(self, consumer)
+
+
+class ChangeFeed:
+    """Лента изменений для потребителя: курсор сдвигается только явным commit()"""
+
+    def __init__(self, history: PriceHistory, consumer: str):
+        self.history = history
+        self.consumer = consumer
+
+    @property
+    def cursor(self) -> int:
+        with self.history.lock:
+            row = self.history.connection.execute(
+                "SELECT last_id FROM feed_cursors WHERE consumer = ?", (self.consumer,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def __iter__(self) -> Iterator[PriceChange]:
+        return self.history.iter_changes(after_id=self.cursor)
+
+    def is_delivered(self, point_id: int) -> bool:
+        return point_id <= self.cursor
+
+    def commit(self, last_id: int):
+        with self.history.lock:
+            self.history.connection.execute(
+                "INSERT OR REPLACE INTO feed_cursors (consumer, last_id) VALUES (?, ?)", (self.consumer, last_id)
+            )
+            self.history.connection.commit()
+        logger.info(f"Лента изменений '{self.consumer}': обработано до #{last_id}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='История цен Saturn')
+    parser.add_argument('--db', default=str(DEFAULT_HISTORY_FILE), help='Файл истории цен')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    latest_parser = subparsers.add_parser('latest', help='Последние цены артикулов')
+    latest_parser.add_argument('skus', nargs='+')
+
+    history_parser = subparsers.add_parser('history', help='История цены артикула')
+    history_parser.add_argument('sku')
+
+    changes_parser = subparsers.add_parser('changes', help='Изменения с момента времени')
+    changes_parser.add_argument('--since', required=True, help='Дата/время ISO, например 2024-05-01T00:00')
+
+    feed_parser = subparsers.add_parser('feed', help='Необработанные изменения потребителя')
+    feed_parser.add_argument('consumer')
+    feed_parser.add_argument('--commit', action='store_true', help='Отметить выведенные изменения обработанными')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with PriceHistory(Path(args.db)) as history:
+        if args.command == 'latest':
+            for sku, point in sorted(history.latest(args.skus).items()):
+                print(f"{sku};{point.price};{point.availability};{datetime.fromtimestamp(point.ts).isoformat()}")
+        elif args.command == 'history':
+            for point in history.history(args.sku):
+                print(f"{datetime.fromtimestamp(point.ts).isoformat()};{point.price};{point.availability};{point.url}")
+        else:
+            if args.command == 'changes':
+                changes = history.changed_since(int(datetime.fromisoformat(args.since).timestamp()))
+            else:
+                feed = history.feed(args.consumer)
+                changes = iter(feed)
+
+            last_id = None
+            for change in changes:
+                last_id = change.id
+                print(f"{datetime.fromtimestamp(change.ts).isoformat()};{change.sku};"
+                      f"{change.old_price};{change.price};{change.availability}")
+
+            if args.command == 'feed' and args.commit and last_id is not None:
+                feed.commit(last_id)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Price Matrix - матрица цен в памяти для правил underprice
+
+Цены нужных групп и закупочная цена целевых товаров загружаются в
+колонки (array('d'), NaN - цены нет), выровненные по списку ID товаров.
+Правила применяются проходом по колонкам в порядке SORT, затем в БД
+пачками пишутся только изменившиеся ячейки: UPDATE ... CASE на пачку
+строк и многострочный INSERT для новых цен.
+"""
+
+import math
+import logging
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MISSING = float('nan')
+
+# Колонка закупочной цены (b_catalog_product.PURCHASING_PRICE)
+PURCHASING_COLUMN = 0
+
+LOAD_CHUNK_SIZE = 5000
+WRITE_CHUNK_SIZE = 1000
+
+
+class PriceMatrix:
+    """Колонки цен по группам, выровненные по ID товаров"""
+
+    def __init__(self):
+        self.product_ids = array('q')
+        self.iblock_ids = array('q')
+        self.section_ids = array('q')
+        self.index: Dict[int, int] = {}
+        self.columns: Dict[int, array] = {}
+        self.original: Dict[int, array] = {}
+        self._scopes: Dict[Tuple[int, Optional[int]], List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def add_product(self, product_id: int, iblock_id: int, section_id: Optional[int],
+                    purchasing_price: Optional[float]):
+        self.index[product_id] = len(self.product_ids)
+        self.product_ids.append(product_id)
+        self.iblock_ids.append(iblock_id)
+        self.section_ids.append(section_id or 0)
+        self._column(PURCHASING_COLUMN).append(MISSING if purchasing_price is None else purchasing_price)
+
+    def _column(self, group_id: int) -> array:
+        if group_id not in self.columns:
+            self.columns[group_id] = array('d', [MISSING]) * len(self.product_ids)
+        return self.columns[group_id]
+
+    def ensure_groups(self, group_ids: Iterable[int]):
+        for group_id in group_ids:
+            self._column(group_id)
+
+    def snapshot(self):
+        """Запоминает загруженные значения для последующего поиска изменений"""
+        self.original = {group_id: array('d', column) for group_id, column in self.columns.items()}
+
+    @classmethod
+    def load(cls, connection, iblock_ids: Iterable[int], group_ids: Iterable[int],
+             product_ids: Optional[Iterable[int]] = None,
+             chunk_size: int = LOAD_CHUNK_SIZE,
+             id_range: Optional[Tuple[int, int]] = None) -> 'PriceMatrix':
+        """Загрузка товаров инфоблоков и их цен (keyset-пагинация по ID)
+        
+        id_range ограничивает загрузку диапазоном ID (партицией).
+        """
+        matrix = cls()
+        iblock_ids = sorted(set(iblock_ids))
+        group_ids = sorted(set(g for g in group_ids if g != PURCHASING_COLUMN))
+        matrix.ensure_groups([PURCHASING_COLUMN])
+
+        if not iblock_ids:
+            matrix.snapshot()
+            return matrix
+
+        iblock_placeholders = ', '.join(['%s'] * len(iblock_ids))
+        query = f"""
+        SELECT e.ID, e.IBLOCK_ID, e.IBLOCK_SECTION_ID, cat.PURCHASING_PRICE
+        FROM b_iblock_element e
+        JOIN b_catalog_product cat ON cat.ID = e.ID AND cat.PURCHASING_PRICE IS NOT NULL
+        WHERE e.ACTIVE = 'Y' AND e.IBLOCK_ID IN ({iblock_placeholders}) AND e.ID > %s{{extra}}
+        ORDER BY e.ID
+        LIMIT %s
+        """
+
+        cursor = connection.cursor()
+        try:
+            if product_ids is not None:
+                ids = sorted(set(product_ids))
+                for i in range(0, len(ids), chunk_size):
+                    window = ids[i:i + chunk_size]
+                    extra = f" AND e.ID IN ({', '.join(['%s'] * len(window))})"
+                    cursor.execute(query.format(extra=extra), [*iblock_ids, 0, *window, chunk_size])
+                    for row in cursor.fetchall():
+                        matrix.add_product(row[0], row[1], row[2], _to_float(row[3]))
+            else:
+                last_id, extra, extra_params = 0, '', []
+                if id_range:
+                    last_id, extra, extra_params = id_range[0] - 1, " AND e.ID <= %s", [id_range[1]]
+                while True:
+                    cursor.execute(query.format(extra=extra), [*iblock_ids, last_id, *extra_params, chunk_size])
+                    rows = cursor.fetchall()
+                    for row in rows:
+                        matrix.add_product(row[0], row[1], row[2], _to_float(row[3]))
+                    if len(rows) < chunk_size:
+                        break
+                    last_id = rows[-1][0]
+
+            matrix._load_prices(cursor, group_ids, chunk_size)
+        finally:
+            cursor.close()
+
+        matrix.snapshot()
+        logger.info(f"Матрица цен: товаров {len(matrix)}, колонок {len(matrix.columns)}")
+        return matrix
+
+    @classmethod
+    def from_products(cls, connection, products: Iterable[Tuple[int, int, Optional[int], Optional[float]]],
+                      group_ids: Iterable[int]) -> 'PriceMatrix':
+        """Матрица для уже выбранной пачки товаров (ID, инфоблок, раздел, закупочная цена)"""
+        matrix = cls()
+        matrix.ensure_groups([PURCHASING_COLUMN])
+        for product_id, iblock_id, section_id, purchasing_price in products:
+            matrix.add_product(product_id, iblock_id, section_id, purchasing_price)
+
+        cursor = connection.cursor()
+        try:
+            matrix._load_prices(cursor, sorted(set(g for g in group_ids if g != PURCHASING_COLUMN)), LOAD_CHUNK_SIZE)
+        finally:
+            cursor.close()
+
+        matrix.snapshot()
+        return matrix
+
+    def _load_prices(self, cursor, group_ids: List[int], chunk_size: int):
+        self.ensure_groups(group_ids)
+        if not group_ids or not len(self):
+            return
+
+        group_placeholders = ', '.join(['%s'] * len(group_ids))
+        for i in range(0, len(self), chunk_size):
+            window = list(self.product_ids[i:i + chunk_size])
+            cursor.execute(f"""
+            SELECT PRODUCT_ID, CATALOG_GROUP_ID, PRICE FROM b_catalog_price
+            WHERE CATALOG_GROUP_ID IN ({group_placeholders})
+            AND PRODUCT_ID IN ({', '.join(['%s'] * len(window))})
+            ORDER BY ID
+            """, [*group_ids, *window])
+            for product_id, group_id, price in cursor.fetchall():
+                column = self.columns[group_id]
+                position = self.index[product_id]
+                # При нескольких строках одной группы берём первую
+                if math.isnan(column[position]):
+                    column[position] = float(price)
+
+    def scope(self, iblock_id: int, section_id: Optional[int] = None, section_tree=None) -> List[int]:
+        """Позиции товаров в инфоблоке/разделе правила (кэшируются)
+
+        С деревом разделов (SectionTree) в охват входят и подразделы.
+        """
+        key = (iblock_id, section_id or None)
+        if key not in self._scopes:
+            iblocks, sections = self.iblock_ids, self.section_ids
+            if section_id and section_tree is not None:
+                covered = set(section_tree.subtree_ids(section_id))
+                positions = [i for i in range(len(iblocks)) if iblocks[i] == iblock_id and sections[i] in covered]
+            elif section_id:
+                positions = [i for i in range(len(iblocks)) if iblocks[i] == iblock_id and sections[i] == section_id]
+            else:
+                positions = [i for i in range(len(iblocks)) if iblocks[i] == iblock_id]
+            self._scopes[key] = positions
+        return self._scopes[key]
+
+    def apply_rule(self, from_group: int, to_group: int, percent: float, positions: List[int]) -> int:
+        """Колонка to_group = from_group * (1 + percent/100) для положительных цен"""
+        source = self.columns[from_group]
+        target = self._column(to_group)
+        factor = percent / 100
+        applied = 0
+        for i in positions:
+            value = source[i]
+            # NaN > 0 ложно - товары без исходной цены пропускаются
+            if value > 0:
+                new_value = value + value * factor
+                if new_value > 0:
+                    target[i] = new_value
+                    applied += 1
+        return applied
+
+    def changed_cells(self, tolerance: float = 0.005) -> Iterator[Tuple[int, int, float, bool]]:
+        """(ID товара, группа, новая цена, новая ли строка) для изменившихся ячеек"""
+        for group_id, column in self.columns.items():
+            original = self.original.get(group_id)
+            for i, value in enumerate(column):
+                if math.isnan(value):
+                    continue
+                old_value = original[i] if original is not None else MISSING
+                if math.isnan(old_value):
+                    yield self.product_ids[i], group_id, value, True
+                elif abs(value - old_value) > tolerance:
+                    yield self.product_ids[i], group_id, value, False
+
+    def write_back(self, connection, tolerance: float = 0.005) -> Tuple[int, int]:
+        """Запись изменившихся ячеек пачками; возвращает (обновлено, добавлено)"""
+        price_updates, price_inserts, purchasing_updates = [], [], []
+        for product_id, group_id, value, is_new in self.changed_cells(tolerance):
+            value = round(value, 2)
+            if group_id == PURCHASING_COLUMN:
+                purchasing_updates.append((value, product_id))
+            elif is_new:
+                price_inserts.append((product_id, group_id, value))
+            else:
+                price_updates.append((value, product_id, group_id))
+
+        cursor = connection.cursor()
+        try:
+            updates_by_group: Dict[int, List[Tuple[int, float]]] = {}
+            for value, product_id, group_id in price_updates:
+                updates_by_group.setdefault(group_id, []).append((product_id, value))
+            
+            for group_id, rows in updates_by_group.items():
+                for i in range(0, len(rows), WRITE_CHUNK_SIZE):
+                    chunk = rows[i:i + WRITE_CHUNK_SIZE]
+                    case_sql, params = _case_update(chunk)
+                    cursor.execute(f"""
+                    UPDATE b_catalog_price
+                    SET PRICE = CASE PRODUCT_ID {case_sql} END, TIMESTAMP_X = NOW()
+                    WHERE CATALOG_GROUP_ID = %s AND PRODUCT_ID IN ({', '.join(['%s'] * len(chunk))})
+                    """, params + [group_id] + [product_id for product_id, _ in chunk])
+            
+            for i in range(0, len(price_inserts), WRITE_CHUNK_SIZE):
+                cursor.executemany("""
+                INSERT INTO b_catalog_price
+                (PRODUCT_ID, CATALOG_GROUP_ID, PRICE, CURRENCY, TIMESTAMP_X)
+                VALUES (%s, %s, %s, 'RUB', NOW())
+                """, price_inserts[i:i + WRITE_CHUNK_SIZE])
+            
+            purchasing_rows = [(product_id, value) for value, product_id in purchasing_updates]
+            for i in range(0, len(purchasing_rows), WRITE_CHUNK_SIZE):
+                chunk = purchasing_rows[i:i + WRITE_CHUNK_SIZE]
+                case_sql, params = _case_update(chunk)
+                cursor.execute(f"""
+                UPDATE b_catalog_product
+                SET PURCHASING_PRICE = CASE ID {case_sql} END, TIMESTAMP_X = NOW()
+                WHERE ID IN ({', '.join(['%s'] * len(chunk))})
+                """, params + [product_id for product_id, _ in chunk])
+        finally:
+            cursor.close()
+
+        self.snapshot()
+        return len(price_updates) + len(purchasing_updates), len(price_inserts)
+
+
+def _case_update(rows: List[Tuple[int, float]]) -> Tuple[str, List]:
+    """WHEN-ветки CASE для обновления пачки строк одним UPDATE"""
+    params = []
+    for key, value in rows:
+        params.extend((key, value))
+    return ' '.join(['WHEN %s THEN %s'] * len(rows)), params
+
+
+def _to_float(value) -> Optional[float]:
+    return float(value) if value is not None else None
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Price Writer - отложенная запись цен в Bitrix отдельными потоками
+
+Парсеры кладут результаты в ограниченную очередь и сразу возвращаются
+к сбору страниц, потоки записи забирают их пачками, применяют наценку
+и пишут цены в БД. Результаты с уже применённой наценкой (MarkedUpPrice)
+пишутся без повторного поиска товара. Заполненная очередь блокирует submit (backpressure),
+close() дожидается записи всего, что уже попало в очередь. Поток записи, не
+сумевший подключиться к Bitrix, останавливает стадию: submit и close
+поднимают ошибку, а не копят в очереди то, что некому записать.
+"""
+
+import queue
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional
+
+from bitrix_integration import BitrixClient, BitrixConfig, MarkupProcessor, PriceWriteStats
+from metrics import QUEUE_DEPTH
+from sync_journal import FAILED, NOT_IN_BITRIX, WRITTEN, SyncJournal
+from tracing import TRACER
+from underprice_python import UnderpriceDebouncer
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Как часто ожидающий место в очереди проверяет, не остановились ли потоки записи
+PUT_TIMEOUT = 1.0
+
+
+class MarkedUpPrice(NamedTuple):
+    """Цена с уже применённой наценкой для известного товара Bitrix"""
+    product_id: int
+    sku: str
+    price: float
+
+
+@dataclass
+class PriceWriterStats:
+    submitted: int = 0
+    not_found: int = 0
+    errors: int = 0
+    batches: int = 0
+    prices: PriceWriteStats = field(default_factory=PriceWriteStats)
+    # time.monotonic() первой записанной в БД цены
+    first_written_at: Optional[float] = None
+
+    def __str__(self) -> str:
+        return (f"получено {self.submitted}, пачек {self.batches}, "
+                f"не найдено в Bitrix {self.not_found}, ошибок {self.errors}; цены: {self.prices}")
+
+
+class PriceWriter:
+    """Стадия записи цен: ограниченная очередь + пул потоков-писателей"""
+
+    def __init__(self, config: BitrixConfig, workers: int = 1, queue_size: int = 1000,
+                 batch_size: int = 200, flush_interval: float = 1.0,
+                 trigger_underprice: bool = True, underprice_per_batch: bool = False,
+                 underprice_min_interval: float = 30.0, journal: Optional[SyncJournal] = None):
+        self.config = config
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.underprice_per_batch = underprice_per_batch
+        self.underprice = UnderpriceDebouncer(underprice_min_interval) if trigger_underprice else None
+        # Журнал прогона: written/failed по каждому записанному артикулу. При
+        # ошибке записи артикулы остаются scraped и допишутся при --resume
+        self.journal = journal
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = PriceWriterStats()
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+        self.started = False
+        # Поток записи не смог подключиться к Bitrix - стадия записи остановлена
+        self.failed = threading.Event()
+        self.error: Optional[BaseException] = None
+        # Товары, ждущие пересчёта underprice -> артикул (для трассировки)
+        self._traced_products: Dict[int, str] = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self.started:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"price-writer-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.started = True
+        logger.info(f"Запущено потоков записи цен: {self.workers}")
+
+    def submit(self, result, timeout: Optional[float] = None):
+        """Постановка результата парсинга в очередь (блокируется при заполненной очереди)"""
+        if not self.started:
+            raise RuntimeError("PriceWriter не запущен")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._raise_if_failed()
+            wait = PUT_TIMEOUT if deadline is None else min(PUT_TIMEOUT, deadline - time.monotonic())
+            try:
+                self.queue.put(result, timeout=max(0.0, wait))
+                break
+            except queue.Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+        QUEUE_DEPTH.set(self.queue.qsize(), queue='price_writer')
+        with self.lock:
+            self.stats.submitted += 1
+
+    def close(self) -> PriceWriterStats:
+        """Дожидается записи всех поставленных результатов и останавливает потоки"""
+        if not self.started:
+            return self.stats
+        for _ in self.threads:
+            # Остановившиеся потоки очередь не разбирают - ждём места, пока есть живые
+            while any(thread.is_alive() for thread in self.threads):
+                try:
+                    self.queue.put(_STOP, timeout=PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.started = False
+
+        # Записанное исправными потоками пересчитывается и при ошибке стадии
+        if self.underprice and self.underprice.pending:
+            logger.info(f"Запускаем пересчет скидок для {len(self.underprice.pending)} товаров...")
+            self._flush_underprice()
+        logger.info(f"Запись цен завершена: {self.stats}")
+        self._raise_if_failed()
+        return self.stats
+
+    def _raise_if_failed(self):
+        if self.failed.is_set():
+            raise RuntimeError(f"Стадия записи цен остановилась с ошибкой: {self.error}") from self.error
+
+    def _run(self):
+        client = BitrixClient(self.config)
+        if not client.connect():
+            logger.error("Поток записи цен не смог подключиться к Bitrix, запись остановлена")
+            self.error = RuntimeError("Поток записи цен не смог подключиться к Bitrix")
+            self.failed.set()
+            return
+
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if not batch else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    self._flush(client, batch)
+                    batch = []
+                    continue
+
+                if item is _STOP:
+                    self._flush(client, batch)
+                    break
+
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._flush(client, batch)
+                    batch = []
+        finally:
+            client.disconnect()
+
+    def _flush(self, client: BitrixClient, batch: List):
+        if not batch:
+            return
+
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            new_prices = {}
+            product_skus = {}
+            not_found = 0
+            journal_events = []
+
+            # Цены из конвейера синхронизации уже с наценкой - только запись
+            raw_results = []
+            for item in batch:
+                if isinstance(item, MarkedUpPrice):
+                    new_prices[item.product_id] = item.price
+                    product_skus[item.product_id] = item.sku
+                else:
+                    raw_results.append(item)
+
+            prefix = self.config.supplier_prefix
+            products = {}
+            if raw_results:
+                products = client.get_products_by_articles([f"{prefix}{result.sku}" for result in raw_results])
+            markup_processor = MarkupProcessor(client)
+
+            for result in raw_results:
+                product = products.get(f"{prefix}{result.sku}")
+                if not product:
+                    not_found += 1
+                    journal_events.append((result.sku, FAILED, result.price, None, None, None, NOT_IN_BITRIX))
+                    logger.warning(f"⚠️ Товар {result.sku} не найден в Bitrix")
+                    continue
+
+                with TRACER.span('markup', sku=result.sku):
+                    final_price, markup_percent = markup_processor.apply_markup(product, result.price)
+                new_prices[product.id] = final_price
+                product_skus[product.id] = result.sku
+                logger.info(f"✅ {result.sku}: {result.price} → {final_price:.2f} руб. ({markup_percent:+.1f}%)")
+
+            write_stats = client.write_prices(new_prices)
+            TRACER.record((item.sku for item in batch), 'write', start, time.perf_counter() - started,
+                          batch=len(batch))
+
+            with self.lock:
+                if write_stats.written and self.stats.first_written_at is None:
+                    self.stats.first_written_at = time.monotonic()
+                self.stats.batches += 1
+                self.stats.not_found += not_found
+                self.stats.prices.merge(write_stats)
+
+            if self.journal:
+                # Артикулы с неудавшейся записью остаются scraped и допишутся при --resume
+                skipped = {event[0] for event in journal_events}
+                skipped.update(product_skus[product_id] for product_id in write_stats.failed_ids)
+                journal_events.extend(
+                    (item.sku, WRITTEN, item.price, None, None, None, None)
+                    for item in batch if item.sku not in skipped
+                )
+                self.journal.record_many(journal_events)
+
+            # Пересчёт скидок underprice откладывается: товары копятся до конца
+            # синхронизации (или пачки, если underprice_per_batch)
+            if self.underprice and write_stats.written_ids:
+                if TRACER.enabled:
+                    with self.lock:
+                        self._traced_products.update(
+                            (product_id, product_skus[product_id]) for product_id in write_stats.written_ids
+                        )
+                self.underprice.add(write_stats.written_ids)
+                if self.underprice_per_batch:
+                    self._flush_underprice(force=False)
+
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки цен ({len(batch)} шт.): {e}")
+            with self.lock:
+                self.stats.errors += len(batch)
+
+    def _flush_underprice(self, force: bool = True):
+        """Пересчёт underprice с интервалом в трассах пересчитанных артикулов"""
+        with self.lock:
+            traced, self._traced_products = self._traced_products, {}
+        start = time.time()
+        started = time.perf_counter()
+        if self.underprice.flush(force=force):
+            TRACER.record(traced.values(), 'underprice', start, time.perf_counter() - started, products=len(traced))
+        else:
+            # Пересчёт отложен или не удался - товары остались в очереди debouncer
+            with self.lock:
+                self._traced_products.update(traced)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Process Runner - синхронизация несколькими процессами на одной машине
+
+Родительский процесс делит артикулы на непересекающиеся части
+(консистентный хеш, как у шардов) и запускает по процессу на часть.
+Каждый процесс - полноценный потоковый конвейер со своей HTTP-сессией,
+своими соединениями MySQL и своим GIL. Родитель выдаёт разрешения на
+HTTP-запросы через общий семафор (единый лимит запросов к Saturn на всю
+машину), собирает прогресс, итоги и снимки метрик через очередь и
+объединяет CSV частей в общий файл. Трассы каждый исполнитель пишет
+в свой файл рядом с CSV частей.
+"""
+
+import os
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+
+from metrics import REGISTRY
+from sku_sharding import ShardRing
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит запросов к Saturn в секунду на все процессы (0 - без лимита)
+SATURN_RATE_LIMIT = float(os.getenv('SATURN_RATE_LIMIT', 20))
+PROCESS_WORKER_THREADS = int(os.getenv('PROCESS_WORKER_THREADS', 10))
+PROGRESS_INTERVAL = 5.0
+# После остановки (сигнал или срок прогона) исполнителю даётся столько на дописывание
+# начатого, затем процесс завершается принудительно, сек
+PROCESS_STOP_GRACE = float(os.getenv('PROCESS_STOP_GRACE_SECONDS', 120))
+# Сколько ждать выхода процесса, уже отчитавшегося об итоге, сек
+PROCESS_EXIT_TIMEOUT = 30.0
+
+_RATE_TICK = 0.02
+
+
+class GlobalRateLimiter:
+    """Токен-бакет родителя: поток пополняет общий для процессов семафор"""
+
+    def __init__(self, context, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.semaphore = context.BoundedSemaphore(self.burst)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rate-limiter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        tokens = 0.0
+        last = time.monotonic()
+        while not self._stop.wait(_RATE_TICK):
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            last = now
+            while tokens >= 1:
+                tokens -= 1
+                try:
+                    self.semaphore.release()
+                except ValueError:
+                    # Семафор полон - разрешения не копятся сверх burst
+                    tokens = 0
+                    break
+
+
+def _iter_until(items, stop_event):
+    for item in items:
+        if stop_event.is_set():
+            return
+        yield item
+
+
+def _worker_main(index: int, items: List[Tuple], config, options: Dict, results_queue, semaphore, stop_event):
+    """Процесс-исполнитель: конвейер синхронизации по своей части артикулов"""
+    # Ctrl-C обрабатывает родитель и останавливает исполнителей через stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s')
+
+    from fast_saturn_parser import FastSaturnParser
+    from price_history import PriceHistory
+    from sync_pipeline import SyncPipeline
+    from tracing import TRACER, finish_run_trace
+
+    parser = FastSaturnParser(max_workers=options['threads'], request_delay=0)
+    if semaphore is not None:
+        parser.rate_limiter = semaphore.acquire
+    history = PriceHistory()
+    output_dir = options['output_dir']
+    if options['trace']:
+        TRACER.start(os.path.join(output_dir, f"traces_{index}.jsonl"))
+    pipeline = SyncPipeline(
+        config,
+        parse_func=parser.parse_single_product,
+        parse_workers=options['threads'],
+        db_writers=options['db_writers'],
+        raw_csv=os.path.join(output_dir, f"raw_{index}.csv") if options['write_csv'] else None,
+        processed_csv=os.path.join(output_dir, f"processed_{index}.csv") if options['write_csv'] else None,
+        history=history
+    )
+
+    done = threading.Event()
+
+    def report_progress():
+        while not done.wait(PROGRESS_INTERVAL):
+            results_queue.put(('progress', index, {'skus': pipeline.stats.skus, 'parsed': pipeline.stats.parsed}))
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+    outcome = None
+    try:
+        stats = pipeline.run(_iter_until(items, stop_event))
+        outcome = ('done', index, {
+            'skus': stats.skus, 'parsed': stats.parsed, 'not_found': stats.not_found,
+            'parse_errors': stats.parse_errors, 'written': stats.writer.prices.written,
+            'unchanged': stats.writer.prices.unchanged,
+            'write_errors': stats.writer.errors + stats.writer.prices.failed,
+            'history_errors': stats.history_errors,
+        })
+    except Exception as e:
+        outcome = ('error', index, str(e))
+    finally:
+        done.set()
+        history.close()
+        finish_run_trace(os.path.join(output_dir, f"trace_report_{index}.txt"))
+        # Снимок метрик уходит раньше итога: родитель ждёт очередь до последнего итога
+        results_queue.put(('metrics', index, REGISTRY.snapshot()))
+        if outcome is not None:
+            results_queue.put(outcome)
+
+
+class ProcessRunner:
+    """Запуск N процессов-исполнителей и сведение их результатов"""
+
+    def __init__(self, manager, processes: int, rate: float = SATURN_RATE_LIMIT,
+                 threads: int = PROCESS_WORKER_THREADS, db_writers: int = 1, write_csv: bool = True,
+                 trace: bool = False):
+        self.manager = manager
+        self.processes = max(1, processes)
+        self.rate = rate
+        self.threads = threads
+        self.db_writers = db_writers
+        self.write_csv = write_csv
+        self.trace = trace
+        self.context = multiprocessing.get_context('spawn')
+
+    @staticmethod
+    def _terminate_stuck(workers, results: Dict[int, Dict], reason: str):
+        """Принудительное завершение исполнителей, так и не отчитавшихся об итоге"""
+        for index, worker in enumerate(workers):
+            if index in results:
+                continue
+            if worker.is_alive():
+                worker.terminate()
+            results[index] = {'error': reason}
+            logger.error(f"Процесс {index} {reason}, остановлен принудительно")
+
+    def split(self, items: List[Tuple]) -> List[List[Tuple]]:
+        ring = ShardRing(self.processes)
+        parts = [[] for _ in range(self.processes)]
+        for item in items:
+            parts[ring.shard_of(item[0])].append(item)
+        return parts
+
+    def run(self, items: List[Tuple]) -> bool:
+        start = time.monotonic()
+        parts = self.split(items)
+        output_dir = self.manager.output_dir / "processes"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        options = {'threads': self.threads, 'db_writers': self.db_writers,
+                   'write_csv': self.write_csv, 'output_dir': str(output_dir), 'trace': self.trace}
+
+        limiter = GlobalRateLimiter(self.context, self.rate) if self.rate > 0 else None
+        results_queue = self.context.Queue()
+        stop_event = self.context.Event()
+
+        workers = [
+            self.context.Process(
+                target=_worker_main, name=f"sync-worker-{index}",
+                args=(index, part, self.manager.config, options, results_queue,
+                      limiter.semaphore if limiter else None, stop_event)
+            )
+            for index, part in enumerate(parts)
+        ]
+        rate = f"лимит {self.rate:g} запросов/с" if self.rate > 0 else "без лимита запросов"
+        logger.info(f"🚀 Синхронизация в {self.processes} процессах по {self.threads} потоков, "
+                    f"артикулов {len(items)} ({', '.join(str(len(part)) for part in parts)}), {rate}")
+
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+        for worker in workers:
+            worker.start()
+        if limiter:
+            limiter.start()
+
+        progress: Dict[int, Dict] = {}
+        results: Dict[int, Dict] = {}
+        last_report = time.monotonic()
+        deadline = getattr(self.manager, 'deadline', None)
+        stopped_at = None
+        deadline_hit = False
+        try:
+            while len(results) < len(workers):
+                if self.manager.stop_event.is_set():
+                    stop_event.set()
+                elif deadline and time.time() >= deadline and not stop_event.is_set():
+                    logger.warning("Срок прогона: исполнители дописывают начатое")
+                    deadline_hit = True
+                    stop_event.set()
+                if stop_event.is_set():
+                    stopped_at = stopped_at or time.monotonic()
+                    if time.monotonic() - stopped_at > PROCESS_STOP_GRACE:
+                        self._terminate_stuck(workers, results, f"не остановился за {PROCESS_STOP_GRACE:g}с")
+                        break
+                try:
+                    kind, index, payload = results_queue.get(timeout=1)
+                except KeyboardInterrupt:
+                    logger.warning("Остановка: исполнители дописывают начатое")
+                    stop_event.set()
+                    continue
+                except queue.Empty:
+                    for index, worker in enumerate(workers):
+                        # Процесс упал, не успев отчитаться
+                        if index not in results and worker.exitcode not in (None, 0):
+                            results[index] = {'error': f"код завершения {worker.exitcode}"}
+                    continue
+
+                if kind == 'progress':
+                    progress[index] = payload
+                elif kind == 'metrics':
+                    REGISTRY.merge(payload)
+                elif kind == 'done':
+                    results[index] = payload
+                    logger.info(f"Процесс {index} завершен: {payload}")
+                else:
+                    results[index] = {'error': payload}
+                    logger.error(f"Процесс {index} завершился ошибкой: {payload}")
+
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    parsed = sum(p.get('parsed', 0) for p in progress.values())
+                    elapsed = time.monotonic() - start
+                    logger.info(f"Прогресс: спарсено {parsed}/{len(items)}, {parsed / elapsed:.1f} товаров/сек")
+        finally:
+            for index, worker in enumerate(workers):
+                worker.join(PROCESS_EXIT_TIMEOUT)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+                    results[index] = {'error': f"не завершился за {PROCESS_EXIT_TIMEOUT:g}с после итога"}
+                    logger.error(f"Процесс {index} завис при завершении и остановлен принудительно")
+            if limiter:
+                limiter.stop()
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+
+        merged: Dict = {}
+        for payload in results.values():
+            for key, value in payload.items():
+                if isinstance(value, (int, float)):
+                    merged[key] = merged.get(key, 0) + value
+        elapsed = time.monotonic() - start
+        logger.info(f"Итог по процессам: {merged}, {elapsed:.1f}с, "
+                    f"{merged.get('parsed', 0) / elapsed if elapsed else 0:.1f} товаров/сек")
+
+        if self.write_csv:
+            self.manager.merge_shard_outputs(output_dir, self.processes)
+
+        failed = [index for index, payload in results.items()
+                  if 'error' in payload or payload.get('write_errors') or payload.get('history_errors')]
+        # Остановка к сроку прогона - не сбой: недоделанное проверится в следующий раз
+        interrupted = stop_event.is_set() and not deadline_hit
+        return not failed and not interrupted and merged.get('parsed', 0) > 0
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Profiler - сэмплирующий профилировщик прогона
+
+Отдельный поток с заданной частотой снимает стеки всех потоков процесса
+(sys._current_frames), внешние инструменты к cron-задаче подключать не
+нужно. Потоки группируются в стадии по имени (sync-parse, sync-markup,
+price-writer, underprice...). Сэмпл потока считается процессорным, если
+за интервал выросло его процессорное время (/proc/self/task/<tid>/stat),
+иначе это ожидание - сеть, очередь, блокировка. По итогам в каталог
+профиля пишутся collapsed-стеки для flamegraph.pl/speedscope по стадиям
+(процессорные и полные по времени) и таблица самых затратных функций.
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', Path("output") / "profile"))
+# Интервал сэмплирования: 20 мс - доли процента накладных расходов
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 20))
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', 25))
+
+# Глубже стеки обрезаются: хватает для flamegraph, дешевле обход
+MAX_STACK_DEPTH = 128
+
+_PROC_TASKS = Path('/proc/self/task')
+
+Frame = Tuple[str, str, int]
+
+
+def stage_name(thread_name: str) -> str:
+    """Стадия по имени потока: номер потока в пуле отбрасывается"""
+    return re.sub(r'([-_]\d+)+$', '', thread_name) or thread_name
+
+
+def _thread_cpu_ticks(native_id: int) -> Optional[int]:
+    """Процессорное время потока (user + system) в тиках; None - недоступно"""
+    try:
+        stat = (_PROC_TASKS / str(native_id) / 'stat').read_text()
+    except OSError:
+        return None
+    # Имя потока в скобках может содержать пробелы - поля считаются после ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+
+class SamplingProfiler:
+    """Профилировщик всех потоков процесса"""
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.cpu_available = _PROC_TASKS.is_dir()
+        # (стадия, стек от корня) -> число сэмплов; все и процессорные
+        self.wall: Counter = Counter()
+        self.cpu: Counter = Counter()
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.elapsed = 0.0
+        self._cpu_ticks: Dict[int, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Профилирование: сэмплы раз в {self.interval * 1000:g} мс"
+                    + ("" if self.cpu_available else ", без разделения на процессор и ожидание"))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.elapsed = time.time() - self.started_at
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self._sample(own)
+
+    def _sample(self, own: int):
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            thread = threads.get(ident)
+            stage = stage_name(thread.name) if thread else 'unknown'
+            stack = self._stack(frame)
+            self.wall[(stage, stack)] += 1
+            if thread is not None and self._on_cpu(thread):
+                self.cpu[(stage, stack)] += 1
+        self.samples += 1
+
+    def _on_cpu(self, thread: threading.Thread) -> bool:
+        if not self.cpu_available or thread.native_id is None:
+            return False
+        ticks = _thread_cpu_ticks(thread.native_id)
+        if ticks is None:
+            return False
+        previous = self._cpu_ticks.get(thread.native_id)
+        self._cpu_ticks[thread.native_id] = ticks
+        return previous is not None and ticks > previous
+
+    @staticmethod
+    def _stack(frame) -> Tuple[Frame, ...]:
+        stack: List[Frame] = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    @staticmethod
+    def _label(frame: Frame) -> str:
+        name, filename, line = frame
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    def stages(self) -> List[str]:
+        totals: Counter = Counter()
+        for (stage, _), count in self.wall.items():
+            totals[stage] += count
+        return [stage for stage, _ in totals.most_common()]
+
+    def collapsed(self, samples: Counter, stage: Optional[str] = None) -> List[str]:
+        """Строки collapsed-формата 'кадр;кадр;кадр число'; без стадии - стадия корневым кадром"""
+        lines: Counter = Counter()
+        for (sample_stage, stack), count in samples.items():
+            if stage is not None and sample_stage != stage:
+                continue
+            frames = [self._label(frame).replace(';', ':') for frame in stack]
+            if stage is None:
+                frames.insert(0, sample_stage)
+            lines[';'.join(frames)] += count
+        return [f"{frames} {count}" for frames, count in sorted(lines.items())]
+
+    def top_functions(self, stage: str, top_n: int = PROFILE_TOP_N) -> List[Dict]:
+        """Функции стадии по собственным процессорным сэмплам (без процессорных - по всем)"""
+        samples = self.cpu if self.cpu_available else self.wall
+        own: Counter = Counter()
+        total: Counter = Counter()
+        wall_own: Counter = Counter()
+        stage_samples = 0
+        for (sample_stage, stack), count in samples.items():
+            if sample_stage != stage or not stack:
+                continue
+            stage_samples += count
+            own[stack[-1]] += count
+            # Рекурсивная функция считается в стеке один раз
+            for frame in set(stack):
+                total[frame] += count
+        for (sample_stage, stack), count in self.wall.items():
+            if sample_stage == stage and stack:
+                wall_own[stack[-1]] += count
+
+        ranked = sorted(total, key=lambda frame: (own[frame], total[frame]), reverse=True)
+        return [
+            {
+                'function': self._label(frame),
+                'self': own[frame],
+                'total': total[frame],
+                'self_pct': 100.0 * own[frame] / stage_samples if stage_samples else 0.0,
+                'total_pct': 100.0 * total[frame] / stage_samples if stage_samples else 0.0,
+                'wall_self': wall_own[frame],
+            }
+            for frame in ranked[:top_n]
+        ]
+
+    def report(self, top_n: int = PROFILE_TOP_N) -> str:
+        kind = "процессорные" if self.cpu_available else "все"
+        # Под нагрузкой поток профилировщика ждёт GIL - фактический интервал длиннее заданного
+        interval_ms = 1000 * self.elapsed / self.samples if self.samples else self.interval * 1000
+        lines = [f"Профиль прогона: {self.elapsed:.1f}с, сэмплов {self.samples} "
+                 f"(в среднем раз в {interval_ms:.0f} мс), в таблицах {kind} сэмплы"]
+        for stage in self.stages():
+            wall = sum(count for (sample_stage, _), count in self.wall.items() if sample_stage == stage)
+            cpu = sum(count for (sample_stage, _), count in self.cpu.items() if sample_stage == stage)
+            lines.append('')
+            lines.append(f"== {stage}: сэмплов {wall}"
+                         + (f", на процессоре {cpu} (~{cpu * interval_ms / 1000:.1f}с)" if self.cpu_available else ''))
+            lines.append(f"{'self%':>7} {'total%':>7} {'self':>7} {'wall':>7}  функция")
+            for row in self.top_functions(stage, top_n):
+                lines.append(f"{row['self_pct']:7.1f} {row['total_pct']:7.1f} {row['self']:7d} "
+                             f"{row['wall_self']:7d}  {row['function']}")
+        return '\n'.join(lines)
+
+    def write(self, directory: Path, top_n: int = PROFILE_TOP_N) -> Path:
+        """Файлы профиля: <стадия>.cpu.collapsed, <стадия>.wall.collapsed, all.*.collapsed, top_functions.txt"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        kinds = [('wall', self.wall)] + ([('cpu', self.cpu)] if self.cpu_available else [])
+        for kind, samples in kinds:
+            (directory / f"all.{kind}.collapsed").write_text('\n'.join(self.collapsed(samples)) + '\n', encoding='utf-8')
+            for stage in self.stages():
+                filename = re.sub(r'[^\w.-]', '_', stage)
+                path = directory / f"{filename}.{kind}.collapsed"
+                path.write_text('\n'.join(self.collapsed(samples, stage)) + '\n', encoding='utf-8')
+        (directory / "top_functions.txt").write_text(self.report(top_n) + '\n', encoding='utf-8')
+        return directory
+
+
+def profile_run_dir(base: Path = PROFILE_DIR) -> Path:
+    """Каталог профиля прогона рядом с остальными выходными файлами"""
+    return Path(base) / datetime.now().strftime('%Y%m%d_%H%M%S')
+
+
+def run_profiled(func, *args, directory: Optional[Path] = None, **kwargs):
+    """Выполнение func под профилировщиком; профиль пишется и при ошибке"""
+    directory = directory or profile_run_dir()
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.stop()
+        try:
+            profiler.write(directory)
+            logger.info(f"Профиль прогона: {directory} (top_functions.txt, *.collapsed для flamegraph.pl)")
+        except OSError as e:
+            logger.error(f"Ошибка записи профиля: {e}")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Refresh Scheduler - адаптивное расписание перепарсинга артикулов Saturn
+
+По каждому артикулу хранится интервал проверки, время следующей проверки
+и сглаженная частота изменений цены. Неизменившаяся цена удваивает
+интервал (экспоненциальный откат), изменение сбрасывает его к минимуму.
+Интервал ограничен сверху максимальной допустимой давностью цены, так что
+даже самые стабильные товары проверяются не реже раза в неделю. В прогон
+попадают только артикулы, которым пора, волатильные - первыми.
+
+Расписание лежит в файле истории цен (PriceHistory) рядом с таблицей
+latest, из которой берутся времена последней проверки и изменения.
+"""
+
+import os
+import sys
+import time
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from price_history import PriceHistory
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+
+# Минимальный интервал чуть меньше суток, чтобы изменчивые товары попадали в каждый ночной прогон
+REFRESH_MIN_HOURS = float(os.getenv('REFRESH_MIN_HOURS', 20))
+REFRESH_MAX_STALENESS_HOURS = float(os.getenv('REFRESH_MAX_STALENESS_HOURS', 24 * 7))
+REFRESH_BACKOFF = float(os.getenv('REFRESH_BACKOFF', 2.0))
+
+# Вес нового наблюдения в сглаженной частоте изменений
+CHANGE_RATE_ALPHA = 0.3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refresh_schedule (
+    sku TEXT PRIMARY KEY,
+    interval INTEGER NOT NULL,
+    next_due INTEGER NOT NULL,
+    last_checked INTEGER NOT NULL,
+    change_rate REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_schedule_due ON refresh_schedule (next_due);
+"""
+
+
+class ScheduleEntry(NamedTuple):
+    sku: str
+    interval: int
+    next_due: int
+    last_checked: int
+    change_rate: float
+
+
+class RefreshScheduler:
+    """Расписание проверок артикулов по наблюдаемой изменчивости цен"""
+
+    def __init__(self, history: PriceHistory, min_hours: float = REFRESH_MIN_HOURS,
+                 max_staleness_hours: float = REFRESH_MAX_STALENESS_HOURS, backoff: float = REFRESH_BACKOFF):
+        self.history = history
+        self.min_interval = int(min_hours * HOUR)
+        self.max_interval = max(self.min_interval, int(max_staleness_hours * HOUR))
+        self.backoff = max(1.0, backoff)
+        with history.lock:
+            history.connection.executescript(SCHEMA)
+
+    def entries(self) -> Dict[str, ScheduleEntry]:
+        with self.history.lock:
+            rows = self.history.connection.execute(
+                "SELECT sku, interval, next_due, last_checked, change_rate FROM refresh_schedule"
+            ).fetchall()
+        return {row[0]: ScheduleEntry(*row) for row in rows}
+
+    def due(self, skus: Iterable[str], now: Optional[int] = None) -> List[str]:
+        """Артикулы, которым пора: сначала новые, затем по частоте изменений и просрочке"""
+        now = int(now if now is not None else time.time())
+        entries = self.entries()
+        skus = list(skus)
+
+        due = []
+        for sku in skus:
+            entry = entries.get(sku)
+            if entry is None:
+                due.append((0, 0.0, 0, sku))
+            elif entry.next_due <= now:
+                due.append((1, -entry.change_rate, entry.next_due, sku))
+        due.sort()
+
+        logger.info(f"Расписание: к проверке {len(due)} из {len(skus)} артикулов "
+                    f"(новых {sum(1 for item in due if item[0] == 0)})")
+        return [item[-1] for item in due]
+
+    def iter_due(self, items: Iterable, key: Callable = lambda item: item, now: Optional[int] = None) -> Iterator:
+        """Потоковый фильтр: пропускает только элементы, чьим артикулам пора"""
+        now = int(now if now is not None else time.time())
+        next_due = {sku: entry.next_due for sku, entry in self.entries().items()}
+        skipped = 0
+        for item in items:
+            if next_due.get(key(item), 0) <= now:
+                yield item
+            else:
+                skipped += 1
+        logger.info(f"Расписание: пропущено ещё не назревших артикулов {skipped}")
+
+    def next_interval(self, entry: Optional[ScheduleEntry], changed: bool) -> int:
+        if entry is None or changed:
+            return self.min_interval
+        return min(self.max_interval, int(entry.interval * self.backoff))
+
+    def update_checked_since(self, since: int) -> int:
+        """Пересчёт расписания для артикулов, проверенных начиная с since (по истории цен)"""
+        entries = self.entries()
+        with self.history.lock:
+            rows = self.history.connection.execute(
+                "SELECT sku, changed_at, checked_at FROM latest WHERE checked_at >= ?", (since,)
+            ).fetchall()
+
+            updates = []
+            changed_count = 0
+            for sku, changed_at, checked_at in rows:
+                entry = entries.get(sku)
+                changed = entry is None or changed_at > entry.last_checked
+                changed_count += changed
+                interval = self.next_interval(entry, changed)
+                rate = 1.0 if entry is None else (
+                    CHANGE_RATE_ALPHA * changed + (1 - CHANGE_RATE_ALPHA) * entry.change_rate
+                )
+                updates.append((sku, interval, checked_at + interval, checked_at, rate))
+
+            self.history.connection.executemany("""
+            INSERT OR REPLACE INTO refresh_schedule (sku, interval, next_due, last_checked, change_rate)
+            VALUES (?, ?, ?, ?, ?)
+            """, updates)
+            self.history.connection.commit()
+
+        logger.info(f"Расписание обновлено: проверено {len(updates)}, с изменением цены {changed_count}")
+        return len(updates)
+
+    def earliest_due(self) -> Optional[int]:
+        """Ближайшее время проверки (None - расписание пустое)"""
+        with self.history.lock:
+            return self.history.connection.execute("SELECT MIN(next_due) FROM refresh_schedule").fetchone()[0]
+
+    def summary(self, now: Optional[int] = None) -> Dict[str, int]:
+        now = int(now if now is not None else time.time())
+        with self.history.lock:
+            total, due = self.history.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(next_due <= ?), 0) FROM refresh_schedule", (now,)
+            ).fetchone()
+            intervals = dict(self.history.connection.execute(
+                "SELECT interval, COUNT(*) FROM refresh_schedule GROUP BY interval ORDER BY interval"
+            ).fetchall())
+        return {'total': total, 'due': due, **{f"{interval / HOUR:g}ч": count for interval, count in intervals.items()}}
+
+
+def main():
+    import argparse
+    from pathlib import Path
+    from price_history import DEFAULT_HISTORY_FILE
+
+    parser = argparse.ArgumentParser(description='Расписание перепарсинга артикулов Saturn')
+    parser.add_argument('--db', default=str(DEFAULT_HISTORY_FILE), help='Файл истории цен')
+    args = parser.parse_args()
+
+    with PriceHistory(Path(args.db)) as history:
+        summary = RefreshScheduler(history).summary()
+    print(f"Артикулов в расписании: {summary.pop('total')}, к проверке сейчас: {summary.pop('due')}")
+    for interval, count in summary.items():
+        print(f"  интервал {interval}: {count}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
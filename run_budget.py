@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Run Budget - синхронизация к сроку
+
+Артикулы упорядочиваются по приоритету: изменчивость цены (из расписания
+перепарсинга), продажи товара в Bitrix и давность последней проверки.
+Во время прогона скорость обработки пересчитывается непрерывно и
+проецируется на время, оставшееся до срока. Если прогноз не укладывается,
+число параллельных запросов наращивается ступенями, пока это ускоряет
+обработку; когда наращивать дальше некуда или бесполезно, к сроку
+отбрасывается хвост с наименьшим приоритетом - эти артикулы самые
+давние и первыми попадут в следующий прогон.
+"""
+
+import os
+import math
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from refresh_scheduler import RefreshScheduler
+
+logger = logging.getLogger(__name__)
+
+# Запас до срока: дозапись очереди в Bitrix (в полном режиме - этап 2)
+RUN_BUDGET_RESERVE_MINUTES = float(os.getenv('RUN_BUDGET_RESERVE_MINUTES', 10))
+# Предел параллельных запросов при наращивании
+RUN_BUDGET_MAX_WORKERS = int(os.getenv('RUN_BUDGET_MAX_WORKERS', 40))
+# За сколько дней учитываются продажи товара
+SALES_RANK_DAYS = int(os.getenv('SALES_RANK_DAYS', 30))
+
+# Веса составляющих приоритета: изменчивость, продажи, давность проверки
+VOLATILITY_WEIGHT = 0.4
+SALES_WEIGHT = 0.35
+STALENESS_WEIGHT = 0.25
+
+# Как часто пересчитывается прогноз и решается вопрос о наращивании
+CONTROL_INTERVAL = 30.0
+# Вес нового замера в сглаженной скорости
+RATE_ALPHA = 0.5
+# Ступень наращивания оставляется, только если ускорила обработку хотя бы на 10%
+RAMP_MIN_GAIN = 0.1
+
+
+def parse_deadline(deadline: Optional[str] = None, time_budget_minutes: Optional[float] = None,
+                   now: Optional[datetime] = None) -> Optional[float]:
+    """Срок прогона (unix-время): 'ЧЧ:ММ' (ближайшее), ISO-дата/время или бюджет в минутах
+
+    Если заданы оба, действует более ранний.
+    """
+    now = now or datetime.now()
+    candidates = []
+    if deadline:
+        try:
+            at = datetime.strptime(deadline, '%H:%M')
+            moment = now.replace(hour=at.hour, minute=at.minute, second=0, microsecond=0)
+            if moment <= now:
+                moment += timedelta(days=1)
+        except ValueError:
+            moment = datetime.fromisoformat(deadline)
+        candidates.append(moment.timestamp())
+    if time_budget_minutes:
+        candidates.append(now.timestamp() + time_budget_minutes * 60)
+    return min(candidates) if candidates else None
+
+
+def load_sales_ranks(config, days: int = SALES_RANK_DAYS) -> Dict[str, float]:
+    """Продажи товаров Saturn за days дней по артикулам; без модуля магазина - пусто"""
+    from bitrix_integration import BitrixClient
+
+    client = BitrixClient(config)
+    if not client.connect():
+        logger.warning("Продажи для приоритета не загружены: нет подключения к Bitrix")
+        return {}
+    try:
+        return client.get_sales_by_sku(days)
+    except Exception as e:
+        logger.warning(f"Продажи для приоритета не загружены: {e}")
+        return {}
+    finally:
+        client.disconnect()
+
+
+class PriorityPlanner:
+    """Порядок артикулов по ценности проверки"""
+
+    def __init__(self, scheduler: RefreshScheduler, sales: Optional[Dict[str, float]] = None):
+        self.scheduler = scheduler
+        self.sales = sales or {}
+        top_sales = max(self.sales.values(), default=0)
+        self._sales_norm = math.log1p(top_sales) if top_sales > 0 else 1.0
+
+    def order(self, items: Iterable, key: Callable = lambda item: item, now: Optional[int] = None) -> List:
+        """Элементы по убыванию приоритета их артикулов"""
+        now = int(now if now is not None else time.time())
+        entries = self.scheduler.entries()
+        max_staleness = self.scheduler.max_interval
+
+        def score(item) -> float:
+            sku = key(item)
+            entry = entries.get(sku)
+            # Новый артикул: цена неизвестна - максимальные изменчивость и давность
+            volatility = entry.change_rate if entry else 1.0
+            staleness = min(1.0, (now - entry.last_checked) / max_staleness) if entry else 1.0
+            sales = math.log1p(self.sales.get(sku, 0)) / self._sales_norm
+            return VOLATILITY_WEIGHT * volatility + SALES_WEIGHT * sales + STALENESS_WEIGHT * staleness
+
+        ordered = sorted(items, key=score, reverse=True)
+        logger.info(f"Приоритет: упорядочено артикулов {len(ordered)}, "
+                    f"с продажами {sum(1 for item in ordered if self.sales.get(key(item)))}")
+        return ordered
+
+
+class RunBudget:
+    """Срок прогона и прогноз: сколько артикулов успеем при текущей скорости"""
+
+    def __init__(self, deadline: float, total: int, reserve_minutes: float = RUN_BUDGET_RESERVE_MINUTES):
+        self.deadline = deadline
+        self.total = total
+        # Новые артикулы перестают выдаваться за reserve до срока
+        self.cutoff = deadline - reserve_minutes * 60
+        self.rate: Optional[float] = None
+        self._window_start = time.monotonic()
+        self._window_done = 0
+
+    @property
+    def time_left(self) -> float:
+        return max(0.0, self.cutoff - time.time())
+
+    def expired(self) -> bool:
+        return time.time() >= self.cutoff
+
+    def update(self, done: int) -> Optional[float]:
+        """Замер скорости раз в CONTROL_INTERVAL; возвращает скорость окна или None"""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < CONTROL_INTERVAL:
+            return None
+        window_rate = (done - self._window_done) / elapsed
+        self.rate = window_rate if self.rate is None else RATE_ALPHA * window_rate + (1 - RATE_ALPHA) * self.rate
+        self._window_start = now
+        self._window_done = done
+        return window_rate
+
+    def projected(self, done: int) -> int:
+        """Сколько артикулов из оставшихся не успеем при текущей скорости"""
+        if self.rate is None:
+            return 0
+        return max(0, int(self.total - done - self.rate * self.time_left))
+
+    def describe(self) -> str:
+        return f"срок {datetime.fromtimestamp(self.deadline):%Y-%m-%d %H:%M}, приём артикулов до " \
+               f"{datetime.fromtimestamp(self.cutoff):%H:%M}, артикулов {self.total}"
+
+
+class ConcurrencyController:
+    """Наращивание параллельности, пока прогноз не укладывается в срок и это ускоряет обработку"""
+
+    def __init__(self, budget: RunBudget, initial: int, maximum: int = RUN_BUDGET_MAX_WORKERS):
+        self.budget = budget
+        self.concurrency = max(1, initial)
+        self.maximum = max(self.concurrency, maximum)
+        self.saturated = False
+        self._previous: Optional[int] = None
+        self._rate_before_step: Optional[float] = None
+
+    def checkpoint(self, done: int) -> int:
+        """Вызов по ходу прогона с числом обработанных артикулов; возвращает параллельность"""
+        window_rate = self.budget.update(done)
+        if window_rate is None:
+            return self.concurrency
+
+        if self._previous is not None:
+            # Оценка прошлой ступени: не ускорила - упёрлись в лимит запросов или в сам сайт
+            if window_rate < self._rate_before_step * (1 + RAMP_MIN_GAIN):
+                logger.info(f"Наращивание до {self.concurrency} не ускорило обработку "
+                            f"({window_rate:.1f} товаров/сек), возврат к {self._previous}")
+                self.concurrency = self._previous
+                self.saturated = True
+            self._previous = None
+
+        shortfall = self.budget.projected(done)
+        logger.info(f"Прогноз: {self.budget.rate:.1f} товаров/сек, осталось {self.budget.total - done}, "
+                    f"до приёма {self.budget.time_left / 60:.1f} мин, не успеваем {shortfall}")
+
+        if shortfall and not self.saturated and self.concurrency < self.maximum:
+            self._previous = self.concurrency
+            self._rate_before_step = window_rate
+            self.concurrency = min(self.maximum, self.concurrency + max(1, self.concurrency // 4))
+            logger.info(f"Наращиваем параллельность: {self._previous} → {self.concurrency}")
+        elif shortfall:
+            logger.warning(f"К сроку будут отброшены ~{shortfall} артикулов с наименьшим приоритетом")
+        return self.concurrency
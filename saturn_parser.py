@@ -245,7 +245,10 @@ class SaturnParser:
                         continue
                     
                     # Найден нужный товар
-                    return self._extract_product_data_from_item(item, sku)
+                    product_data = self._extract_product_data_from_item(item, sku)
+                    if product_data:
+                        product_data['url'] = search_url
+                    return product_data
             
             page_text = soup.get_text()
             
@@ -99,6 +99,15 @@ run_sync() {
         "full")
             python3 full_sync.py --batch-size "$batch_size"
             ;;
+        "stream")
+            python3 full_sync.py --stream --batch-size "$batch_size"
+            ;;
+        "resume")
+            python3 full_sync.py --resume --batch-size "$batch_size"
+            ;;
+        "daemon")
+            exec python3 full_sync.py --daemon --stream --adaptive
+            ;;
         "parse-only")
             python3 full_sync.py --parse-only --batch-size "$batch_size"
             ;;
@@ -110,7 +119,7 @@ run_sync() {
             ;;
         *)
             log "ОШИБКА: Неизвестный режим: $mode"
-            log "Доступные режимы: full, parse-only, process-only, test"
+            log "Доступные режимы: full, stream, resume, daemon, parse-only, process-only, test"
             exit 1
             ;;
     esac
@@ -154,6 +163,9 @@ Saturn Parser - Скрипт запуска синхронизации
 
 Команды:
   full [SIZE]       Полная синхронизация (по умолчанию)
+  stream [SIZE]     Потоковая синхронизация (парсинг и запись одновременно)
+  resume [SIZE]     Продолжить прерванную полную синхронизацию по журналу
+  daemon            Демон: потоковая синхронизация по адаптивному расписанию
   parse-only [SIZE] Только парсинг цен с Saturn
   process-only      Только обработка существующих цен
   test              Тестовый режим (10 товаров)
@@ -165,6 +177,7 @@ Saturn Parser - Скрипт запуска синхронизации
 Примеры:
   $0                    # Полная синхронизация (100 товаров)
   $0 full 50           # Полная синхронизация (50 товаров)
+  $0 stream 500        # Потоковая синхронизация (500 товаров)
   $0 test              # Тестовый режим
   $0 parse-only 20     # Только парсинг (20 товаров)
   $0 monitor           # Мониторинг
@@ -175,6 +188,44 @@ Saturn Parser - Скрипт запуска синхронизации
   BITRIX_MYSQL_USERNAME Пользователь MySQL
   BITRIX_MYSQL_PASSWORD Пароль MySQL
   BITRIX_IBLOCK_ID      ID информационного блока
+  BITRIX_MYSQL_POOL_SIZE    Размер пула соединений MySQL (5)
+  BITRIX_MYSQL_C_EXTENSION  1 - использовать C-расширение mysql-connector
+  UNDERPRICE_MODE           Режим пересчета скидок: rows, sql, matrix (rows)
+  UNDERPRICE_FUSION         0 - режим rows без слияния цепочек правил (1)
+  UNDERPRICE_PURCHASING_RULES  1 - выполнять правила от/к закупочной цене (P) без группы цен P (0)
+  UNDERPRICE_WORKERS        Параллельных потоков пересчета скидок (1)
+  UNDERPRICE_PARTITION_SIZE Размер партиции, ID товаров (50000)
+  UNDERPRICE_FULL_INTERVAL_HOURS  Полный пересчет в режиме --incremental раз в N часов (24)
+  SYNC_JOURNAL_FILE         Журнал прогонов для --resume (cache/sync_journal.db)
+  SYNC_RESUME_MAX_AGE_HOURS --resume не продолжает прогоны старше N часов (24)
+  SYNC_JOURNAL_KEEP_RUNS    Последних прогонов в журнале, старые удаляются по завершении прогона (20, 0 - все)
+  SYNC_DAEMON_INTERVAL_MINUTES  Демон: максимальный интервал между прогонами, мин (60)
+  SYNC_DAEMON_MAX_RESUMES   Демон: продолжений незавершённого прогона подряд (2)
+  SHARD_LEASE_STORE         --shards: аренды шардов, 'mysql' или 'sqlite:путь' (sqlite:cache/shard_leases.db)
+  SHARD_LEASE_TTL           --shards: срок аренды шарда, с (300)
+  SHARD_MAX_ATTEMPTS        --shards: попыток обработки шарда до статуса failed (3)
+  SHARD_RETRY_BACKOFF       --shards: пауза перед повтором шарда, с на номер попытки (60)
+  SATURN_RATE_LIMIT         --processes: общий лимит запросов к Saturn в секунду (20, 0 - без лимита)
+  PROCESS_WORKER_THREADS    --processes: потоков парсинга в каждом процессе (10)
+  PROCESS_STOP_GRACE_SECONDS  --processes: после остановки или срока процесс завершается принудительно через N сек (120)
+  RUN_BUDGET_RESERVE_MINUTES  --deadline/--time-budget: запас до срока на дозапись и этап 2, мин (10)
+  RUN_BUDGET_MAX_WORKERS    --deadline/--time-budget: предел параллельных запросов при наращивании (40)
+  SALES_RANK_DAYS           --deadline/--time-budget: период продаж для приоритета, дней (30)
+  METRICS_TEXTFILE          Файл метрик Prometheus для textfile collector node_exporter (не задан - не пишется)
+  METRICS_SUMMARY_FILE      JSON-сводка метрик прогона (output/run_metrics.json)
+  SYNC_TRACE                Трассы артикулов по стадиям, 1/0 (1)
+  SYNC_TRACE_FILE           Файл трасс JSONL (output/traces.jsonl)
+  TRACE_REPORT_FILE         Отчёт о самых медленных артикулах (output/trace_report.txt)
+  TRACE_TOP_N               Артикулов в отчёте (20)
+  PROFILE_DIR               Каталог профилей при --profile (output/profile)
+  PROFILE_INTERVAL_MS       Интервал сэмплирования профилировщика, мс (20)
+  PROFILE_TOP_N             Функций в таблице профиля на стадию (25)
+  PRICE_HISTORY_FILE        История цен Saturn (cache/price_history.db)
+  PRICE_HISTORY_BUSY_TIMEOUT  Ожидание блокировки файла истории цен, сек (60)
+  PRICE_HISTORY_RETENTION_DAYS  Хранение точек истории цен после прогона, дней (180, 0 - без очистки)
+  REFRESH_MIN_HOURS         --adaptive: минимальный интервал перепарсинга, ч (20)
+  REFRESH_MAX_STALENESS_HOURS  --adaptive: максимальная давность цены, ч (168)
+  REFRESH_BACKOFF           --adaptive: множитель интервала для неизменных цен (2)
   SUPPLIER_PREFIX       Префикс поставщика (saturn-)
 
 EOF
@@ -201,7 +252,7 @@ main() {
         "cleanup")
             cleanup
             ;;
-        "full"|"parse-only"|"process-only"|"test")
+        "full"|"stream"|"resume"|"daemon"|"parse-only"|"process-only"|"test")
             check_dependencies
             check_config
             run_sync "$command" "$param"
@@ -184,6 +184,31 @@ ExecStart=$project_dir/scripts/run_sync.sh full
 StandardOutput=journal
 StandardError=journal
 
+[Install]
+WantedBy=multi-user.target
+EOF
+
+    # Долгоживущий демон: прогоны по расписанию без холодного старта,
+    # reload = SIGHUP (перечитать конфигурацию), stop = SIGTERM (дописать начатое)
+    cat > "/etc/systemd/system/saturn-parser-daemon.service" << EOF
+[Unit]
+Description=Saturn Price Sync Daemon
+After=network.target mysql.service
+
+[Service]
+Type=simple
+User=$(whoami)
+WorkingDirectory=$project_dir
+Environment=PATH=$project_dir/venv/bin:/usr/local/bin:/usr/bin:/bin
+ExecStart=$project_dir/venv/bin/python3 full_sync.py --daemon --stream --adaptive
+ExecReload=/bin/kill -HUP \$MAINPID
+KillSignal=SIGTERM
+TimeoutStopSec=300
+Restart=on-failure
+RestartSec=60
+StandardOutput=journal
+StandardError=journal
+
 [Install]
 WantedBy=multi-user.target
 EOF
@@ -192,6 +217,7 @@ EOF
     log "✅ Systemd сервис создан"
     log "Для запуска: sudo systemctl start saturn-parser"
     log "Для автозапуска: sudo systemctl enable saturn-parser"
+    log "Демон вместо cron: sudo systemctl enable --now saturn-parser-daemon"
 }
 
 # Создание тестовых данных
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Section Tree - индекс дерева разделов Bitrix по вложенным множествам
+
+Дерево строится один раз из LEFT_MARGIN/RIGHT_MARGIN таблицы
+b_iblock_section. Проверка «раздел лежит в поддереве» выполняется
+сравнением границ за O(1), поиск ближайшего покрывающего раздела из
+набора (разделы правил) - двоичным поиском по левым границам.
+"""
+
+import time
+import logging
+import threading
+from bisect import bisect_right
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Как часто (сек) перепроверять штамп таблицы разделов для кэша в памяти
+STAMP_CHECK_INTERVAL = 300
+
+
+class SectionNode(NamedTuple):
+    id: int
+    iblock_id: int
+    parent_id: Optional[int]
+    left: int
+    right: int
+    depth: int
+
+
+class SectionTree:
+    """Разделы всех инфоблоков с границами вложенных множеств"""
+
+    def __init__(self, nodes: Iterable[SectionNode] = (), stamp: Tuple = ()):
+        self.nodes: Dict[int, SectionNode] = {node.id: node for node in nodes}
+        self.stamp = stamp
+        self._subtrees: Dict[int, List[int]] = {}
+        # IBLOCK_ID -> (левые границы, ID разделов) в порядке обхода дерева
+        self._order: Dict[int, Tuple[List[int], List[int]]] = {}
+        for node in sorted(self.nodes.values(), key=lambda n: (n.iblock_id, n.left)):
+            lefts, ids = self._order.setdefault(node.iblock_id, ([], []))
+            lefts.append(node.left)
+            ids.append(node.id)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @classmethod
+    def load(cls, connection) -> 'SectionTree':
+        cursor = connection.cursor()
+        try:
+            stamp = section_table_stamp(cursor)
+            cursor.execute("""
+            SELECT ID, IBLOCK_ID, IBLOCK_SECTION_ID, LEFT_MARGIN, RIGHT_MARGIN, DEPTH_LEVEL
+            FROM b_iblock_section
+            """)
+            nodes = [
+                SectionNode(int(row[0]), int(row[1]), int(row[2]) if row[2] else None,
+                            int(row[3] or 0), int(row[4] or 0), int(row[5] or 0))
+                for row in cursor.fetchall()
+            ]
+        finally:
+            cursor.close()
+
+        tree = cls(nodes, stamp)
+        logger.info(f"Дерево разделов: {len(tree)} разделов")
+        return tree
+
+    def contains(self, ancestor_id: Optional[int], section_id: Optional[int]) -> bool:
+        """Лежит ли section_id в поддереве ancestor_id (включая сам раздел)"""
+        if not ancestor_id:
+            return True
+        if not section_id:
+            return False
+        if ancestor_id == section_id:
+            return True
+        ancestor = self.nodes.get(ancestor_id)
+        node = self.nodes.get(section_id)
+        if ancestor is None or node is None or ancestor.iblock_id != node.iblock_id:
+            return False
+        return ancestor.left <= node.left and node.right <= ancestor.right
+
+    def overlaps(self, first_id: Optional[int], second_id: Optional[int]) -> bool:
+        """Пересекаются ли поддеревья двух разделов (один вложен в другой)"""
+        return self.contains(first_id, second_id) or self.contains(second_id, first_id)
+
+    def ancestors(self, section_id: int) -> List[int]:
+        """Цепочка предков от раздела к корню (без самого раздела)"""
+        chain = []
+        node = self.nodes.get(section_id)
+        while node is not None and node.parent_id:
+            chain.append(node.parent_id)
+            node = self.nodes.get(node.parent_id)
+        return chain
+
+    def subtree_ids(self, section_id: int) -> List[int]:
+        """ID раздела и всех его подразделов (кэшируется)"""
+        if section_id not in self._subtrees:
+            node = self.nodes.get(section_id)
+            if node is None:
+                self._subtrees[section_id] = [section_id]
+            else:
+                lefts, ids = self._order[node.iblock_id]
+                start = bisect_right(lefts, node.left) - 1
+                end = bisect_right(lefts, node.right)
+                self._subtrees[section_id] = ids[start:end]
+        return self._subtrees[section_id]
+
+    def matcher(self, section_ids: Iterable[int]) -> 'SectionMatcher':
+        return SectionMatcher(self, section_ids)
+
+
+class SectionMatcher:
+    """Поиск самого вложенного раздела из набора, покрывающего заданный раздел
+
+    Поддеревья разделов либо вложены, либо не пересекаются, поэтому после
+    двоичного поиска последнего раздела набора с левой границей не больше
+    границы искомого остаётся подняться по цепочке объемлющих разделов.
+    """
+
+    def __init__(self, tree: SectionTree, section_ids: Iterable[int]):
+        self.tree = tree
+        self.unknown = set()
+        self._entries: Dict[int, Tuple[List[int], List[SectionNode], List[int]]] = {}
+
+        nodes = []
+        for section_id in set(section_ids):
+            node = tree.nodes.get(section_id)
+            if node is None:
+                self.unknown.add(section_id)
+            else:
+                nodes.append(node)
+
+        for node in sorted(nodes, key=lambda n: (n.iblock_id, n.left)):
+            lefts, entries, enclosing = self._entries.setdefault(node.iblock_id, ([], [], []))
+            # Ближайший объемлющий - последний из предыдущих, чьё поддерево содержит узел
+            parent = len(entries) - 1
+            while parent >= 0 and entries[parent].right < node.right:
+                parent = enclosing[parent]
+            lefts.append(node.left)
+            entries.append(node)
+            enclosing.append(parent)
+
+    def match(self, section_id: Optional[int]) -> Optional[int]:
+        if not section_id:
+            return None
+        if section_id in self.unknown:
+            return section_id
+
+        node = self.tree.nodes.get(section_id)
+        if node is None or node.iblock_id not in self._entries:
+            return None
+
+        lefts, entries, enclosing = self._entries[node.iblock_id]
+        index = bisect_right(lefts, node.left) - 1
+        while index >= 0:
+            if node.right <= entries[index].right:
+                return entries[index].id
+            index = enclosing[index]
+        return None
+
+
+def section_table_stamp(cursor) -> Tuple:
+    cursor.execute("SELECT COUNT(*), MAX(ID), MAX(TIMESTAMP_X) FROM b_iblock_section")
+    return tuple(str(value) for value in cursor.fetchone())
+
+
+class SectionTreeCache:
+    """Дерево разделов в памяти процесса; перестраивается при смене штампа таблицы"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._tree: Optional[SectionTree] = None
+        self._checked_at = 0.0
+
+    def get(self, connection, force: bool = False) -> SectionTree:
+        with self.lock:
+            now = time.monotonic()
+            if not force and self._tree is not None and now - self._checked_at < STAMP_CHECK_INTERVAL:
+                CACHE_REQUESTS.inc(cache='section_tree', result='hit')
+                return self._tree
+
+            if not force and self._tree is not None:
+                cursor = connection.cursor()
+                try:
+                    stamp = section_table_stamp(cursor)
+                finally:
+                    cursor.close()
+                if stamp == self._tree.stamp:
+                    self._checked_at = now
+                    CACHE_REQUESTS.inc(cache='section_tree', result='hit')
+                    return self._tree
+
+            CACHE_REQUESTS.inc(cache='section_tree', result='miss')
+            self._tree = SectionTree.load(connection)
+            self._checked_at = now
+            return self._tree
+
+    def invalidate(self):
+        with self.lock:
+            self._tree = None
+            self._checked_at = 0.0
+
+
+_default_cache = SectionTreeCache()
+
+
+def get_section_tree(connection, force: bool = False) -> SectionTree:
+    """Дерево разделов через общий для процесса кэш"""
+    return _default_cache.get(connection, force=force)
+
+
+def invalidate_section_tree():
+    _default_cache.invalidate()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+SKU Sharding - распределение одного прогона синхронизации по нескольким узлам
+
+Артикулы раскладываются по N шардам кольцом консистентного хеширования
+(виртуальные узлы, md5), так что при смене N переезжает только часть
+артикулов. Узлы захватывают шарды через таблицу аренд: в MySQL Bitrix
+(несколько машин) или в общем SQLite-файле (несколько процессов на
+одной машине, локальная проверка). Аренда продлевается фоновым потоком;
+шард узла, переставшего продлевать аренду, после истечения срока
+забирает другой узел. Итоги шардов сохраняются в той же таблице и
+сводятся в один отчёт, CSV шардов объединяются в общий файл.
+
+Сроки аренды считаются по часам узлов - срок (SHARD_LEASE_TTL) должен
+заметно превышать возможное расхождение часов.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+SHARD_LEASE_TTL = int(os.getenv('SHARD_LEASE_TTL', 300))
+SHARD_LEASE_STORE = os.getenv('SHARD_LEASE_STORE', f"sqlite:{Path('cache') / 'shard_leases.db'}")
+SHARD_VNODES = 256
+# Попыток обработки шарда до статуса failed и пауза перед повтором (на номер попытки), сек
+SHARD_MAX_ATTEMPTS = int(os.getenv('SHARD_MAX_ATTEMPTS', 3))
+SHARD_RETRY_BACKOFF = int(os.getenv('SHARD_RETRY_BACKOFF', 60))
+
+LEASE_TABLE = 'saturn_sync_shards'
+
+FREE = 'free'
+LEASED = 'leased'
+DONE = 'done'
+# Шард не обработан за SHARD_MAX_ATTEMPTS попыток - больше не выдаётся в этом прогоне
+FAILED = 'failed'
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS {LEASE_TABLE} (
+    run_key VARCHAR(64) NOT NULL,
+    shard INT NOT NULL,
+    owner VARCHAR(128),
+    status VARCHAR(16) NOT NULL,
+    lease_until BIGINT NOT NULL DEFAULT 0,
+    attempts INT NOT NULL DEFAULT 0,
+    stats TEXT,
+    PRIMARY KEY (run_key, shard)
+)
+"""
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class ShardRing:
+    """Кольцо консистентного хеширования артикулов по шардам"""
+
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES):
+        if shards < 1:
+            raise ValueError("Число шардов должно быть положительным")
+        self.shards = shards
+        points = sorted((_hash(f"shard-{shard}-{vnode}"), shard) for shard in range(shards) for vnode in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_of(self, sku: str) -> int:
+        index = bisect_right(self._hashes, _hash(sku)) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardLease(NamedTuple):
+    shard: int
+    owner: Optional[str]
+    status: str
+    lease_until: int
+    attempts: int
+    stats: Dict
+
+
+class ShardLeaseStore:
+    """Таблица аренд шардов; захват и продление - условный UPDATE с проверкой rowcount"""
+
+    placeholder = '%s'
+    insert_ignore = 'INSERT IGNORE'
+
+    def _execute(self, query: str, params=()) -> int:
+        raise NotImplementedError
+
+    def _query(self, query: str, params=()) -> List[tuple]:
+        raise NotImplementedError
+
+    def _sql(self, query: str) -> str:
+        return query.replace('%s', self.placeholder)
+
+    def init_run(self, run_key: str, shards: int):
+        for shard in range(shards):
+            self._execute(f"""
+            {self.insert_ignore} INTO {LEASE_TABLE} (run_key, shard, status, lease_until, attempts)
+            VALUES (%s, %s, '{FREE}', 0, 0)
+            """, (run_key, shard))
+
+    def claim(self, run_key: str, owner: str, ttl: int = SHARD_LEASE_TTL,
+              exclude: Iterable[int] = ()) -> Optional[int]:
+        """Захват свободного шарда или шарда с истёкшей арендой; None - брать нечего
+
+        Свободный шард после неудачной попытки выдаётся не раньше lease_until (пауза
+        перед повтором); exclude - шарды, которые узел уже не смог обработать.
+        """
+        now = int(time.time())
+        exclude = set(exclude)
+        candidates = self._query(f"""
+        SELECT shard, status, owner FROM {LEASE_TABLE}
+        WHERE run_key = %s AND status IN ('{FREE}', '{LEASED}') AND lease_until < %s
+        ORDER BY status, shard
+        """, (run_key, now))
+
+        for shard, status, previous_owner in candidates:
+            if shard in exclude:
+                continue
+            claimed = self._execute(f"""
+            UPDATE {LEASE_TABLE} SET owner = %s, status = '{LEASED}', lease_until = %s, attempts = attempts + 1
+            WHERE run_key = %s AND shard = %s AND status IN ('{FREE}', '{LEASED}') AND lease_until < %s
+            """, (owner, now + ttl, run_key, shard, now))
+            if claimed == 1:
+                if status == LEASED:
+                    logger.warning(f"Шард {shard} забран у {previous_owner}: аренда истекла")
+                logger.info(f"Узел {owner} взял шард {shard}")
+                return shard
+        return None
+
+    def renew(self, run_key: str, shard: int, owner: str, ttl: int = SHARD_LEASE_TTL) -> bool:
+        return self._execute(f"""
+        UPDATE {LEASE_TABLE} SET lease_until = %s
+        WHERE run_key = %s AND shard = %s AND owner = %s AND status = '{LEASED}'
+        """, (int(time.time()) + ttl, run_key, shard, owner)) == 1
+
+    def complete(self, run_key: str, shard: int, owner: str, stats: Dict) -> bool:
+        return self._execute(f"""
+        UPDATE {LEASE_TABLE} SET status = '{DONE}', lease_until = 0, stats = %s
+        WHERE run_key = %s AND shard = %s AND owner = %s AND status = '{LEASED}'
+        """, (json.dumps(stats), run_key, shard, owner)) == 1
+
+    def release(self, run_key: str, shard: int, owner: str) -> bool:
+        """Досрочное освобождение шарда при остановке - его сразу возьмёт другой узел"""
+        return self._execute(f"""
+        UPDATE {LEASE_TABLE} SET status = '{FREE}', owner = NULL, lease_until = 0
+        WHERE run_key = %s AND shard = %s AND owner = %s AND status = '{LEASED}'
+        """, (run_key, shard, owner)) == 1
+
+    def fail(self, run_key: str, shard: int, owner: str, max_attempts: int = SHARD_MAX_ATTEMPTS,
+             backoff: int = SHARD_RETRY_BACKOFF) -> bool:
+        """Неудачная попытка: повтор через backoff * попыток, после max_attempts попыток - failed"""
+        return self._execute(f"""
+        UPDATE {LEASE_TABLE} SET
+            status = CASE WHEN attempts >= %s THEN '{FAILED}' ELSE '{FREE}' END,
+            owner = CASE WHEN attempts >= %s THEN owner ELSE NULL END,
+            lease_until = CASE WHEN attempts >= %s THEN 0 ELSE %s + attempts * %s END
+        WHERE run_key = %s AND shard = %s AND owner = %s AND status = '{LEASED}'
+        """, (max_attempts, max_attempts, max_attempts, int(time.time()), backoff, run_key, shard, owner)) == 1
+
+    def leases(self, run_key: str) -> List[ShardLease]:
+        rows = self._query(f"""
+        SELECT shard, owner, status, lease_until, attempts, stats FROM {LEASE_TABLE}
+        WHERE run_key = %s ORDER BY shard
+        """, (run_key,))
+        return [ShardLease(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]) if row[5] else {})
+                for row in rows]
+
+    def merged_stats(self, run_key: str) -> Dict:
+        """Сводка прогона: суммы счётчиков по завершённым шардам"""
+        leases = self.leases(run_key)
+        merged: Dict = {'shards': len(leases), 'done': sum(1 for lease in leases if lease.status == DONE),
+                        'failed': sum(1 for lease in leases if lease.status == FAILED)}
+        for lease in leases:
+            for key, value in lease.stats.items():
+                if isinstance(value, (int, float)):
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class SqliteLeaseStore(ShardLeaseStore):
+    """Аренды в общем SQLite-файле (процессы одной машины, локальная проверка)"""
+
+    placeholder = '?'
+    insert_ignore = 'INSERT OR IGNORE'
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def _execute(self, query: str, params=()) -> int:
+        with self.lock:
+            cursor = self.connection.execute(self._sql(query), params)
+            self.connection.commit()
+            return cursor.rowcount
+
+    def _query(self, query: str, params=()) -> List[tuple]:
+        with self.lock:
+            return self.connection.execute(self._sql(query), params).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class MySqlLeaseStore(ShardLeaseStore):
+    """Аренды в таблице базы Bitrix (узлы на разных машинах)"""
+
+    def __init__(self, config):
+        from db_pool import DbPoolConfig, get_pool
+        self.pool = get_pool(DbPoolConfig.from_bitrix_config(config))
+        self._execute(SCHEMA)
+
+    def _execute(self, query: str, params=()) -> int:
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, params)
+                connection.commit()
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    def _query(self, query: str, params=()) -> List[tuple]:
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def close(self):
+        pass
+
+
+def open_lease_store(spec: str = SHARD_LEASE_STORE, config=None) -> ShardLeaseStore:
+    """Хранилище аренд по строке вида 'mysql' или 'sqlite:/path/to/file.db'"""
+    if spec == 'mysql':
+        if config is None:
+            raise ValueError("Для аренд в MySQL нужна конфигурация Bitrix")
+        return MySqlLeaseStore(config)
+    if spec.startswith('sqlite:'):
+        return SqliteLeaseStore(Path(spec[len('sqlite:'):]))
+    raise ValueError(f"Неизвестное хранилище аренд: {spec}")
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseKeeper:
+    """Фоновое продление аренды шарда на время его обработки"""
+
+    def __init__(self, store: ShardLeaseStore, run_key: str, shard: int, owner: str, ttl: int = SHARD_LEASE_TTL):
+        self.store = store
+        self.run_key = run_key
+        self.shard = shard
+        self.owner = owner
+        self.ttl = ttl
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f"lease-shard-{self.shard}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(max(1.0, self.ttl / 3)):
+            try:
+                renewed = self.store.renew(self.run_key, self.shard, self.owner, self.ttl)
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды шарда {self.shard}: {e}")
+                continue
+            if not renewed:
+                logger.error(f"Аренда шарда {self.shard} потеряна, обработка шарда прекращается")
+                self.lost.set()
+                return
+
+    def guard(self, items: Iterable) -> Iterator:
+        """Выдача элементов, пока аренда за узлом"""
+        for item in items:
+            if self.lost.is_set():
+                return
+            yield item
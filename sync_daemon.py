@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Sync Daemon - долгоживущий процесс синхронизации Saturn → Bitrix
+
+Вместо холодного запуска на каждый прогон (импорт bs4/mysql, новые
+HTTP-сессии и соединения, загрузка правил и метаданных) один процесс
+держит всё тёплым между прогонами: пулы соединений MySQL, кэши
+метаданных, правил и дерева разделов, HTTP-сессии парсеров, открытые
+журнал и историю цен. Прогоны запускаются по интервалу или, в
+адаптивном режиме, к ближайшему сроку проверки по расписанию.
+
+SIGHUP - перечитать конфигурацию перед следующим прогоном,
+SIGTERM/SIGINT - перестать выдавать новые артикулы, дописать начатое
+и выйти (недоделанное продолжится по журналу при следующем старте).
+Прогон с ошибками продолжается по журналу не больше SYNC_DAEMON_MAX_RESUMES
+раз подряд, затем начинается новый - иначе артикулы, записанные в
+застрявшем прогоне, больше не обновлялись бы.
+"""
+
+import os
+import time
+import signal
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DAEMON_INTERVAL_MINUTES = float(os.getenv('SYNC_DAEMON_INTERVAL_MINUTES', 60))
+# Минимальная пауза между прогонами, чтобы не крутиться вхолостую
+DAEMON_MIN_SLEEP_SECONDS = 60
+# Сколько раз подряд продолжать по журналу незавершённый прогон
+DAEMON_MAX_RESUMES = int(os.getenv('SYNC_DAEMON_MAX_RESUMES', 2))
+
+
+class SyncDaemon:
+    """Цикл прогонов FullSyncManager с обработкой сигналов"""
+
+    def __init__(self, manager, mode: str = 'stream', interval_minutes: Optional[float] = None,
+                 run_kwargs: Optional[Dict] = None, max_resumes: int = DAEMON_MAX_RESUMES):
+        self.manager = manager
+        self.mode = mode
+        self.interval = (interval_minutes if interval_minutes is not None else DAEMON_INTERVAL_MINUTES) * 60
+        self.run_kwargs = run_kwargs or {}
+        self.stop_event = manager.stop_event
+        self.reload_requested = False
+        self.cycles = 0
+        self.failed_cycles = 0
+        self.max_resumes = max_resumes
+        # Первый прогон продолжает прерванный прошлым запуском демона
+        self.resume_next = True
+        self.resumes = 0
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._on_reload)
+
+    def _on_stop(self, signum, frame):
+        if self.stop_event.is_set():
+            return
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}: завершаем после текущих артикулов")
+        self.stop_event.set()
+
+    def _on_reload(self, signum, frame):
+        logger.info("Получен SIGHUP: конфигурация будет перечитана перед следующим прогоном")
+        self.reload_requested = True
+
+    def run(self) -> int:
+        self.install_signal_handlers()
+        logger.info(f"🚀 Демон синхронизации запущен (режим {self.mode}, "
+                    f"{'по расписанию' if self.manager.adaptive else f'интервал {self.interval / 60:g} мин'})")
+
+        try:
+            while not self.stop_event.is_set():
+                if self.reload_requested:
+                    self.reload_requested = False
+                    try:
+                        self.manager.reload_config()
+                    except Exception as e:
+                        logger.error(f"Ошибка перечитывания конфигурации, работаем со старой: {e}")
+
+                self.run_cycle()
+                if self.stop_event.is_set():
+                    break
+
+                sleep = self.next_sleep()
+                logger.info(f"Следующий прогон через {sleep / 60:.1f} мин")
+                self.stop_event.wait(sleep)
+        finally:
+            self.shutdown()
+
+        logger.info(f"Демон остановлен: прогонов {self.cycles}, с ошибками {self.failed_cycles}")
+        return 0
+
+    def run_cycle(self) -> bool:
+        self.cycles += 1
+        start = time.monotonic()
+        logger.info(f"=== Прогон #{self.cycles} ===")
+        resume = self.resume_next and self.resumes < self.max_resumes
+        if self.resume_next and not resume:
+            logger.warning(f"Прогон продолжался по журналу {self.resumes} раз подряд, начинаем новый")
+        self.resumes = self.resumes + 1 if resume else 0
+        try:
+            # Прогон, прерванный сбоем или остановкой, продолжается по журналу
+            success = self.manager.run(self.mode, resume=resume, **self.run_kwargs)
+        except Exception as e:
+            logger.error(f"Прогон #{self.cycles} завершился исключением: {e}")
+            success = False
+
+        self.resume_next = not success
+        if success:
+            self.resumes = 0
+        else:
+            self.failed_cycles += 1
+        logger.info(f"Прогон #{self.cycles} {'завершен' if success else 'с ошибками'} "
+                    f"за {time.monotonic() - start:.1f}с")
+        return success
+
+    def next_sleep(self) -> float:
+        """Пауза до следующего прогона: интервал или, по расписанию, до ближайшего срока"""
+        if not self.manager.adaptive:
+            return self.interval
+        earliest = self.manager.scheduler.earliest_due()
+        if earliest is None:
+            return self.interval
+        return min(self.interval, max(DAEMON_MIN_SLEEP_SECONDS, earliest - time.time()))
+
+    def shutdown(self):
+        from db_pool import close_all_pools
+        try:
+            self.manager.history.close()
+        finally:
+            close_all_pools()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Sync Journal - журнал прогона синхронизации для продолжения после сбоя
+
+Каждое изменение состояния артикула (pending → scraped → written или
+failed) дописывается событием в SQLite в режиме WAL. События копятся в
+памяти и пишутся пачками; при падении теряется не больше одной пачки.
+--resume продолжает последний незавершённый прогон: записанные артикулы
+пропускаются, уже спарсенные цены сразу уходят в запись без повторного
+запроса к Saturn. По завершении прогона журнал обрезается до
+SYNC_JOURNAL_KEEP_RUNS последних прогонов, чтобы демон не копил события.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_FILE = Path(os.getenv('SYNC_JOURNAL_FILE', Path("cache") / "sync_journal.db"))
+# Прогон старше этого не продолжается: спарсенные в нём цены уже устарели
+RESUME_MAX_AGE_HOURS = float(os.getenv('SYNC_RESUME_MAX_AGE_HOURS', 24))
+# Сколько последних прогонов хранить в журнале (0 - хранить все)
+KEEP_RUNS = int(os.getenv('SYNC_JOURNAL_KEEP_RUNS', 20))
+
+PENDING = 'pending'
+SCRAPED = 'scraped'
+WRITTEN = 'written'
+FAILED = 'failed'
+
+# Причина failed, при которой артикул не перепарсивается при продолжении
+# (остальные failed - не найден на Saturn или ошибка запроса - повторяются)
+NOT_IN_BITRIX = 'not_in_bitrix'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    sku TEXT NOT NULL,
+    state TEXT NOT NULL,
+    price REAL,
+    name TEXT,
+    availability TEXT,
+    url TEXT,
+    error TEXT,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_events_run_sku ON events (run_id, sku, id);
+"""
+
+
+@dataclass
+class JournalEntry:
+    """Последнее состояние артикула в прогоне"""
+    sku: str
+    state: str
+    price: Optional[float] = None
+    name: Optional[str] = None
+    availability: Optional[str] = None
+    url: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state == WRITTEN or (self.state == FAILED and self.error == NOT_IN_BITRIX)
+
+
+class SyncJournal:
+    """Журнал состояний артикулов с пакетной записью событий"""
+
+    def __init__(self, path: Path = DEFAULT_JOURNAL_FILE, batch_size: int = 500, flush_interval: float = 2.0,
+                 keep_runs: int = KEEP_RUNS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keep_runs = keep_runs
+
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        self.lock = threading.Lock()
+        self.run_id: Optional[int] = None
+        self._buffer: List[Tuple] = []
+        self._flushed_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start_run(self, mode: str) -> int:
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (mode, status, started_at) VALUES (?, 'running', ?)",
+                (mode, datetime.now().isoformat())
+            )
+            self.connection.commit()
+            self.run_id = cursor.lastrowid
+        logger.info(f"Журнал синхронизации: прогон #{self.run_id} ({self.path})")
+        return self.run_id
+
+    def resume_run(self, mode: Optional[str] = None,
+                   max_age_hours: float = RESUME_MAX_AGE_HOURS) -> Optional[int]:
+        """Продолжение последнего прогона, если он не завершён (None - продолжать нечего)
+
+        Незавершённым считается прерванный (running) или упавший (failed) прогон.
+        Более старые прогоны не продолжаются, даже если после них был
+        завершённый: их цены перезаписали бы свежие. Прогон старше
+        max_age_hours тоже не продолжается.
+        """
+        query = "SELECT id, status, started_at FROM runs"
+        params: Tuple = ()
+        if mode:
+            query += " WHERE mode = ?"
+            params = (mode,)
+        with self.lock:
+            row = self.connection.execute(query + " ORDER BY id DESC LIMIT 1", params).fetchone()
+            if not row or row[1] == 'completed':
+                return None
+            age_hours = (datetime.now() - datetime.fromisoformat(row[2])).total_seconds() / 3600
+            if age_hours > max_age_hours:
+                logger.warning(f"Прогон #{row[0]} начат {age_hours:.1f} ч назад (дольше {max_age_hours:g} ч), "
+                               f"не продолжаем")
+                return None
+            self.run_id = row[0]
+            self.connection.execute("UPDATE runs SET status = 'running', finished_at = NULL WHERE id = ?", (self.run_id,))
+            self.connection.commit()
+        logger.info(f"Продолжаем прогон #{self.run_id} из журнала {self.path}")
+        return self.run_id
+
+    def record(self, sku: str, state: str, price: Optional[float] = None, name: Optional[str] = None,
+               availability: Optional[str] = None, url: Optional[str] = None, error: Optional[str] = None):
+        """Событие состояния артикула (пишется в БД пачкой)"""
+        self.record_many([(sku, state, price, name, availability, url, error)])
+
+    def record_many(self, events: Iterable[Tuple]):
+        if self.run_id is None:
+            return
+        now = time.time()
+        with self.lock:
+            self._buffer.extend((self.run_id, *event, now) for event in events)
+            if (len(self._buffer) >= self.batch_size
+                    or time.monotonic() - self._flushed_at >= self.flush_interval):
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._flushed_at = time.monotonic()
+        if not self._buffer:
+            return
+        try:
+            self.connection.executemany("""
+            INSERT INTO events (run_id, sku, state, price, name, availability, url, error, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, self._buffer)
+            self.connection.commit()
+            self._buffer = []
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи журнала синхронизации: {e}")
+
+    def entries(self, run_id: Optional[int] = None) -> Dict[str, JournalEntry]:
+        """Последнее состояние каждого артикула прогона"""
+        self.flush()
+        run_id = run_id or self.run_id
+        with self.lock:
+            rows = self.connection.execute("""
+            SELECT sku, state, price, name, availability, url, error FROM events
+            WHERE id IN (SELECT MAX(id) FROM events WHERE run_id = ? GROUP BY sku)
+            """, (run_id,)).fetchall()
+        return {row[0]: JournalEntry(*row) for row in rows}
+
+    def plan(self, skus: Iterable[str]) -> Tuple[List[str], List[JournalEntry]]:
+        """Разделение артикулов прогона: что парсить и какие спарсенные цены дописать"""
+        entries = self.entries()
+        to_parse, scraped = [], []
+        skipped = 0
+        for sku in skus:
+            entry = entries.get(sku)
+            if entry is None or (entry.state in (PENDING, FAILED) and not entry.done):
+                to_parse.append(sku)
+            elif entry.state == SCRAPED:
+                scraped.append(entry)
+            else:
+                skipped += 1
+        logger.info(f"Журнал: пропущено готовых {skipped}, к записи без парсинга {len(scraped)}, "
+                    f"к парсингу {len(to_parse)}")
+        return to_parse, scraped
+
+    def finish_run(self, status: str = 'completed'):
+        if self.run_id is None:
+            return
+        with self.lock:
+            self._flush_locked()
+            self.connection.execute(
+                "UPDATE runs SET status = ?, finished_at = ? WHERE id = ?",
+                (status, datetime.now().isoformat(), self.run_id)
+            )
+            self.connection.commit()
+            self._prune_locked()
+        logger.info(f"Прогон #{self.run_id} завершен: {status}")
+
+    def _prune_locked(self):
+        """Удаление прогонов (и их событий) старше keep_runs последних
+
+        Текущий прогон не удаляется, даже если он продолжен и уже не среди
+        последних.
+        """
+        if self.keep_runs <= 0:
+            return
+        row = self.connection.execute(
+            "SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?", (self.keep_runs,)
+        ).fetchone()
+        if not row:
+            return
+        try:
+            stale = "SELECT id FROM runs WHERE id <= ? AND id != ?"
+            params = (row[0], self.run_id)
+            deleted = self.connection.execute(
+                f"DELETE FROM events WHERE run_id IN ({stale})", params).rowcount
+            runs = self.connection.execute(f"DELETE FROM runs WHERE id IN ({stale})", params).rowcount
+            self.connection.commit()
+            logger.info(f"Журнал: удалено старых прогонов {runs}, событий {deleted}")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка очистки журнала синхронизации: {e}")
+
+    def close(self):
+        with self.lock:
+            self._flush_locked()
+            self.connection.close()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Sync Pipeline - потоковая синхронизация Saturn → Bitrix
+
+Артикулы читаются из Bitrix потоком и сразу уходят в парсинг, результаты
+парсинга через ограниченную очередь попадают на стадию наценки, оттуда -
+в PriceWriter (ограниченная очередь + потоки записи в БД). Первые цены
+появляются в Bitrix через секунды после старта, общее время близко к
+max(парсинг, запись), а не к их сумме. CSV пишутся попутно и не обязательны.
+"""
+
+import csv
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from bitrix_integration import BitrixClient, BitrixConfig, BitrixProduct, MarkupProcessor
+from db_pool import DbPoolConfig
+from metrics import QUEUE_DEPTH, SKUS_TOTAL
+from price_history import PriceHistory
+from price_writer import MarkedUpPrice, PriceWriter, PriceWriterStats
+from run_budget import RUN_BUDGET_MAX_WORKERS, ConcurrencyController, RunBudget
+from sync_journal import FAILED, PENDING, SCRAPED, WRITTEN, SyncJournal
+from tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Потребитель ленты изменений истории цен - запись в Bitrix
+BITRIX_FEED = 'bitrix'
+
+# Сколько результатов стадия наценки забирает из очереди за раз (одна транзакция истории)
+MARKUP_BATCH_SIZE = 200
+
+# Как часто ожидающий место в очереди наценки проверяет, жива ли стадия наценки
+MARKUP_PUT_TIMEOUT = 1.0
+
+# Соединения пула, занятые прогоном помимо потоков записи: чтение артикулов и стадия наценки
+PIPELINE_CONNECTIONS = 2
+
+RAW_CSV_FIELDS = ['sku', 'name', 'price', 'availability', 'url']
+PROCESSED_CSV_FIELDS = ['sku', 'name', 'original_price', 'markup_percent', 'final_price', 'section_id', 'updated_at']
+
+
+@dataclass
+class PipelineStats:
+    skus: int = 0
+    parsed: int = 0
+    not_found: int = 0
+    parse_errors: int = 0
+    marked_up: int = 0
+    resumed: int = 0
+    unchanged: int = 0
+    shed: int = 0
+    # Пачки результатов, не попавшие в историю цен
+    history_errors: int = 0
+    elapsed: float = 0.0
+    first_write_after: Optional[float] = None
+    writer: Optional[PriceWriterStats] = None
+
+    def __str__(self) -> str:
+        first = f"{self.first_write_after:.1f}с" if self.first_write_after is not None else "-"
+        return (f"артикулов {self.skus}, спарсено {self.parsed}, не найдено {self.not_found}, "
+                f"ошибок парсинга {self.parse_errors}, с наценкой {self.marked_up}, "
+                f"из журнала {self.resumed}, без изменений {self.unchanged}, отброшено к сроку {self.shed}, "
+                f"ошибок истории {self.history_errors}, "
+                f"первая запись через {first}, всего {self.elapsed:.1f}с")
+
+
+class SyncPipeline:
+    """Конвейер парсинг → наценка → запись в Bitrix на ограниченных очередях"""
+
+    def __init__(self, config: BitrixConfig, parse_func: Callable, parse_workers: int = 10,
+                 queue_size: int = 1000, db_writers: int = 1,
+                 raw_csv: Optional[str] = None, processed_csv: Optional[str] = None,
+                 journal: Optional[SyncJournal] = None, history: Optional[PriceHistory] = None,
+                 changes_only: bool = False, budget: Optional[RunBudget] = None,
+                 max_parse_workers: int = RUN_BUDGET_MAX_WORKERS):
+        self.config = config
+        self.parse_func = parse_func
+        self.parse_workers = max(1, parse_workers)
+        self.queue_size = queue_size
+        self.db_writers = db_writers
+        check_pool_size(config, db_writers)
+        self.raw_csv = raw_csv
+        self.processed_csv = processed_csv
+        self.journal = journal
+        self.history = history
+        # Только изменения: пропускаются артикулы, чья последняя точка истории
+        # уже доставлена в Bitrix (не новее курсора ленты BITRIX_FEED)
+        self.changes_only = changes_only and history is not None
+        self.delivered_until = 0
+        # Срок прогона: параллельность парсинга наращивается до max_parse_workers,
+        # если прогноз не укладывается; к сроку выдача артикулов прекращается
+        self.budget = budget
+        self.controller = ConcurrencyController(budget, self.parse_workers, max_parse_workers) if budget else None
+
+        self.markup_queue = queue.Queue(maxsize=queue_size)
+        # Стадия наценки упала: очередь больше никто не разбирает
+        self.markup_failed = threading.Event()
+        self.markup_error: Optional[BaseException] = None
+        self.stats = PipelineStats()
+        self.lock = threading.Lock()
+
+    def run(self, items: Iterable[Tuple[str, Optional[BitrixProduct]]]) -> PipelineStats:
+        """Прогон конвейера по парам (артикул Saturn, товар Bitrix или None)"""
+        start = time.monotonic()
+        if self.changes_only:
+            self.delivered_until = self.history.feed(BITRIX_FEED).cursor
+        writer = PriceWriter(self.config, workers=self.db_writers, queue_size=self.queue_size, journal=self.journal)
+        writer.start()
+
+        markup_thread = threading.Thread(target=self._run_markup, args=(writer,), name="sync-markup", daemon=True)
+        markup_thread.start()
+
+        try:
+            self._parse_stage(items)
+        finally:
+            while markup_thread.is_alive():
+                try:
+                    self.markup_queue.put(_STOP, timeout=MARKUP_PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+            markup_thread.join()
+            self.stats.writer = writer.close()
+        if self.markup_error is not None:
+            raise RuntimeError(f"Стадия наценки остановилась с ошибкой: {self.markup_error}") from self.markup_error
+
+        self.stats.elapsed = time.monotonic() - start
+        if self.stats.writer.first_written_at is not None:
+            self.stats.first_write_after = self.stats.writer.first_written_at - start
+        logger.info(f"Потоковая синхронизация: {self.stats}")
+        logger.info(f"Запись цен: {self.stats.writer}")
+        return self.stats
+
+    def _parse_stage(self, items: Iterable[Tuple[str, Optional[BitrixProduct]]]):
+        # Число задач в полёте ограничено, чтобы не вычитывать весь список артикулов заранее
+        max_in_flight = self.parse_workers * 2
+        in_flight = set()
+        # При продолжении прогона: готовые артикулы пропускаются, спарсенные
+        # идут сразу на наценку с ценой из журнала
+        entries = self.journal.entries() if self.journal else {}
+
+        pool_size = self.controller.maximum if self.controller else self.parse_workers
+        with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='sync-parse') as executor:
+            for sku, product in items:
+                if self.budget is not None:
+                    if self.budget.expired():
+                        self.stats.shed = self.budget.total - self.stats.skus
+                        logger.warning(f"Срок прогона: отброшено артикулов с наименьшим приоритетом {self.stats.shed}")
+                        break
+                    # Параллельность задаётся числом задач в полёте, пул создан на максимум
+                    max_in_flight = self.controller.checkpoint(self._completed())
+                self.stats.skus += 1
+                entry = entries.get(sku)
+                if entry is not None and entry.done:
+                    continue
+                if entry is not None and entry.state == SCRAPED:
+                    self.stats.resumed += 1
+                    self._put_markup((product, entry))
+                    continue
+
+                if self.journal:
+                    self.journal.record(sku, PENDING)
+                while len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._on_parsed(future)
+                in_flight.add(executor.submit(self._parse_one, sku, product))
+
+                if self.stats.skus % 500 == 0:
+                    logger.info(f"Прогресс: артикулов {self.stats.skus}, спарсено {self.stats.parsed}")
+
+            for future in in_flight:
+                self._on_parsed(future)
+
+    def _completed(self) -> int:
+        return self.stats.parsed + self.stats.not_found + self.stats.parse_errors + self.stats.resumed
+
+    def _parse_one(self, sku: str, product: Optional[BitrixProduct]):
+        try:
+            with TRACER.activate(sku), TRACER.span('parse'):
+                return sku, product, self.parse_func(sku), None
+        except Exception as e:
+            return sku, product, None, e
+
+    def _on_parsed(self, future):
+        sku, product, result, error = future.result()
+        if error is not None:
+            self.stats.parse_errors += 1
+            SKUS_TOTAL.inc(result='error')
+            logger.error(f"Ошибка парсинга {sku}: {error}")
+            if self.journal:
+                self.journal.record(sku, FAILED, error=str(error))
+            return
+
+        if result is None:
+            self.stats.not_found += 1
+            SKUS_TOTAL.inc(result='not_found')
+            logger.warning(f"Не найден {sku}")
+            if self.journal:
+                self.journal.record(sku, FAILED, error="не найден")
+            return
+
+        self.stats.parsed += 1
+        SKUS_TOTAL.inc(result='found')
+        if self.journal:
+            self.journal.record(sku, SCRAPED, result.price, result.name, result.availability, result.url)
+        # Блокируется при заполненной очереди наценки (backpressure до парсеров)
+        self._put_markup((product, result))
+
+    def _put_markup(self, item):
+        """Постановка в очередь наценки; упавшая стадия наценки прерывает ожидание ошибкой"""
+        while True:
+            if self.markup_failed.is_set():
+                raise RuntimeError(f"Стадия наценки остановилась с ошибкой: {self.markup_error}")
+            try:
+                self.markup_queue.put(item, timeout=MARKUP_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def _run_markup(self, writer: PriceWriter):
+        try:
+            self._markup_stage(writer)
+        except Exception as e:
+            logger.error(f"Стадия наценки остановилась с ошибкой: {e}")
+            self.markup_error = e
+            self.markup_failed.set()
+
+    def _markup_stage(self, writer: PriceWriter):
+        client = BitrixClient(self.config)
+        connected = client.connect()
+        if not connected:
+            logger.error("Стадия наценки не смогла подключиться к Bitrix, наценка будет применена при записи")
+        markup_processor = MarkupProcessor(client)
+
+        raw_file = raw_writer = processed_file = processed_writer = None
+        try:
+            if self.raw_csv:
+                raw_file, raw_writer = _open_csv(self.raw_csv, RAW_CSV_FIELDS)
+            if self.processed_csv:
+                processed_file, processed_writer = _open_csv(self.processed_csv, PROCESSED_CSV_FIELDS)
+
+            stopped = False
+            while not stopped:
+                batch, stopped = self._next_batch()
+                point_ids = self._record_history(batch)
+
+                for product, result in batch:
+                    if raw_writer:
+                        raw_writer.writerow([result.sku, result.name, result.price, result.availability, result.url])
+
+                    if self.changes_only and point_ids.get(result.sku, self.delivered_until + 1) <= self.delivered_until:
+                        self.stats.unchanged += 1
+                        if self.journal:
+                            self.journal.record(result.sku, WRITTEN, result.price)
+                        continue
+
+                    if product is None or not connected:
+                        # Товар неизвестен (артикулы из файла) - поиск и наценка в PriceWriter
+                        writer.submit(result)
+                        continue
+
+                    try:
+                        with TRACER.span('markup', sku=result.sku):
+                            final_price, markup_percent = markup_processor.apply_markup(product, result.price)
+                    except Exception as e:
+                        logger.error(f"Ошибка наценки {result.sku}: {e}")
+                        writer.submit(result)
+                        continue
+
+                    self.stats.marked_up += 1
+                    writer.submit(MarkedUpPrice(product.id, result.sku, final_price))
+                    if processed_writer:
+                        processed_writer.writerow([
+                            product.article, product.name, result.price, markup_percent,
+                            final_price, product.section_id, datetime.now().isoformat()
+                        ])
+        finally:
+            for f in (raw_file, processed_file):
+                if f:
+                    f.close()
+            client.disconnect()
+
+    def _next_batch(self):
+        """Блокирующее ожидание одного результата и всё, что уже есть в очереди"""
+        batch = []
+        item = self.markup_queue.get()
+        QUEUE_DEPTH.set(self.markup_queue.qsize() + 1, queue='markup')
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= MARKUP_BATCH_SIZE:
+                return batch, False
+            try:
+                item = self.markup_queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _record_history(self, batch) -> dict:
+        if not self.history or not batch:
+            return {}
+        try:
+            return self.history.record(result for _, result in batch)
+        except Exception as e:
+            # Запись в Bitrix продолжается, но прогон считается неуспешным
+            logger.error(f"Ошибка записи истории цен: {e}")
+            self.stats.history_errors += 1
+            return {}
+
+
+def check_pool_size(config: BitrixConfig, db_writers: int):
+    """Весь прогон держит соединения чтения, наценки и каждого потока записи
+
+    При меньшем пуле поток записи ждёт соединение до таймаута пула и прогон
+    падает - лучше сразу остановиться с понятной ошибкой.
+    """
+    pool_size = DbPoolConfig.from_bitrix_config(config).pool_size
+    required = PIPELINE_CONNECTIONS + max(1, db_writers)
+    if pool_size < required:
+        raise ValueError(f"Пулу соединений MySQL не хватает соединений: нужно {required} "
+                         f"(чтение артикулов, наценка и {max(1, db_writers)} потоков записи), "
+                         f"BITRIX_MYSQL_POOL_SIZE={pool_size}. Увеличьте BITRIX_MYSQL_POOL_SIZE "
+                         f"или уменьшите --db-writers")
+
+
+def _open_csv(path: str, fields):
+    output_path = Path(path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(output_path, 'w', newline='', encoding='utf-8')
+    writer = csv.writer(f, delimiter=';')
+    writer.writerow(fields)
+    return f, writer
+
+
+def iter_bitrix_skus(config: BitrixConfig, limit: Optional[int] = None) -> Iterator[Tuple[str, BitrixProduct]]:
+    """Товары Saturn из Bitrix потоком: (артикул без префикса, товар)"""
+    client = BitrixClient(config)
+    if not client.connect():
+        raise RuntimeError("Не удалось подключиться к Bitrix")
+
+    count = 0
+    try:
+        for chunk in client.iter_products_by_prefix():
+            for row in chunk:
+                if limit is not None and count >= limit:
+                    return
+                product = BitrixProduct(id=row.id, name=row.name, article=row.article,
+                                        section_id=row.section_id, active=True)
+                yield row.article.replace(config.supplier_prefix, ''), product
+                count += 1
+    finally:
+        client.disconnect()
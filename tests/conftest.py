@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Модули проекта лежат в корне репозитория, бенчмарки - в benchmarks/
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT, ROOT / 'benchmarks'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,23 @@
+from bench_underprice_matrix import ARTICLE_PROPERTY_ID, IBLOCK_ID, BenchConnection, build_catalog
+from bitrix_integration import BitrixClient, BitrixConfig
+
+
+def test_stream_yields_each_product_once_with_multiple_articles():
+    db = build_catalog(50, seed=1)
+    # Множественное свойство артикула: у части товаров по две-три строки значений
+    db.executemany("""
+    INSERT INTO b_iblock_element_property (IBLOCK_ELEMENT_ID, IBLOCK_PROPERTY_ID, VALUE) VALUES (?, ?, ?)
+    """, [(product_id, ARTICLE_PROPERTY_ID, f"ST-{product_id}-{n}")
+          for product_id in range(1, 51, 2) for n in range(1, 1 + product_id % 3)])
+
+    config = BitrixConfig('localhost', 3306, 'bitrix', 'user', 'password', iblock_id=IBLOCK_ID,
+                          supplier_prefix='ST-', article_property_id=ARTICLE_PROPERTY_ID)
+    client = BitrixClient(config)
+    client.connection = BenchConnection(db)
+    try:
+        rows = [row for chunk in client.iter_products_by_prefix(chunk_size=7) for row in chunk]
+    finally:
+        db.close()
+
+    assert [row.id for row in rows] == list(range(1, 51))
+    assert all(row.article == f"ST-{row.id}" for row in rows)
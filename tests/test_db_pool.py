@@ -0,0 +1,40 @@
+import pytest
+
+from db_pool import ConnectionPool, DbPoolConfig, PoolTimeoutError
+
+
+class FakeConnection:
+    in_transaction = False
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ConnectionPool, '_open', lambda self: FakeConnection())
+    return ConnectionPool(DbPoolConfig('localhost', 3306, 'bitrix', 'user', 'password', pool_size=3))
+
+
+def test_free_counts_checked_out_connections(pool):
+    assert pool.free == 3
+    first = pool.acquire()
+    with pool.connection():
+        assert pool.free == 1
+    assert pool.free == 2
+    pool.release(first)
+    assert pool.free == 3
+
+
+def test_acquire_times_out_when_exhausted(pool):
+    held = [pool.acquire() for _ in range(3)]
+    assert pool.free == 0
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire(timeout=0.01)
+    assert pool.free == 0
+    for connection in held:
+        pool.release(connection)
+    assert pool.free == 3
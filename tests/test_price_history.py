@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from price_history import PriceHistory
+
+
+def observation(sku, price, availability='в наличии', url=None):
+    return SimpleNamespace(sku=sku, price=price, availability=availability, url=url or f"https://example/{sku}")
+
+
+def test_record_stores_only_changes(tmp_path):
+    with PriceHistory(tmp_path / 'history.db') as history:
+        first = history.record([observation('a', 100.0), observation('b', 50.5)], ts=1000)
+        same = history.record([observation('a', 100.0), observation('b', 50.5)], ts=2000)
+        changed = history.record([observation('a', 120.0), observation('b', 50.5, 'нет в наличии')], ts=3000)
+
+        assert same == first
+        assert changed['a'] > first['a'] and changed['b'] > first['b']
+        assert history.max_id() == 4
+        latest = history.latest(['a', 'b', 'missing'])
+        assert set(latest) == {'a', 'b'}
+        assert (latest['a'].price, latest['a'].ts) == (120.0, 3000)
+        assert latest['b'].availability == 'нет в наличии'
+        # URL хранится только при смене, но в истории протянут во все точки
+        assert [(point.price, point.url) for point in history.history('a')] == [
+            (100.0, 'https://example/a'), (120.0, 'https://example/a')
+        ]
+
+
+def test_change_feed_pages_and_old_prices(tmp_path):
+    with PriceHistory(tmp_path / 'history.db') as history:
+        history.record([observation('a', 1.0), observation('b', 2.0)], ts=1000)
+        history.record([observation('a', 1.5)], ts=2000)
+        history.record([observation('b', 2.5)], ts=3000)
+
+        changes = list(history.iter_changes(page_size=1))
+        assert [(change.sku, change.old_price, change.price) for change in changes] == [
+            ('a', None, 1.0), ('b', None, 2.0), ('a', 1.0, 1.5), ('b', 2.0, 2.5)
+        ]
+        assert [change.sku for change in history.changed_since(2000)] == ['a', 'b']
+        assert [change.price for change in history.iter_changes(after_id=changes[2].id)] == [2.5]
+
+
+def test_feed_cursor_moves_only_on_commit(tmp_path):
+    path = tmp_path / 'history.db'
+    with PriceHistory(path) as history:
+        history.record([observation('a', 1.0), observation('b', 2.0)], ts=1000)
+        feed = history.feed('bitrix')
+        other = history.feed('report')
+
+        delivered = list(feed)
+        assert [change.sku for change in delivered] == ['a', 'b']
+        # Без commit() лента выдаёт те же изменения повторно
+        assert list(feed) == delivered
+        feed.commit(delivered[0].id)
+        assert feed.is_delivered(delivered[0].id) and not feed.is_delivered(delivered[1].id)
+        assert [change.sku for change in feed] == ['b']
+        # Курсоры потребителей независимы
+        assert len(list(other)) == 2
+
+    with PriceHistory(path) as history:
+        history.record([observation('a', 3.0)], ts=2000)
+        assert [(change.sku, change.price) for change in history.feed('bitrix')] == [('b', 2.0), ('a', 3.0)]
+
+
+def test_compact_keeps_baseline_and_latest_points(tmp_path):
+    day = 86400
+    with PriceHistory(tmp_path / 'history.db') as history:
+        history.record([observation('a', 1.0), observation('b', 5.0)], ts=1 * day)
+        history.record([observation('a', 2.0)], ts=2 * day)
+        history.record([observation('a', 3.0)], ts=10 * day)
+
+        assert history.compact(retention_days=5, now=12 * day) == 1
+        assert history.compact(retention_days=0, now=100 * day) == 0
+
+        # Точка до срока остаётся базой для old_price, URL перенесён в неё
+        assert [(point.price, point.url) for point in history.history('a')] == [
+            (2.0, 'https://example/a'), (3.0, 'https://example/a')
+        ]
+        changes = list(history.changed_since(5 * day))
+        assert [(change.sku, change.old_price, change.price) for change in changes] == [('a', 2.0, 3.0)]
+        assert history.latest(['b'])['b'].price == 5.0
+        assert [point.price for point in history.history('b')] == [5.0]
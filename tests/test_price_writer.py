@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+
+import pytest
+
+import price_writer
+from bitrix_integration import BitrixConfig, PriceWriteStats
+from price_writer import MarkedUpPrice, PriceWriter
+from sync_journal import SCRAPED, WRITTEN, SyncJournal
+
+CONFIG = BitrixConfig('localhost', 3306, 'bitrix', 'user', 'password', iblock_id=1)
+
+
+class FakeClient:
+    """BitrixClient без БД: запоминает пачки цен, может задерживать запись"""
+
+    def __init__(self, config, calls, gate=None, failed_ids=(), connected=True):
+        self.calls = calls
+        self.connected = connected
+        self.gate = gate
+        self.failed_ids = set(failed_ids)
+        self.writing = threading.Event()
+
+    def connect(self):
+        return self.connected
+
+    def disconnect(self):
+        pass
+
+    def write_prices(self, new_prices):
+        self.writing.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.calls.append(dict(new_prices))
+        stats = PriceWriteStats()
+        for product_id in new_prices:
+            if product_id in self.failed_ids:
+                stats.failed += 1
+                stats.failed_ids.append(product_id)
+            else:
+                stats.changed += 1
+                stats.written_ids.append(product_id)
+        return stats
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+def patch_client(monkeypatch, calls, **kwargs):
+    clients = []
+
+    def factory(config):
+        client = FakeClient(config, calls, **kwargs)
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(price_writer, 'BitrixClient', factory)
+    return clients
+
+
+def make_writer(**kwargs):
+    options = dict(workers=1, trigger_underprice=False, flush_interval=60)
+    options.update(kwargs)
+    return PriceWriter(CONFIG, **options)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_flush_on_full_batch(monkeypatch, calls):
+    patch_client(monkeypatch, calls)
+    writer = make_writer(batch_size=3)
+    writer.start()
+    try:
+        for product_id in range(1, 7):
+            writer.submit(MarkedUpPrice(product_id, f"sku-{product_id}", 100.0 + product_id))
+        # Интервал сброса велик - обе пачки уходят по размеру, не дожидаясь close()
+        assert wait_for(lambda: len(calls) == 2)
+    finally:
+        stats = writer.close()
+    assert calls == [{1: 101.0, 2: 102.0, 3: 103.0}, {4: 104.0, 5: 105.0, 6: 106.0}]
+    assert stats.batches == 2
+    assert stats.prices.written == 6
+
+
+def test_flush_on_interval(monkeypatch, calls):
+    patch_client(monkeypatch, calls)
+    writer = make_writer(batch_size=100, flush_interval=0.05)
+    writer.start()
+    try:
+        writer.submit(MarkedUpPrice(1, 'sku-1', 10.0))
+        assert wait_for(lambda: len(calls) == 1)
+    finally:
+        writer.close()
+    assert calls == [{1: 10.0}]
+
+
+def test_backpressure_blocks_submit(monkeypatch, calls):
+    gate = threading.Event()
+    clients = patch_client(monkeypatch, calls, gate=gate)
+    writer = make_writer(batch_size=1, queue_size=1)
+    writer.start()
+    try:
+        writer.submit(MarkedUpPrice(1, 'sku-1', 10.0))
+        assert wait_for(lambda: clients and clients[0].writing.is_set())
+        # Писатель занят первой пачкой, второй результат занимает всю очередь
+        writer.submit(MarkedUpPrice(2, 'sku-2', 20.0))
+        with pytest.raises(queue.Full):
+            writer.submit(MarkedUpPrice(3, 'sku-3', 30.0), timeout=0.05)
+    finally:
+        gate.set()
+        stats = writer.close()
+    assert calls == [{1: 10.0}, {2: 20.0}]
+    assert stats.submitted == 2
+
+
+def test_close_drains_queue(monkeypatch, calls):
+    patch_client(monkeypatch, calls)
+    writer = make_writer(workers=2, batch_size=10)
+    writer.start()
+    for product_id in range(1, 26):
+        writer.submit(MarkedUpPrice(product_id, f"sku-{product_id}", float(product_id)))
+    stats = writer.close()
+
+    written = {}
+    for call in calls:
+        written.update(call)
+    assert written == {product_id: float(product_id) for product_id in range(1, 26)}
+    assert stats.submitted == 25
+    assert stats.prices.written == 25
+    assert writer.threads == [] and not writer.started
+    # Повторный close() и submit() после остановки
+    assert writer.close() is stats
+    with pytest.raises(RuntimeError):
+        writer.submit(MarkedUpPrice(26, 'sku-26', 1.0))
+
+
+def test_failed_writes_stay_scraped(monkeypatch, calls, tmp_path):
+    patch_client(monkeypatch, calls, failed_ids={2})
+    with SyncJournal(tmp_path / 'journal.db') as journal:
+        journal.start_run('stream')
+        journal.record_many((f"sku-{product_id}", SCRAPED, 10.0, None, None, None, None) for product_id in (1, 2, 3))
+        writer = make_writer(batch_size=10, journal=journal)
+        writer.start()
+        for product_id in (1, 2, 3):
+            writer.submit(MarkedUpPrice(product_id, f"sku-{product_id}", 10.0))
+        stats = writer.close()
+        entries = journal.entries()
+
+    assert stats.prices.failed_ids == [2]
+    assert {sku: entry.state for sku, entry in entries.items()} == {
+        'sku-1': WRITTEN, 'sku-2': SCRAPED, 'sku-3': WRITTEN
+    }
+
+
+def test_connect_failure_stops_writer(monkeypatch, calls):
+    patch_client(monkeypatch, calls, connected=False)
+    writer = make_writer(queue_size=1)
+    writer.start()
+    assert writer.failed.wait(5)
+    # Очередь некому разбирать: submit не ждёт места, а сообщает об ошибке стадии
+    with pytest.raises(RuntimeError, match='записи цен'):
+        for product_id in range(3):
+            writer.submit(MarkedUpPrice(product_id, f"sku-{product_id}", 1.0))
+    with pytest.raises(RuntimeError, match='подключиться'):
+        writer.close()
+    assert calls == []
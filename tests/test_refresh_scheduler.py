@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+
+from price_history import PriceHistory
+from refresh_scheduler import HOUR, RefreshScheduler
+
+
+@pytest.fixture
+def history(tmp_path):
+    with PriceHistory(tmp_path / 'history.db') as history:
+        yield history
+
+
+def check(history, scheduler, ts, prices):
+    history.record([SimpleNamespace(sku=sku, price=price, availability='в наличии', url=None)
+                    for sku, price in prices.items()], ts=ts)
+    scheduler.update_checked_since(ts)
+
+
+def test_unchanged_price_backs_off_to_max_staleness(history):
+    scheduler = RefreshScheduler(history, min_hours=1, max_staleness_hours=5, backoff=2)
+    intervals = []
+    ts = 0
+    for _ in range(5):
+        ts += 10 * HOUR
+        check(history, scheduler, ts, {'stable': 100.0})
+        intervals.append(scheduler.entries()['stable'].interval // HOUR)
+    assert intervals == [1, 2, 4, 5, 5]
+    entry = scheduler.entries()['stable']
+    assert entry.next_due == ts + 5 * HOUR
+
+
+def test_price_change_resets_interval(history):
+    scheduler = RefreshScheduler(history, min_hours=1, max_staleness_hours=100, backoff=3)
+    check(history, scheduler, 10 * HOUR, {'a': 1.0})
+    check(history, scheduler, 20 * HOUR, {'a': 1.0})
+    assert scheduler.entries()['a'].interval == 3 * HOUR
+
+    check(history, scheduler, 30 * HOUR, {'a': 2.0})
+    entry = scheduler.entries()['a']
+    assert entry.interval == HOUR
+    # Сглаженная частота: новый (1.0), без изменения, с изменением
+    assert entry.change_rate == pytest.approx(0.3 + 0.7 * 0.7)
+
+
+def test_due_orders_new_then_volatile(history):
+    scheduler = RefreshScheduler(history, min_hours=1, max_staleness_hours=100)
+    check(history, scheduler, HOUR, {'stable': 1.0, 'volatile': 1.0, 'fresh': 1.0})
+    check(history, scheduler, 2 * HOUR, {'stable': 1.0, 'volatile': 2.0})
+    check(history, scheduler, 3 * HOUR, {'fresh': 1.0})
+
+    now = 10 * HOUR
+    assert scheduler.due(['stable', 'volatile', 'fresh', 'new'], now=now) == [
+        'new', 'volatile', 'stable', 'fresh'
+    ]
+    assert list(scheduler.iter_due(['stable', 'fresh', 'new'], now=3 * HOUR)) == ['new']
+    assert scheduler.earliest_due() == 3 * HOUR
@@ -0,0 +1,47 @@
+from section_tree import SectionNode, SectionTree
+
+# Инфоблок 1:  1 [1, 10] -> 2 [2, 7] -> 3 [3, 4], 4 [5, 6];  1 -> 5 [8, 9];  6 [11, 12]
+# Инфоблок 2:  7 [1, 2]
+NODES = [
+    SectionNode(1, 1, None, 1, 10, 1),
+    SectionNode(2, 1, 1, 2, 7, 2),
+    SectionNode(3, 1, 2, 3, 4, 3),
+    SectionNode(4, 1, 2, 5, 6, 3),
+    SectionNode(5, 1, 1, 8, 9, 2),
+    SectionNode(6, 1, None, 11, 12, 1),
+    SectionNode(7, 2, None, 1, 2, 1),
+]
+
+
+def test_subtree_ids():
+    tree = SectionTree(NODES)
+    assert tree.subtree_ids(1) == [1, 2, 3, 4, 5]
+    assert tree.subtree_ids(2) == [2, 3, 4]
+    assert tree.subtree_ids(4) == [4]
+    assert tree.subtree_ids(7) == [7]
+    # Неизвестный раздел - только он сам
+    assert tree.subtree_ids(99) == [99]
+
+
+def test_contains_and_overlaps():
+    tree = SectionTree(NODES)
+    assert tree.contains(1, 4) and tree.contains(2, 3) and tree.contains(3, 3)
+    assert not tree.contains(4, 2) and not tree.contains(2, 5)
+    # Одинаковые границы в разных инфоблоках не дают вложенности
+    assert not tree.contains(1, 7)
+    assert tree.contains(None, 5) and not tree.contains(1, None)
+    assert tree.overlaps(3, 1) and not tree.overlaps(3, 4)
+    assert tree.ancestors(3) == [2, 1]
+
+
+def test_matcher_finds_deepest_covering_section():
+    tree = SectionTree(NODES)
+    matcher = tree.matcher([1, 2, 6, 99])
+    assert matcher.match(3) == 2
+    assert matcher.match(2) == 2
+    assert matcher.match(5) == 1
+    assert matcher.match(6) == 6
+    assert matcher.match(7) is None
+    assert matcher.match(None) is None
+    # Раздел правила, которого нет в дереве, совпадает только сам с собой
+    assert matcher.match(99) == 99
@@ -0,0 +1,93 @@
+import time
+from collections import Counter
+
+import pytest
+
+from sku_sharding import DONE, FAILED, FREE, LEASED, ShardRing, SqliteLeaseStore
+
+RUN = 'run-1'
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteLeaseStore(tmp_path / 'leases.db')
+    store.init_run(RUN, 3)
+    yield store
+    store.close()
+
+
+def statuses(store):
+    return {lease.shard: (lease.status, lease.owner) for lease in store.leases(RUN)}
+
+
+def test_ring_is_stable_and_balanced():
+    ring = ShardRing(4)
+    skus = [f"{i:06d}" for i in range(4000)]
+    owners = [ring.shard_of(sku) for sku in skus]
+    same = ShardRing(4)
+    assert owners == [same.shard_of(sku) for sku in skus]
+    assert min(Counter(owners).values()) > 500
+
+    # При добавлении шарда артикулы переезжают только на новый шард
+    grown = ShardRing(5)
+    moved = [sku for sku, owner in zip(skus, owners) if grown.shard_of(sku) != owner]
+    assert moved and all(grown.shard_of(sku) == 4 for sku in moved)
+    assert len(moved) < len(skus) / 3
+
+    with pytest.raises(ValueError):
+        ShardRing(0)
+
+
+def test_claim_takes_each_shard_once(store):
+    assert [store.claim(RUN, 'a'), store.claim(RUN, 'b'), store.claim(RUN, 'a')] == [0, 1, 2]
+    assert store.claim(RUN, 'c') is None
+    # Повторная инициализация прогона не сбрасывает аренды
+    store.init_run(RUN, 3)
+    assert statuses(store) == {0: (LEASED, 'a'), 1: (LEASED, 'b'), 2: (LEASED, 'a')}
+
+
+def test_expired_lease_is_stolen(store):
+    assert store.claim(RUN, 'a', ttl=-1) == 0
+    # Сначала раздаются свободные шарды, затем шарды с истёкшей арендой
+    assert [store.claim(RUN, 'b', ttl=60) for _ in range(3)] == [1, 2, 0]
+    # Прежний владелец больше не может продлить или завершить шард
+    assert not store.renew(RUN, 0, 'a')
+    assert not store.complete(RUN, 0, 'a', {'parsed': 1})
+    assert store.renew(RUN, 0, 'b')
+    assert store.complete(RUN, 0, 'b', {'parsed': 5, 'written': 4})
+    assert store.leases(RUN)[0].attempts == 2
+
+
+def test_release_returns_shard_immediately(store):
+    assert store.claim(RUN, 'a') == 0
+    assert store.release(RUN, 0, 'a')
+    assert statuses(store)[0] == (FREE, None)
+    assert store.claim(RUN, 'b') == 0
+
+
+def test_fail_backs_off_then_gives_up(store):
+    assert store.claim(RUN, 'a') == 0
+    assert store.fail(RUN, 0, 'a', max_attempts=2, backoff=60)
+    lease = store.leases(RUN)[0]
+    assert (lease.status, lease.owner) == (FREE, None)
+    assert lease.lease_until >= time.time() + 50
+    # Пока идёт пауза, шард не выдаётся; exclude убирает шарды, которые узел не смог обработать
+    assert store.claim(RUN, 'b', exclude={1}) == 2
+
+    store._execute("UPDATE saturn_sync_shards SET lease_until = 0 WHERE shard = 0")
+    assert store.claim(RUN, 'b') == 0
+    assert store.fail(RUN, 0, 'b', max_attempts=2, backoff=60)
+    assert statuses(store)[0] == (FAILED, 'b')
+    store._execute("UPDATE saturn_sync_shards SET lease_until = 0 WHERE shard = 0")
+    assert store.claim(RUN, 'c', exclude={2}) == 1
+    assert store.claim(RUN, 'c') is None
+
+
+def test_merged_stats(store):
+    for owner in ('a', 'b', 'c'):
+        store.claim(RUN, owner)
+    store.complete(RUN, 0, 'a', {'parsed': 5, 'written': 4, 'note': 'x'})
+    store.complete(RUN, 1, 'b', {'parsed': 3, 'written': 3})
+    store.fail(RUN, 2, 'c', max_attempts=1)
+    assert store.merged_stats(RUN) == {'shards': 3, 'done': 2, 'failed': 1, 'parsed': 8, 'written': 7}
+    assert [lease.status for lease in store.leases(RUN)] == [DONE, DONE, FAILED]
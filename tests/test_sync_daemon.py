@@ -0,0 +1,30 @@
+import threading
+
+from sync_daemon import SyncDaemon
+
+
+class FakeManager:
+    """FullSyncManager, прогоны которого завершаются по заданному списку"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.resumes = []
+        self.stop_event = threading.Event()
+        self.adaptive = False
+
+    def run(self, mode, resume=False, **kwargs):
+        self.resumes.append(resume)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_resume_is_capped_and_reset_by_success():
+    manager = FakeManager([False, False, False, RuntimeError('сбой'), True, True, False, True])
+    daemon = SyncDaemon(manager, max_resumes=2)
+    for _ in range(8):
+        daemon.run_cycle()
+    # Первый прогон продолжает прерванный; после двух продолжений подряд - новый прогон
+    assert manager.resumes == [True, True, False, True, True, False, False, True]
+    assert daemon.failed_cycles == 5
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+from sync_journal import FAILED, NOT_IN_BITRIX, PENDING, SCRAPED, WRITTEN, SyncJournal
+
+
+def test_plan_splits_by_last_state(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db', batch_size=2) as journal:
+        journal.start_run('full')
+        journal.record_many([
+            ('written', SCRAPED, 10.0, 'Товар', 'в наличии', 'https://example/1', None),
+            ('written', WRITTEN, 10.0, None, None, None, None),
+            ('scraped', SCRAPED, 20.0, 'Товар 2', 'в наличии', 'https://example/2', None),
+            ('pending', PENDING, None, None, None, None, None),
+            ('not_found', FAILED, None, None, None, None, 'not_found'),
+            ('not_in_bitrix', FAILED, 30.0, None, None, None, NOT_IN_BITRIX),
+        ])
+        to_parse, scraped = journal.plan(
+            ['written', 'scraped', 'pending', 'not_found', 'not_in_bitrix', 'new'])
+
+    assert to_parse == ['pending', 'not_found', 'new']
+    assert [(entry.sku, entry.price, entry.url) for entry in scraped] == [('scraped', 20.0, 'https://example/2')]
+
+
+def test_resume_continues_unfinished_run(tmp_path):
+    path = tmp_path / 'journal.db'
+    with SyncJournal(path) as journal:
+        finished = journal.start_run('full')
+        journal.record('a', WRITTEN, 1.0)
+        journal.finish_run()
+
+        interrupted = journal.start_run('full')
+        journal.record('a', WRITTEN, 1.0)
+        journal.record('b', SCRAPED, 2.0)
+        # Без finish_run - прогон прерван, буфер дописывается при close()
+
+    with SyncJournal(path) as journal:
+        assert journal.resume_run('stream') is None
+        assert journal.resume_run('full') == interrupted != finished
+        to_parse, scraped = journal.plan(['a', 'b', 'c'])
+    assert to_parse == ['c']
+    assert [entry.sku for entry in scraped] == ['b']
+
+
+def test_failed_run_can_be_resumed(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db') as journal:
+        run_id = journal.start_run('stream')
+        journal.finish_run('failed')
+        assert journal.resume_run() == run_id
+        journal.finish_run()
+        assert journal.resume_run() is None
+
+
+def test_record_without_run_is_ignored(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db') as journal:
+        journal.record('a', WRITTEN, 1.0)
+        assert journal.entries() == {}
+
+
+def test_resume_only_latest_run_of_mode(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db') as journal:
+        stream = journal.start_run('stream')
+        journal.finish_run('failed')
+        journal.start_run('stream')
+        journal.finish_run()
+        # Упавший прогон старше завершённого не продолжается
+        assert journal.resume_run('stream') is None
+
+        full = journal.start_run('full')
+        journal.finish_run('failed')
+        assert journal.resume_run('full') == full
+        assert journal.resume_run('stream') is None
+        assert stream != full
+
+
+def test_resume_skips_old_run(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db') as journal:
+        run_id = journal.start_run('full')
+        journal.connection.execute("UPDATE runs SET started_at = ? WHERE id = ?",
+                                   ((datetime.now() - timedelta(hours=30)).isoformat(), run_id))
+        journal.connection.commit()
+        assert journal.resume_run('full', max_age_hours=24) is None
+        assert journal.resume_run('full', max_age_hours=48) == run_id
+
+
+def test_finish_run_prunes_old_runs(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db', keep_runs=2) as journal:
+        run_ids = []
+        for sku in ['a', 'b', 'c', 'd']:
+            run_ids.append(journal.start_run('full'))
+            journal.record(sku, WRITTEN, 1.0)
+            journal.finish_run()
+
+        runs = [row[0] for row in journal.connection.execute("SELECT id FROM runs ORDER BY id")]
+        events = journal.connection.execute("SELECT DISTINCT run_id FROM events ORDER BY run_id").fetchall()
+        assert runs == run_ids[-2:]
+        assert [row[0] for row in events] == run_ids[-2:]
+        assert list(journal.entries(run_ids[-1])) == ['d']
+
+
+def test_prune_keeps_resumed_run(tmp_path):
+    with SyncJournal(tmp_path / 'journal.db', keep_runs=1) as journal:
+        stream = journal.start_run('stream')
+        journal.record('a', SCRAPED, 1.0)
+        journal.flush()
+        journal.start_run('full')
+        journal.start_run('full')
+
+        assert journal.resume_run('stream') == stream
+        journal.finish_run('failed')
+        runs = [row[0] for row in journal.connection.execute("SELECT id FROM runs ORDER BY id")]
+        assert runs == [stream, stream + 2]
+        assert list(journal.entries()) == ['a']
@@ -0,0 +1,13 @@
+import pytest
+
+from bitrix_integration import BitrixConfig
+from sync_pipeline import SyncPipeline
+
+CONFIG = BitrixConfig('localhost', 3306, 'bitrix', 'user', 'password', iblock_id=1)
+
+
+def test_pool_must_fit_reader_markup_and_writers(monkeypatch):
+    monkeypatch.setenv('BITRIX_MYSQL_POOL_SIZE', '5')
+    SyncPipeline(CONFIG, parse_func=lambda sku: None, db_writers=3)
+    with pytest.raises(ValueError, match='BITRIX_MYSQL_POOL_SIZE'):
+        SyncPipeline(CONFIG, parse_func=lambda sku: None, db_writers=4)
@@ -0,0 +1,107 @@
+import pytest
+
+from bench_underprice_matrix import (
+    IBLOCK_ID, PRICE_GROUPS, BenchConnection, build_catalog, make_processor, price_state, resolve,
+    run_fused, run_matrix, run_rows, states_match
+)
+from section_tree import invalidate_section_tree
+from underprice_python import PURCHASING_PRICE_GROUP, UnderpriceProcessor, UnderpriceRule
+
+PRODUCTS = 400
+SEED = 7
+
+BASE, RETAIL, WHOLESALE, VIP = (PRICE_GROUPS[code] for code in ('BASE', 'RETAIL', 'WHOLESALE', 'VIP'))
+
+
+@pytest.fixture(autouse=True)
+def fresh_section_tree():
+    # Дерево разделов кэшируется на процесс, каталог у каждого теста свой
+    invalidate_section_tree()
+    yield
+    invalidate_section_tree()
+
+
+def final_state(runner, **kwargs):
+    db = build_catalog(PRODUCTS, SEED)
+    try:
+        runner(db, **kwargs)
+        return price_state(db)
+    finally:
+        db.close()
+
+
+def run_scoped(db, mode, product_ids):
+    processor = make_processor(BenchConnection(db), 'matrix' if mode == 'matrix' else 'rows')
+    resolved = resolve(processor)
+    if mode == 'matrix':
+        processor.process_rules_matrix(resolved, product_ids)
+    elif mode == 'fused':
+        processor.process_rules_fused(resolved, product_ids)
+    else:
+        for rule, price_from_id, price_to_id in resolved:
+            processor.process_rule_rows(rule, price_from_id, price_to_id, product_ids)
+
+
+def test_fused_and_matrix_match_rows():
+    initial = final_state(lambda db: None)
+    rows = final_state(run_rows)
+    assert not states_match(initial, rows)
+    assert states_match(rows, final_state(run_fused))
+    assert states_match(rows, final_state(run_matrix))
+
+
+@pytest.mark.parametrize('mode', ['fused', 'matrix'])
+def test_scoped_run_matches_rows(mode):
+    product_ids = list(range(1, PRODUCTS + 1, 3))
+    rows = final_state(run_scoped, mode='rows', product_ids=product_ids)
+    assert states_match(rows, final_state(run_scoped, mode=mode, product_ids=product_ids))
+
+
+def test_fewer_round_trips_than_rows():
+    trips = {}
+    for name, runner in (('rows', run_rows), ('fused', run_fused), ('matrix', run_matrix)):
+        db = build_catalog(PRODUCTS, SEED)
+        trips[name] = runner(db).round_trips
+        db.close()
+    assert trips['fused'] * 10 < trips['rows']
+    assert trips['matrix'] * 10 < trips['rows']
+
+
+def test_fused_groups_keep_rule_order():
+    processor = make_processor(None, 'rows')
+    groups = UnderpriceProcessor.plan_fused_groups(resolve(processor))
+    assert [[rule.id for rule, _, _ in group] for group in groups] == [[1, 2, 3], [4]]
+
+    # Правило 3 читает WHOLESALE, который пишет правило 2 из пересекающегося охвата:
+    # перенос правила 3 в группу правила 1 изменил бы результат
+    chain = [
+        (UnderpriceRule(1, IBLOCK_ID, None, 'BASE', 'RETAIL', 10.0, 100), BASE, RETAIL),
+        (UnderpriceRule(2, IBLOCK_ID, 5, 'RETAIL', 'WHOLESALE', 5.0, 200), RETAIL, WHOLESALE),
+        (UnderpriceRule(3, IBLOCK_ID, None, 'WHOLESALE', 'VIP', 5.0, 300), WHOLESALE, VIP),
+    ]
+    groups = UnderpriceProcessor.plan_fused_groups(chain)
+    assert [[rule.id for rule, _, _ in group] for group in groups] == [[1], [2], [3]]
+
+    # Независимое правило того же охвата присоединяется к первой группе
+    chain[2] = (UnderpriceRule(3, IBLOCK_ID, None, 'BASE', 'VIP', 5.0, 300), BASE, VIP)
+    groups = UnderpriceProcessor.plan_fused_groups(chain)
+    assert [[rule.id for rule, _, _ in group] for group in groups] == [[1, 3], [2]]
+
+
+def test_rule_stages_follow_dependencies():
+    processor = make_processor(None, 'rows')
+    stages = UnderpriceProcessor.plan_rule_stages(resolve(processor))
+    assert [[rule.id for rule, _, _ in stage] for stage in stages] == [[1], [2, 4], [3]]
+
+
+def test_purchasing_rules_are_opt_in():
+    processor = make_processor(None, 'rows')
+    processor.purchasing_rules = False
+    assert processor.resolve_price_group('P') is None
+    assert processor.resolve_price_group('BASE') == BASE
+
+    processor.metadata.catalog_groups['P'] = 99
+    assert processor.resolve_price_group('P') == PURCHASING_PRICE_GROUP
+    processor.metadata.catalog_groups.pop('P')
+    processor.purchasing_rules = True
+    assert processor.resolve_price_group('P') == PURCHASING_PRICE_GROUP
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Tracing - трассировка артикулов по стадиям синхронизации
+
+У каждого артикула в прогоне свой ID трассы, стадии записываются
+интервалами (span): парсинг и вложенные в него HTTP-запросы, наценка,
+запись пачки в Bitrix, пересчёт underprice. Стадии одного артикула идут в
+разных потоках, поэтому артикул передаётся явно (sku=...) или берётся из
+контекста потока парсинга (activate). Интервалы пишутся построчно в JSONL
+по мере поступления, в памяти держатся только суммы по артикулам - из них
+в конце прогона строится отчёт о самых медленных артикулах.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SYNC_TRACE = os.getenv('SYNC_TRACE', '1') == '1'
+SYNC_TRACE_FILE = Path(os.getenv('SYNC_TRACE_FILE', Path("output") / "traces.jsonl"))
+TRACE_REPORT_FILE = Path(os.getenv('TRACE_REPORT_FILE', Path("output") / "trace_report.txt"))
+TRACE_TOP_N = int(os.getenv('TRACE_TOP_N', 20))
+
+# Сколько строк копится перед записью в файл
+WRITE_BUFFER_SIZE = 1000
+
+# Текущий артикул потока: (артикул, имя открытого интервала, его атрибуты)
+_current: contextvars.ContextVar = contextvars.ContextVar('trace_current', default=None)
+
+
+class Tracer:
+    """Трассировщик прогона; выключенный ничего не пишет и почти ничего не стоит"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.path: Optional[Path] = None
+        self._file = None
+        self._buffer: List[str] = []
+        self._trace_ids: Dict[str, str] = {}
+        # Артикул -> интервал верхнего уровня -> [количество, секунды]
+        self._totals: Dict[str, Dict[str, List[float]]] = {}
+        # Артикул -> [начало первого интервала, конец последнего]
+        self._bounds: Dict[str, List[float]] = {}
+
+    def start(self, path: Path = SYNC_TRACE_FILE):
+        """Начало прогона: новый файл трасс"""
+        with self.lock:
+            self.path = Path(path)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._buffer = []
+            self._trace_ids = {}
+            self._totals = {}
+            self._bounds = {}
+            self.enabled = True
+
+    def close(self, top_n: int = TRACE_TOP_N) -> str:
+        """Конец прогона: дозапись файла и отчёт о самых медленных артикулах"""
+        with self.lock:
+            if not self.enabled:
+                return ''
+            self.enabled = False
+            self._write_buffer()
+            self._file.close()
+            self._file = None
+        return self.report(top_n)
+
+    @contextmanager
+    def activate(self, sku: str) -> Iterator[None]:
+        """Артикул по умолчанию для интервалов в этом потоке"""
+        token = _current.set((sku, None, None))
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def span(self, name: str, sku: Optional[str] = None, **attrs) -> Iterator[Dict]:
+        """Интервал стадии; атрибуты можно дополнить внутри блока через возвращённый словарь"""
+        current = _current.get()
+        if not self.enabled or (sku is None and current is None):
+            yield attrs
+            return
+
+        if sku is None:
+            sku, parent = current[0], current[1]
+        else:
+            parent = current[1] if current is not None and current[0] == sku else None
+        token = _current.set((sku, name, attrs))
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            _current.reset(token)
+            self._record(sku, name, parent, start, time.perf_counter() - started, attrs)
+
+    def annotate(self, **attrs):
+        """Атрибуты текущего открытого интервала потока"""
+        current = _current.get()
+        if self.enabled and current is not None and current[2] is not None:
+            current[2].update(attrs)
+
+    def record(self, skus: Iterable[str], name: str, start: float, duration: float, **attrs):
+        """Общий интервал для нескольких артикулов (запись пачки, пересчёт underprice)"""
+        if not self.enabled:
+            return
+        for sku in skus:
+            self._record(sku, name, None, start, duration, attrs)
+
+    def _record(self, sku: str, name: str, parent: Optional[str], start: float, duration: float, attrs: Dict):
+        with self.lock:
+            if not self.enabled:
+                return
+            trace_id = self._trace_ids.get(sku)
+            if trace_id is None:
+                trace_id = self._trace_ids[sku] = uuid.uuid4().hex[:16]
+            line = {'trace_id': trace_id, 'sku': sku, 'span': name, 'start': round(start, 4),
+                    'duration': round(duration, 4)}
+            if parent:
+                line['parent'] = parent
+            if attrs:
+                line['attrs'] = attrs
+            self._buffer.append(json.dumps(line, ensure_ascii=False, default=str))
+
+            # Вложенные интервалы (HTTP внутри парсинга) в сумму по артикулу не входят
+            total = self._totals.setdefault(sku, {}).setdefault(name if parent is None else f"{parent}/{name}", [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            bounds = self._bounds.get(sku)
+            if bounds is None:
+                self._bounds[sku] = [start, start + duration]
+            else:
+                bounds[0] = min(bounds[0], start)
+                bounds[1] = max(bounds[1], start + duration)
+
+            if len(self._buffer) >= WRITE_BUFFER_SIZE:
+                self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer and self._file:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+
+    def slowest(self, top_n: int = TRACE_TOP_N) -> List[Dict]:
+        """Артикулы с наибольшим временем стадий (без вложенных интервалов)"""
+        with self.lock:
+            rows = []
+            for sku, spans in self._totals.items():
+                active = sum(seconds for name, (_, seconds) in spans.items() if '/' not in name)
+                first, last = self._bounds[sku]
+                rows.append({'sku': sku, 'trace_id': self._trace_ids[sku], 'active': active,
+                             'wall': last - first, 'spans': {name: tuple(value) for name, value in spans.items()}})
+        rows.sort(key=lambda row: row['active'], reverse=True)
+        return rows[:top_n]
+
+    def report(self, top_n: int = TRACE_TOP_N) -> str:
+        lines = [f"Самые медленные артикулы (трассы: {self.path})"]
+        for row in self.slowest(top_n):
+            breakdown = ', '.join(
+                f"{name} {seconds:.2f}с" + (f" ×{int(count)}" if count > 1 else '')
+                for name, (count, seconds) in sorted(row['spans'].items(), key=lambda item: -item[1][1])
+            )
+            lines.append(f"{row['sku']} [{row['trace_id']}]: {row['active']:.2f}с в стадиях, "
+                         f"{row['wall']:.2f}с от начала до конца; {breakdown}")
+        return '\n'.join(lines)
+
+
+TRACER = Tracer()
+
+
+def finish_run_trace(report_file: Optional[Path] = TRACE_REPORT_FILE, top_n: int = TRACE_TOP_N):
+    """Закрытие трассировки прогона: отчёт в лог и в файл"""
+    report = TRACER.close(top_n)
+    if not report:
+        return
+    logger.info(report)
+    if report_file:
+        try:
+            Path(report_file).parent.mkdir(parents=True, exist_ok=True)
+            Path(report_file).write_text(report + '\n', encoding='utf-8')
+        except OSError as e:
+            logger.error(f"Ошибка записи отчёта трассировки: {e}")
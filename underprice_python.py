@@ -2,18 +2,54 @@
 
 import os
 import sys
+import json
+import time
+import hashlib
 import logging
-from typing import List, Dict, Tuple, Optional
-from dataclasses import dataclass
-from datetime import datetime
-import mysql.connector
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Dict, NamedTuple, Set, Tuple, Optional
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from pathlib import Path
 from mysql.connector import Error
 from dotenv import load_dotenv
 
+from bitrix_metadata import BitrixMetadata, get_metadata
+from metrics import CACHE_REQUESTS
+from price_matrix import PURCHASING_COLUMN, PriceMatrix
+from section_tree import SectionTree, get_section_tree
+from db_pool import DbPoolConfig, PoolTimeoutError, get_pool
+
 load_dotenv()
 
 logger = logging.getLogger('underprice_python')
 
+# Размер пачки потоковой выборки товаров
+STREAM_CHUNK_SIZE = 1000
+
+# Код закупочной цены (b_catalog_product.PURCHASING_PRICE) в правилах
+PURCHASING_PRICE_CODE = 'P'
+PURCHASING_PRICE_GROUP = PURCHASING_COLUMN
+
+# Режимы выполнения правил: построчный (эталонный), множественный SQL
+# и матрица цен в памяти
+EXECUTION_MODES = ('rows', 'sql', 'matrix')
+
+# Параллельное выполнение: размер партиции (диапазон ID товаров) и число
+# повторов партиции при взаимоблокировке / таймауте ожидания блокировки
+DEFAULT_PARTITION_SIZE = 50000
+DEADLOCK_RETRIES = 3
+RETRYABLE_ERRNOS = (1213, 1205)  # ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT
+
+# Состояние инкрементального пересчёта (водяной знак изменений цен)
+UNDERPRICE_STATE_FILE = Path(os.getenv('UNDERPRICE_STATE_FILE', Path("cache") / "underprice_state.json"))
+# Как часто (часов) инкрементальный режим делает полный пересчёт
+FULL_RECOMPUTE_INTERVAL_HOURS = float(os.getenv('UNDERPRICE_FULL_INTERVAL_HOURS', 24))
+
+# Как часто (сек) перепроверять штамп инфоблока настроек для кэша правил
+RULES_CHECK_INTERVAL = float(os.getenv('UNDERPRICE_RULES_CHECK_INTERVAL', 60))
+
 @dataclass
 class UnderpriceRule:
     id: int
@@ -32,74 +68,199 @@ class ProductInfo:
     section_id: Optional[int]
     current_price: Optional[float]
 
+class ProductRow(NamedTuple):
+    """Компактная строка товара для потоковой обработки"""
+    id: int
+    article: str
+    section_id: Optional[int]
+    purchasing_price: Optional[float]
+
+@dataclass
+class UnderpriceState:
+    """Водяной знак инкрементального пересчёта - время БД на начало прошлого запуска"""
+    watermark: Optional[str] = None
+    last_full_at: Optional[str] = None
+    rules_fingerprint: Optional[str] = None
+
+def load_underprice_state(path: Path = UNDERPRICE_STATE_FILE) -> UnderpriceState:
+    if not path.exists():
+        return UnderpriceState()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return UnderpriceState(**json.load(f))
+    except (ValueError, TypeError, OSError) as e:
+        logger.warning(f"Не удалось прочитать состояние underprice {path}: {e}")
+        return UnderpriceState()
+
+def save_underprice_state(state: UnderpriceState, path: Path = UNDERPRICE_STATE_FILE):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(asdict(state), f, ensure_ascii=False, indent=2)
+        tmp_file.replace(path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить состояние underprice {path}: {e}")
+
+def rules_fingerprint(rules: List[UnderpriceRule]) -> str:
+    digest = hashlib.sha1()
+    for rule in rules:
+        digest.update(repr(asdict(rule)).encode('utf-8'))
+    return digest.hexdigest()
+
+@dataclass
+class CompiledRules:
+    """Кэш загруженных правил одного инфоблока настроек"""
+    stamp: Tuple
+    rules: List[UnderpriceRule]
+    checked_at: float
+
+# Кэш правил общий для процесса: повторные запуски пересчёта в рамках
+# синхронизации не перечитывают настройки, пока не сменится штамп
+_rules_cache: Dict[int, CompiledRules] = {}
+_rules_cache_lock = threading.Lock()
+
+def invalidate_rules_cache():
+    with _rules_cache_lock:
+        _rules_cache.clear()
+
+class Partition(NamedTuple):
+    """Диапазон ID товаров (и явный список ID при точечном пересчёте)"""
+    first_id: int
+    last_id: int
+    product_ids: Optional[List[int]] = None
+
+def is_retryable_error(error: Exception) -> bool:
+    return getattr(error, 'errno', None) in RETRYABLE_ERRNOS
+
 class UnderpriceProcessor:
     
-    def __init__(self):
+    def __init__(self, mode: Optional[str] = None, workers: Optional[int] = None,
+                 partition_size: Optional[int] = None):
+        self.mode = mode or os.getenv('UNDERPRICE_MODE', 'rows')
+        if self.mode not in EXECUTION_MODES:
+            raise ValueError(f"Неизвестный режим underprice: {self.mode}")
+        
+        self.workers = max(1, workers or int(os.getenv('UNDERPRICE_WORKERS', 1)))
+        self.partition_size = max(1, partition_size or int(os.getenv('UNDERPRICE_PARTITION_SIZE', DEFAULT_PARTITION_SIZE)))
+        self.deadlock_retries = int(os.getenv('UNDERPRICE_DEADLOCK_RETRIES', DEADLOCK_RETRIES))
+        # Слияние цепочек правил с общим охватом в один проход (режим rows)
+        self.fusion = os.getenv('UNDERPRICE_FUSION', '1').lower() not in ('0', 'false', 'no')
+        # Правила от/к закупочной цене (P) без группы цен P в каталоге; по умолчанию
+        # они, как и раньше, пропускаются
+        self.purchasing_rules = os.getenv('UNDERPRICE_PURCHASING_RULES', '0').lower() in ('1', 'true', 'yes')
+        # Рабочие процессоры партиций пробрасывают ошибки блокировок для повтора
+        self.propagate_errors = False
+        self.failed_partitions = 0
+        # Ошибки записи, не прервавшие пересчёт (цена товара, правило в режиме SQL)
+        self.failed_updates = 0
+        
         self.connection = None
+        self.pool = None
         self.rules = []
         self.processed_count = 0
         self.updated_count = 0
         self.price_groups = {}
+        self.metadata: Optional[BitrixMetadata] = None
+        self.section_tree: Optional[SectionTree] = None
     
     def connect(self):
         try:
-            self.connection = mysql.connector.connect(
-                host=os.getenv('BITRIX_MYSQL_HOST', '127.0.0.1'),
-                port=int(os.getenv('BITRIX_MYSQL_PORT', 3306)),
-                database=os.getenv('BITRIX_MYSQL_DATABASE', 'sitemanager'),
-                user=os.getenv('BITRIX_MYSQL_USERNAME', 'bitrix_sync'),
-                password=os.getenv('BITRIX_MYSQL_PASSWORD', ''),
-                charset='utf8mb4',
-                autocommit=True,
-                use_pure=True
-            )
-            logger.info(f"Подключение к MySQL установлено")
-        except Error as e:
+            self.pool = get_pool(DbPoolConfig.from_env())
+            self.connection = self.pool.acquire()
+            logger.debug("Соединение с MySQL получено из пула")
+        except (Error, PoolTimeoutError) as e:
             logger.error(f"Ошибка подключения к MySQL: {e}")
             raise
     
     def disconnect(self):
-        if self.connection:
-            self.connection.close()
-            logger.info("Соединение с MySQL закрыто")
+        if self.connection and self.pool:
+            self.pool.release(self.connection)
+            self.connection = None
+            logger.debug("Соединение с MySQL возвращено в пул")
+    
+    def load_metadata(self, force: bool = False) -> BitrixMetadata:
+        if self.metadata is None or force:
+            self.metadata = get_metadata(self.connection, force=force)
+        return self.metadata
+    
+    def load_section_tree(self) -> SectionTree:
+        if self.section_tree is None:
+            self.section_tree = get_section_tree(self.connection)
+        return self.section_tree
+    
+    def section_condition(self, section_id: int, column: str = 'e.IBLOCK_SECTION_ID') -> Tuple[str, List[int]]:
+        """Условие «товар в разделе или его подразделах» по индексу дерева разделов"""
+        section_ids = self.load_section_tree().subtree_ids(section_id)
+        return f"{column} IN ({', '.join(['%s'] * len(section_ids))})", list(section_ids)
     
     def load_price_groups(self):
-        cursor = self.connection.cursor(dictionary=True)
-        cursor.execute("SELECT ID, NAME, BASE FROM b_catalog_group ORDER BY SORT")
+        metadata = self.load_metadata()
         
-        for row in cursor.fetchall():
-            self.price_groups[row['ID']] = {
-                'name': row['NAME'],
-                'base': row['BASE'] == 'Y'
+        self.price_groups = {
+            group_id: {
+                'name': code,
+                'base': group_id == metadata.base_group_id
             }
-        
-        cursor.close()
+            for code, group_id in metadata.catalog_groups.items()
+        }
         logger.info(f"Загружено групп цен: {len(self.price_groups)}")
     
     def get_price_group_by_code(self, code: str) -> Optional[int]:
-        code_mapping = {
-            'BASE': 1,
-            'RETAIL': 2,
-            'WHOLESALE': 3,
-            'VIP': 4
-        }
-        return code_mapping.get(code)
+        return self.load_metadata().price_group_id(code)
     
-    def load_underprice_rules(self) -> List[UnderpriceRule]:
-        cursor = self.connection.cursor(dictionary=True)
-        
-        cursor.execute("""
-        SELECT VALUE FROM b_option 
-        WHERE MODULE_ID = 'mcart.underprice' AND NAME = 'SETTINGS_IBLOCK_ID'
-        """)
+    def get_article_property_id(self, iblock_id: int) -> Optional[int]:
+        return self.load_metadata().property_id(iblock_id, 'CML2_ARTICLE')
+    
+    def load_underprice_rules(self, force: bool = False) -> List[UnderpriceRule]:
+        """Правила underprice из кэша; перечитываются при смене штампа инфоблока настроек"""
+        metadata = self.load_metadata()
         
-        settings_row = cursor.fetchone()
-        if not settings_row:
+        settings_iblock_id = metadata.underprice_iblock_id
+        if not settings_iblock_id:
             logger.warning("Настройки модуля underprice не найдены")
             return []
         
-        settings_iblock_id = int(settings_row['VALUE'])
+        with _rules_cache_lock:
+            cached = _rules_cache.get(settings_iblock_id)
+        
+        now = time.monotonic()
+        if cached and not force and now - cached.checked_at < RULES_CHECK_INTERVAL:
+            CACHE_REQUESTS.inc(cache='underprice_rules', result='hit')
+            return list(cached.rules)
+        
+        stamp = (metadata.fingerprint,) + self.get_rules_stamp(settings_iblock_id)
+        if cached and not force and cached.stamp == stamp:
+            cached.checked_at = now
+            CACHE_REQUESTS.inc(cache='underprice_rules', result='hit')
+            return list(cached.rules)
+        
+        CACHE_REQUESTS.inc(cache='underprice_rules', result='miss')
         logger.info(f"ID блока настроек underprice: {settings_iblock_id}")
+        rules = self.query_underprice_rules(settings_iblock_id)
+        
+        with _rules_cache_lock:
+            _rules_cache[settings_iblock_id] = CompiledRules(stamp, rules, now)
+        return list(rules)
+    
+    def get_rules_stamp(self, settings_iblock_id: int) -> Tuple:
+        """Штамп настроек: TIMESTAMP_X инфоблока и агрегаты его элементов"""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+            SELECT 
+                (SELECT TIMESTAMP_X FROM b_iblock WHERE ID = %s),
+                COUNT(*), MAX(ID), MAX(TIMESTAMP_X)
+            FROM b_iblock_element
+            WHERE IBLOCK_ID = %s
+            """, (settings_iblock_id, settings_iblock_id))
+            return tuple(str(value) for value in cursor.fetchone())
+        finally:
+            cursor.close()
+    
+    def query_underprice_rules(self, settings_iblock_id: int) -> List[UnderpriceRule]:
+        """Загрузка правил одним запросом; XML_ID значений списков - одним пакетом"""
+        metadata = self.load_metadata()
         
         query = """
         SELECT 
@@ -112,51 +273,43 @@ class UnderpriceProcessor:
             p_percent.VALUE as PERCENT
         FROM b_iblock_element e
         LEFT JOIN b_iblock_element_property p_iblock ON (
-            e.ID = p_iblock.IBLOCK_ELEMENT_ID 
-            AND p_iblock.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'IBLOCK_ID'
-            )
+            e.ID = p_iblock.IBLOCK_ELEMENT_ID AND p_iblock.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p_section ON (
-            e.ID = p_section.IBLOCK_ELEMENT_ID 
-            AND p_section.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'SECTION_ID'
-            )
+            e.ID = p_section.IBLOCK_ELEMENT_ID AND p_section.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p_price_from ON (
-            e.ID = p_price_from.IBLOCK_ELEMENT_ID 
-            AND p_price_from.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PRICE_CODE'
-            )
+            e.ID = p_price_from.IBLOCK_ELEMENT_ID AND p_price_from.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p_price_to ON (
-            e.ID = p_price_to.IBLOCK_ELEMENT_ID 
-            AND p_price_to.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PRICE_CODE_TO'
-            )
+            e.ID = p_price_to.IBLOCK_ELEMENT_ID AND p_price_to.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_iblock_element_property p_percent ON (
-            e.ID = p_percent.IBLOCK_ELEMENT_ID 
-            AND p_percent.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = %s AND CODE = 'PERCENT'
-            )
+            e.ID = p_percent.IBLOCK_ELEMENT_ID AND p_percent.IBLOCK_PROPERTY_ID = %s
         )
         WHERE e.IBLOCK_ID = %s AND e.ACTIVE = 'Y'
         ORDER BY e.SORT, e.ID
         """
         
+        cursor = self.connection.cursor(dictionary=True)
         cursor.execute(query, (
-            settings_iblock_id, settings_iblock_id, settings_iblock_id, 
-            settings_iblock_id, settings_iblock_id, settings_iblock_id
+            metadata.property_id(settings_iblock_id, 'IBLOCK_ID'),
+            metadata.property_id(settings_iblock_id, 'SECTION_ID'),
+            metadata.property_id(settings_iblock_id, 'PRICE_CODE'),
+            metadata.property_id(settings_iblock_id, 'PRICE_CODE_TO'),
+            metadata.property_id(settings_iblock_id, 'PERCENT'),
+            settings_iblock_id
         ))
         
+        rows = cursor.fetchall()
+        cursor.close()
+        
+        self.prefetch_enum_xml_ids(
+            [row['PRICE_CODE_FROM_ENUM_ID'] for row in rows] + [row['PRICE_CODE_TO_ENUM_ID'] for row in rows]
+        )
+        
         rules = []
-        for row in cursor.fetchall():
+        for row in rows:
             try:
                 price_from_code = self.get_enum_xml_id(row['PRICE_CODE_FROM_ENUM_ID'])
                 price_to_code = self.get_enum_xml_id(row['PRICE_CODE_TO_ENUM_ID'])
@@ -174,14 +327,34 @@ class UnderpriceProcessor:
             except (ValueError, TypeError) as e:
                 logger.warning(f"Ошибка обработки правила {row['ID']}: {e}")
         
-        cursor.close()
         logger.info(f"Загружено правил underprice: {len(rules)}")
         return rules
     
+    def prefetch_enum_xml_ids(self, enum_ids: Iterable):
+        """Дочитывает одним запросом XML_ID значений, которых нет в метаданных"""
+        known = self.load_metadata().enum_xml_ids
+        missing = sorted({int(enum_id) for enum_id in enum_ids if enum_id} - known.keys())
+        if not missing:
+            return
+        
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"""
+            SELECT ID, XML_ID FROM b_iblock_property_enum
+            WHERE ID IN ({', '.join(['%s'] * len(missing))})
+            """, missing)
+            known.update((int(enum_id), xml_id) for enum_id, xml_id in cursor.fetchall())
+        finally:
+            cursor.close()
+    
     def get_enum_xml_id(self, enum_id: int) -> Optional[str]:
         if not enum_id:
             return None
-            
+        
+        xml_id = self.load_metadata().enum_xml_ids.get(int(enum_id))
+        if xml_id is not None:
+            return xml_id
+        
         cursor = self.connection.cursor(dictionary=True)
         cursor.execute("SELECT XML_ID FROM b_iblock_property_enum WHERE ID = %s", (enum_id,))
         
@@ -190,16 +363,129 @@ class UnderpriceProcessor:
         
         return row['XML_ID'] if row else None
     
+    def iter_products_for_processing(self, iblock_id: int, section_id: Optional[int] = None,
+                                     chunk_size: int = STREAM_CHUNK_SIZE,
+                                     with_purchasing_price: bool = False,
+                                     product_ids: Optional[Iterable[int]] = None,
+                                     id_range: Optional[Tuple[int, int]] = None) -> Iterator[List[ProductRow]]:
+        """Потоковая выборка товаров пачками (keyset-пагинация по e.ID)
+        
+        Если задан product_ids, выбираются только эти товары - окнами
+        по chunk_size ID вместо обхода всего инфоблока. id_range
+        ограничивает выборку диапазоном ID (партицией).
+        """
+        where_conditions = ["e.ACTIVE = 'Y'", "e.IBLOCK_ID = %s", "e.ID > %s"]
+        section_params = []
+        if section_id:
+            section_sql, section_params = self.section_condition(section_id)
+            where_conditions.append(section_sql)
+        if id_range:
+            where_conditions.append("e.ID <= %s")
+        if with_purchasing_price:
+            where_conditions.append("cat.PURCHASING_PRICE IS NOT NULL")
+        
+        def build_query(extra_condition: str = '') -> str:
+            conditions = where_conditions + ([extra_condition] if extra_condition else [])
+            return f"""
+            SELECT 
+                e.ID,
+                prop.VALUE as ARTICLE,
+                e.IBLOCK_SECTION_ID as SECTION_ID,
+                cat.PURCHASING_PRICE
+            FROM b_iblock_element e
+            LEFT JOIN b_iblock_element_property prop ON (
+                e.ID = prop.IBLOCK_ELEMENT_ID AND prop.IBLOCK_PROPERTY_ID = %s
+            )
+            LEFT JOIN b_catalog_product cat ON e.ID = cat.ID
+            WHERE {' AND '.join(conditions)}
+            ORDER BY e.ID ASC
+            LIMIT %s
+            """
+        
+        article_property_id = self.get_article_property_id(iblock_id)
+        
+        def base_params(last_id: int) -> List:
+            params = [article_property_id, iblock_id, last_id] + section_params
+            if id_range:
+                params.append(id_range[1])
+            return params
+        
+        start_id = id_range[0] - 1 if id_range else 0
+        
+        if product_ids is not None:
+            ids = sorted(set(product_ids))
+            for i in range(0, len(ids), chunk_size):
+                window = ids[i:i + chunk_size]
+                query = build_query(f"e.ID IN ({', '.join(['%s'] * len(window))})")
+                chunk = self._fetch_product_rows(query, base_params(start_id) + window + [chunk_size])
+                if chunk:
+                    yield chunk
+            return
+        
+        query = build_query()
+        last_id = start_id
+        
+        while True:
+            chunk = self._fetch_product_rows(query, base_params(last_id) + [chunk_size])
+            
+            if not chunk:
+                break
+            
+            last_id = chunk[-1].id
+            yield chunk
+            
+            if len(chunk) < chunk_size:
+                break
+    
+    def _fetch_product_rows(self, query: str, params: List) -> List[ProductRow]:
+        # Небуферизованный курсор, пачка дочитывается до yield - между
+        # пачками соединение свободно для чтения цен и записи
+        cursor = self.connection.cursor(buffered=False)
+        try:
+            cursor.execute(query, params)
+            return [
+                ProductRow(row[0], row[1] or '', row[2], float(row[3]) if row[3] else None)
+                for row in cursor
+            ]
+        finally:
+            cursor.close()
+    
+    def get_products_scope(self, product_ids: Iterable[int]) -> Set[Tuple[int, Optional[int]]]:
+        """Пары (IBLOCK_ID, IBLOCK_SECTION_ID), в которые входят товары"""
+        ids = sorted(set(product_ids))
+        scope = set()
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(ids), STREAM_CHUNK_SIZE):
+                window = ids[i:i + STREAM_CHUNK_SIZE]
+                cursor.execute(f"""
+                SELECT DISTINCT IBLOCK_ID, IBLOCK_SECTION_ID FROM b_iblock_element
+                WHERE ID IN ({', '.join(['%s'] * len(window))})
+                """, window)
+                scope.update((int(iblock_id), section_id) for iblock_id, section_id in cursor.fetchall())
+        finally:
+            cursor.close()
+        return scope
+    
+    def rule_covers_scope(self, rule: 'UnderpriceRule', scope: Set[Tuple[int, Optional[int]]]) -> bool:
+        """Покрывает ли правило хотя бы один раздел охвата (с учётом подразделов)"""
+        tree = self.load_section_tree() if rule.section_id else None
+        return any(
+            iblock_id == rule.iblock_id and (not rule.section_id or tree.contains(rule.section_id, section_id))
+            for iblock_id, section_id in scope
+        )
+    
     def get_products_for_processing(self, iblock_id: int, section_id: Optional[int] = None, 
                                    batch_size: int = 1000, offset: int = 0) -> List[ProductInfo]:
         cursor = self.connection.cursor(dictionary=True)
         
         where_conditions = ["e.ACTIVE = 'Y'", "e.IBLOCK_ID = %s"]
-        params = [iblock_id]
+        params = [self.get_article_property_id(iblock_id), iblock_id]
         
         if section_id:
-            where_conditions.append("e.IBLOCK_SECTION_ID = %s")
-            params.append(section_id)
+            section_sql, section_params = self.section_condition(section_id)
+            where_conditions.append(section_sql)
+            params.extend(section_params)
         
         query = f"""
         SELECT 
@@ -209,11 +495,7 @@ class UnderpriceProcessor:
             prop.VALUE as ARTICLE
         FROM b_iblock_element e
         LEFT JOIN b_iblock_element_property prop ON (
-            e.ID = prop.IBLOCK_ELEMENT_ID 
-            AND prop.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = e.IBLOCK_ID AND CODE = 'CML2_ARTICLE'
-            )
+            e.ID = prop.IBLOCK_ELEMENT_ID AND prop.IBLOCK_PROPERTY_ID = %s
         )
         WHERE {' AND '.join(where_conditions)}
         ORDER BY e.ID
@@ -275,82 +557,614 @@ class UnderpriceProcessor:
             return True
             
         except Error as e:
+            if self.propagate_errors and is_retryable_error(e):
+                raise
             logger.error(f"Ошибка обновления цены товара {product_id}: {e}")
+            self.failed_updates += 1
             return False
         finally:
             cursor.close()
     
-    def process_underprice_rules(self):
-        logger.info("🔄 Начинаем обработку правил underprice...")
+    def process_underprice_rules(self, product_ids: Optional[Iterable[int]] = None,
+                                 rules: Optional[List[UnderpriceRule]] = None):
+        """Пересчёт цен по правилам underprice
+        
+        product_ids ограничивает пересчёт этими товарами и правилами,
+        чей инфоблок/раздел их покрывает; None - весь каталог.
+        rules - уже загруженные правила (по умолчанию читаются из БД).
+        """
         start_time = datetime.now()
         
+        if product_ids is not None:
+            product_ids = sorted(set(product_ids))
+            if not product_ids:
+                logger.info("Нет товаров для пересчета underprice")
+                return
+            logger.info(f"🔄 Начинаем обработку правил underprice для {len(product_ids)} товаров...")
+        else:
+            logger.info("🔄 Начинаем обработку правил underprice...")
+        
         self.load_price_groups()
-        self.rules = self.load_underprice_rules()
+        self.rules = rules if rules is not None else self.load_underprice_rules()
         
         if not self.rules:
             logger.warning("Правила underprice не найдены")
             return
         
+        scope = self.get_products_scope(product_ids) if product_ids is not None else None
+        
+        resolved_rules = []
         for profile_id, rule in enumerate(self.rules):
+            if scope is not None and not self.rule_covers_scope(rule, scope):
+                continue
+            
             logger.info(f"📋 Profile {profile_id}: {rule.price_code_from} → {rule.price_code_to} ({rule.percent}%)")
             
-            price_from_id = self.get_price_group_by_code(rule.price_code_from)
-            price_to_id = self.get_price_group_by_code(rule.price_code_to)
+            price_from_id = self.resolve_price_group(rule.price_code_from)
+            price_to_id = self.resolve_price_group(rule.price_code_to)
             
-            if not price_from_id or not price_to_id:
+            if price_from_id is None or price_to_id is None:
                 logger.warning(f"Не найдены группы цен для правила {rule.id}")
                 continue
             
-            element_id = 0
-            rule_processed = 0
-            rule_updated = 0
-            
-            while True:
-                products = self.get_products_batch(
-                    rule.iblock_id, rule.section_id, element_id, 50
-                )
+            resolved_rules.append((rule, price_from_id, price_to_id))
+        
+        if self.workers > 1:
+            self.process_rules_parallel(resolved_rules, product_ids)
+        else:
+            self.process_rules_serial(resolved_rules, product_ids)
+        
+        duration = (datetime.now() - start_time).total_seconds()
+        logger.info(f"✅ Обработка underprice завершена за {duration:.1f}с")
+        logger.info(f"📈 Итого: обработано {self.processed_count}, обновлено {self.updated_count}")
+        if self.failed_partitions:
+            logger.warning(f"Партиций с ошибками: {self.failed_partitions}")
+        if self.failed_updates:
+            logger.warning(f"Ошибок записи при пересчете: {self.failed_updates}")
+    
+    @property
+    def failures(self) -> int:
+        """Ошибки пересчёта в любом режиме: упавшие партиции и пропущенные записи"""
+        return self.failed_partitions + self.failed_updates
+    
+    def process_incremental(self, force_full: bool = False,
+                            full_interval_hours: float = FULL_RECOMPUTE_INTERVAL_HOURS,
+                            state_file: Path = UNDERPRICE_STATE_FILE):
+        """Пересчёт только товаров, исходные цены которых изменились с прошлого запуска
+        
+        Полный пересчёт выполняется по запросу (force_full), при первом
+        запуске, после изменения правил и раз в full_interval_hours.
+        Водяной знак сдвигается на время начала запуска только после
+        успешного пересчёта.
+        """
+        state = load_underprice_state(state_file)
+        run_started = self.get_db_now()
+        
+        self.load_price_groups()
+        rules = self.load_underprice_rules()
+        fingerprint = rules_fingerprint(rules)
+        
+        full_reason = None
+        if force_full:
+            full_reason = "по запросу"
+        elif not state.watermark:
+            full_reason = "нет водяного знака"
+        elif state.rules_fingerprint != fingerprint:
+            full_reason = "изменились правила"
+        elif (not state.last_full_at or
+              datetime.fromisoformat(state.last_full_at) + timedelta(hours=full_interval_hours) <= run_started):
+            full_reason = f"прошло больше {full_interval_hours:g} ч с полного пересчета"
+        
+        if full_reason:
+            logger.info(f"🔄 Полный пересчет underprice ({full_reason})")
+            self.process_underprice_rules(rules=rules)
+            state.last_full_at = run_started.isoformat(sep=' ')
+        else:
+            changed_ids = self.get_changed_product_ids(rules, state.watermark)
+            logger.info(f"🔄 Инкрементальный пересчет underprice: изменилось товаров {len(changed_ids)} "
+                        f"с {state.watermark}")
+            if changed_ids:
+                self.process_underprice_rules(changed_ids, rules=rules)
+        
+        if self.failures:
+            logger.warning("Водяной знак underprice не сдвинут из-за ошибок пересчета")
+            return
+        
+        state.watermark = run_started.isoformat(sep=' ')
+        state.rules_fingerprint = fingerprint
+        save_underprice_state(state, state_file)
+    
+    def get_db_now(self) -> datetime:
+        """Текущее время сервера БД - водяной знак не зависит от часов этой машины"""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT NOW()")
+            now = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        return now if isinstance(now, datetime) else datetime.fromisoformat(str(now))
+    
+    def get_changed_product_ids(self, rules: List[UnderpriceRule], since: str) -> Set[int]:
+        """Товары инфоблоков правил с изменёнными исходными ценами или свойствами элемента
+        
+        Отслеживаются только исходные группы, которые не пишет ни одно правило:
+        производные группы пересчитываются по цепочке вместе с исходной, а
+        собственные записи underprice не вызывают повторный пересчёт.
+        """
+        from_groups, to_groups = set(), set()
+        for rule in rules:
+            from_groups.add(self.resolve_price_group(rule.price_code_from))
+            to_groups.add(self.resolve_price_group(rule.price_code_to))
+        from_groups.discard(None)
+        to_groups.discard(None)
+        
+        source_groups = (from_groups - to_groups) or from_groups
+        price_groups = sorted(source_groups - {PURCHASING_PRICE_GROUP})
+        iblock_ids = sorted({rule.iblock_id for rule in rules})
+        
+        queries = []
+        if iblock_ids:
+            # Новые товары и перенос между разделами меняют охват правил
+            queries.append((
+                f"SELECT ID FROM b_iblock_element WHERE TIMESTAMP_X >= %s "
+                f"AND IBLOCK_ID IN ({', '.join(['%s'] * len(iblock_ids))})",
+                [since] + iblock_ids
+            ))
+        if PURCHASING_PRICE_GROUP in source_groups:
+            queries.append(("SELECT ID FROM b_catalog_product WHERE TIMESTAMP_X >= %s", [since]))
+        if price_groups:
+            queries.append((
+                f"SELECT DISTINCT PRODUCT_ID FROM b_catalog_price WHERE TIMESTAMP_X >= %s "
+                f"AND CATALOG_GROUP_ID IN ({', '.join(['%s'] * len(price_groups))})",
+                [since] + price_groups
+            ))
+        
+        changed = set()
+        for query, params in queries:
+            cursor = self.connection.cursor(buffered=False)
+            try:
+                cursor.execute(query, params)
+                changed.update(row[0] for row in cursor)
+            finally:
+                cursor.close()
+        return changed
+    
+    def resolve_price_group(self, code: str) -> Optional[int]:
+        """ID группы цен для кода правила; для закупочной цены (P) - PURCHASING_PRICE_GROUP
+        
+        Правило с P выполняется, только если в каталоге есть группа цен P
+        или включён UNDERPRICE_PURCHASING_RULES, иначе пропускается.
+        """
+        group_id = self.get_price_group_by_code(code)
+        if code == PURCHASING_PRICE_CODE:
+            if group_id is None and not self.purchasing_rules:
+                return None
+            return PURCHASING_PRICE_GROUP
+        return group_id
+    
+    def process_rule_rows(self, rule: UnderpriceRule, price_from_id: int, price_to_id: int,
+                          product_ids: Optional[List[int]] = None,
+                          id_range: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """Построчное выполнение правила: чтение и запись цены для каждого товара"""
+        rule_processed = 0
+        rule_updated = 0
+        
+        for products in self.iter_products_for_processing(
+            rule.iblock_id, rule.section_id, with_purchasing_price=True,
+            product_ids=product_ids, id_range=id_range
+        ):
+            for product in products:
+                if rule.price_code_from == PURCHASING_PRICE_CODE:
+                    source_price = product.purchasing_price
+                else:
+                    source_price = self.get_product_price(product.id, price_from_id)
                 
-                if not products:
-                    break
+                if source_price is None or source_price <= 0:
+                    continue
+                
+                new_price = source_price + (source_price * rule.percent / 100)
                 
-                batch_processed = 0
-                for product in products:
-                    if rule.price_code_from == "P":
-                        source_price = self.get_purchasing_price(product.id)
+                if new_price > 0:
+                    if rule.price_code_to == PURCHASING_PRICE_CODE:
+                        success = self.update_purchasing_price(product.id, new_price)
                     else:
-                        source_price = self.get_product_price(product.id, price_from_id)
+                        success = self.update_product_price(product.id, price_to_id, new_price)
                     
-                    if source_price is None or source_price <= 0:
-                        continue
-                    
-                    new_price = source_price + (source_price * rule.percent / 100)
-                    
-                    if new_price > 0:
-                        if rule.price_code_to == "P":
-                            success = self.update_purchasing_price(product.id, new_price)
-                        else:
-                            success = self.update_product_price(product.id, price_to_id, new_price)
-                        
-                        if success:
-                            rule_updated += 1
-                            logger.debug(f"💰 {product.article}: {source_price} → {new_price:.2f} руб.")
-                    
-                    rule_processed += 1
-                    batch_processed += 1
-                    element_id = product.id
-                
-                self.processed_count += batch_processed
+                    if success:
+                        rule_updated += 1
+                        logger.debug(f"💰 {product.article}: {source_price} → {new_price:.2f} руб.")
                 
-                if batch_processed < 50:
+                rule_processed += 1
+            
+            logger.info(f"  📊 Обработано: {rule_processed}, обновлено: {rule_updated}")
+        
+        return rule_processed, rule_updated
+    
+    @staticmethod
+    def rules_conflict(rule: UnderpriceRule, price_from_id: int, price_to_id: int,
+                       other: Tuple[UnderpriceRule, int, int],
+                       section_tree: Optional[SectionTree] = None) -> bool:
+        """Зависят ли правила друг от друга по группам цен в пересекающемся охвате"""
+        other_rule, other_from_id, other_to_id = other
+        if not UnderpriceProcessor.rules_overlap(rule, other_rule, section_tree):
+            return False
+        return price_from_id == other_to_id or price_to_id in (other_from_id, other_to_id)
+    
+    @classmethod
+    def plan_fused_groups(cls, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                          section_tree: Optional[SectionTree] = None) -> List[List[Tuple[UnderpriceRule, int, int]]]:
+        """Группы правил с одинаковым охватом (инфоблок, раздел) для выполнения за один проход
+        
+        Правило присоединяется к более ранней группе своего охвата, только если
+        не зависит ни от одного правила групп, стоящих после неё: иначе перенос
+        правила вперёд изменил бы результат относительно порядка SORT.
+        """
+        groups: List[List[Tuple[UnderpriceRule, int, int]]] = []
+        for rule, price_from_id, price_to_id in resolved_rules:
+            target = None
+            for index in range(len(groups) - 1, -1, -1):
+                group_rule = groups[index][0][0]
+                if (group_rule.iblock_id, group_rule.section_id) == (rule.iblock_id, rule.section_id):
+                    later = [other for group in groups[index + 1:] for other in group]
+                    if not any(cls.rules_conflict(rule, price_from_id, price_to_id, other, section_tree) for other in later):
+                        target = groups[index]
                     break
+            if target is None:
+                target = []
+                groups.append(target)
+            target.append((rule, price_from_id, price_to_id))
+        return groups
+    
+    def process_rules_fused(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                            product_ids: Optional[List[int]] = None,
+                            id_range: Optional[Tuple[int, int]] = None):
+        for group in self.plan_fused_groups(resolved_rules, self.load_section_tree()):
+            processed, updated = self.process_rule_group(group, product_ids, id_range)
+            self.processed_count += processed
+            self.updated_count += updated
+    
+    def process_rule_group(self, group: List[Tuple[UnderpriceRule, int, int]],
+                           product_ids: Optional[List[int]] = None,
+                           id_range: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """Цепочка правил одного охвата за один проход по товарам
+        
+        Для каждой пачки товаров цены всех групп цепочки читаются одним
+        запросом, правила применяются в памяти по порядку, промежуточные
+        цены не проходят через MySQL; пишутся только изменившиеся.
+        """
+        first_rule = group[0][0]
+        group_ids = set()
+        for _, price_from_id, price_to_id in group:
+            group_ids.update((price_from_id, price_to_id))
+        
+        chain = ', '.join(f"{rule.price_code_from} → {rule.price_code_to}" for rule, _, _ in group)
+        logger.info(f"🔗 Правил за один проход: {len(group)} ({chain})")
+        
+        rule_processed = 0
+        rule_updated = 0
+        for products in self.iter_products_for_processing(
+            first_rule.iblock_id, first_rule.section_id, with_purchasing_price=True,
+            product_ids=product_ids, id_range=id_range
+        ):
+            matrix = PriceMatrix.from_products(
+                self.connection,
+                ((product.id, first_rule.iblock_id, product.section_id, product.purchasing_price) for product in products),
+                group_ids
+            )
+            positions = list(range(len(matrix)))
+            for rule, price_from_id, price_to_id in group:
+                rule_processed += matrix.apply_rule(price_from_id, price_to_id, rule.percent, positions)
+            
+            updated, inserted = matrix.write_back(self.connection)
+            rule_updated += updated + inserted
+            logger.info(f"  📊 Обработано: {rule_processed}, обновлено: {rule_updated}")
+        
+        return rule_processed, rule_updated
+    
+    def process_rule_sql(self, rule: UnderpriceRule, price_from_id: int, price_to_id: int,
+                         product_ids: Optional[List[int]] = None,
+                         id_range: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """Множественное выполнение правила: UPDATE ... JOIN и INSERT ... SELECT на весь охват
+        
+        b_catalog_price не имеет уникального ключа (PRODUCT_ID, CATALOG_GROUP_ID),
+        поэтому вместо ON DUPLICATE KEY UPDATE существующие строки обновляются
+        через JOIN, а недостающие добавляются через анти-JOIN.
+        """
+        factor = 1 + rule.percent / 100
+        if factor <= 0:
+            # Новая цена не может быть положительной - построчный путь тоже ничего не пишет
+            return 0, 0
+        
+        if rule.price_code_from == PURCHASING_PRICE_CODE:
+            source_join, source_params, source_expr = '', [], 'cat.PURCHASING_PRICE'
+        else:
+            source_join = "JOIN b_catalog_price src ON src.PRODUCT_ID = e.ID AND src.CATALOG_GROUP_ID = %s"
+            source_params, source_expr = [price_from_id], 'src.PRICE'
+        
+        base_from = f"""
+            b_iblock_element e
+            JOIN b_catalog_product cat ON cat.ID = e.ID AND cat.PURCHASING_PRICE IS NOT NULL
+            {source_join}
+        """
+        
+        windows = [None]
+        if product_ids is not None:
+            windows = [product_ids[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(product_ids), STREAM_CHUNK_SIZE)]
+        
+        rule_updated = 0
+        statements = 0
+        cursor = self.connection.cursor()
+        try:
+            for window in windows:
+                conditions = ["e.IBLOCK_ID = %s", "e.ACTIVE = 'Y'", f"{source_expr} > 0"]
+                scope_params = [rule.iblock_id]
+                if rule.section_id:
+                    section_sql, section_params = self.section_condition(rule.section_id)
+                    conditions.append(section_sql)
+                    scope_params.extend(section_params)
+                if id_range:
+                    conditions.append("e.ID BETWEEN %s AND %s")
+                    scope_params.extend(id_range)
+                if window:
+                    conditions.append(f"e.ID IN ({', '.join(['%s'] * len(window))})")
+                    scope_params.extend(window)
+                where = ' AND '.join(conditions)
+                
+                if rule.price_code_to == PURCHASING_PRICE_CODE:
+                    cursor.execute(f"""
+                    UPDATE {base_from}
+                    SET cat.PURCHASING_PRICE = {source_expr} * %s, cat.TIMESTAMP_X = NOW()
+                    WHERE {where}
+                    """, source_params + [factor] + scope_params)
+                    rule_updated += cursor.rowcount
+                    statements += 1
+                    continue
+                
+                cursor.execute(f"""
+                UPDATE {base_from}
+                JOIN b_catalog_price dst ON dst.PRODUCT_ID = e.ID AND dst.CATALOG_GROUP_ID = %s
+                SET dst.PRICE = {source_expr} * %s, dst.TIMESTAMP_X = NOW()
+                WHERE {where}
+                """, source_params + [price_to_id, factor] + scope_params)
+                rule_updated += cursor.rowcount
+                
+                cursor.execute(f"""
+                INSERT INTO b_catalog_price 
+                (PRODUCT_ID, CATALOG_GROUP_ID, PRICE, CURRENCY, TIMESTAMP_X)
+                SELECT e.ID, %s, MIN({source_expr}) * %s, 'RUB', NOW()
+                FROM {base_from}
+                LEFT JOIN b_catalog_price dst ON dst.PRODUCT_ID = e.ID AND dst.CATALOG_GROUP_ID = %s
+                WHERE {where} AND dst.ID IS NULL
+                GROUP BY e.ID
+                """, [price_to_id, factor] + source_params + [price_to_id] + scope_params)
+                rule_updated += cursor.rowcount
+                statements += 2
+        except Error as e:
+            if self.propagate_errors and is_retryable_error(e):
+                raise
+            logger.error(f"Ошибка выполнения правила {rule.id} в режиме SQL: {e}")
+            self.failed_updates += 1
+        finally:
+            cursor.close()
+        
+        logger.info(f"  📊 SQL-запросов: {statements}, обновлено строк: {rule_updated}")
+        return rule_updated, rule_updated
+    
+    def process_rules_matrix(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                             product_ids: Optional[List[int]] = None,
+                             id_range: Optional[Tuple[int, int]] = None) -> PriceMatrix:
+        """Выполнение всех правил в памяти: загрузка колонок, проход по правилам, запись изменений"""
+        if not resolved_rules:
+            return PriceMatrix()
+        
+        group_ids = set()
+        for _, price_from_id, price_to_id in resolved_rules:
+            group_ids.update((price_from_id, price_to_id))
+        
+        matrix = PriceMatrix.load(
+            self.connection,
+            iblock_ids={rule.iblock_id for rule, _, _ in resolved_rules},
+            group_ids=group_ids,
+            product_ids=product_ids,
+            id_range=id_range
+        )
+        
+        for rule, price_from_id, price_to_id in resolved_rules:
+            positions = matrix.scope(rule.iblock_id, rule.section_id, self.load_section_tree() if rule.section_id else None)
+            applied = matrix.apply_rule(price_from_id, price_to_id, rule.percent, positions)
+            self.processed_count += applied
+            logger.info(f"  📊 Правило {rule.id}: товаров в охвате {len(positions)}, рассчитано {applied}")
+        
+        updated, inserted = matrix.write_back(self.connection)
+        self.updated_count += updated + inserted
+        logger.info(f"  💾 Записано изменившихся цен: обновлено {updated}, добавлено {inserted}")
+        return matrix
+    
+    @staticmethod
+    def rules_overlap(first: UnderpriceRule, second: UnderpriceRule,
+                      section_tree: Optional[SectionTree] = None) -> bool:
+        """Пересекаются ли охваты правил (инфоблок и поддеревья разделов)
+        
+        Без дерева разделов разные разделы одного инфоблока считаются
+        пересекающимися - один может оказаться подразделом другого.
+        """
+        if first.iblock_id != second.iblock_id:
+            return False
+        if not first.section_id or not second.section_id or first.section_id == second.section_id:
+            return True
+        return section_tree.overlaps(first.section_id, second.section_id) if section_tree else True
+    
+    @classmethod
+    def plan_rule_stages(cls, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                         section_tree: Optional[SectionTree] = None) -> List[List[Tuple[UnderpriceRule, int, int]]]:
+        """Разбиение правил на стадии в топологическом порядке
+        
+        Правило ставится после всех более ранних по SORT правил с пересекающимся
+        охватом, которые пишут его исходную группу цен, читают или пишут его
+        целевую. Правила одной стадии независимы и выполняются параллельно.
+        """
+        rule_stages = []
+        stages = []
+        for i, (rule, price_from_id, price_to_id) in enumerate(resolved_rules):
+            stage = 0
+            for j in range(i):
+                if cls.rules_conflict(rule, price_from_id, price_to_id, resolved_rules[j], section_tree):
+                    stage = max(stage, rule_stages[j] + 1)
+            rule_stages.append(stage)
+            if stage == len(stages):
+                stages.append([])
+            stages[stage].append(resolved_rules[i])
+        return stages
+    
+    def get_partitions(self, iblock_ids: Iterable[int], section_id: Optional[int] = None,
+                       product_ids: Optional[List[int]] = None) -> List[Partition]:
+        """Партиции по partition_size ID в диапазоне товаров инфоблоков/раздела"""
+        if product_ids is not None:
+            return [
+                Partition(window[0], window[-1], window)
+                for window in (product_ids[i:i + self.partition_size]
+                               for i in range(0, len(product_ids), self.partition_size))
+            ]
+        
+        iblock_ids = sorted(set(iblock_ids))
+        conditions = ["ACTIVE = 'Y'", f"IBLOCK_ID IN ({', '.join(['%s'] * len(iblock_ids))})"]
+        params = list(iblock_ids)
+        if section_id:
+            section_sql, section_params = self.section_condition(section_id, column='IBLOCK_SECTION_ID')
+            conditions.append(section_sql)
+            params.extend(section_params)
+        
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"SELECT MIN(ID), MAX(ID) FROM b_iblock_element WHERE {' AND '.join(conditions)}", params)
+            min_id, max_id = cursor.fetchone()
+        finally:
+            cursor.close()
+        
+        if min_id is None:
+            return []
+        return [
+            Partition(first_id, min(first_id + self.partition_size - 1, max_id))
+            for first_id in range(min_id, max_id + 1, self.partition_size)
+        ]
+    
+    def process_rules_serial(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                             product_ids: Optional[List[int]] = None):
+        """Выполнение правил на соединении процессора"""
+        if self.mode == 'matrix':
+            self.process_rules_matrix(resolved_rules, product_ids)
+        elif self.mode == 'rows' and self.fusion:
+            self.process_rules_fused(resolved_rules, product_ids)
+        else:
+            for rule, price_from_id, price_to_id in resolved_rules:
+                if self.mode == 'sql':
+                    rule_processed, rule_updated = self.process_rule_sql(rule, price_from_id, price_to_id, product_ids)
+                else:
+                    rule_processed, rule_updated = self.process_rule_rows(rule, price_from_id, price_to_id, product_ids)
                 
-                logger.info(f"  📊 Обработано: {rule_processed}, обновлено: {rule_updated}")
+                self.processed_count += rule_processed
+                self.updated_count += rule_updated
+    
+    def process_rules_parallel(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                               product_ids: Optional[List[int]] = None):
+        """Параллельное выполнение правил партициями на соединениях из пула
+        
+        В режиме matrix (и rows со слиянием правил) каждая партиция проходит
+        всю цепочку правил в памяти.
+        В режимах rows/sql правила выполняются стадиями plan_rule_stages:
+        партиции всех правил стадии обрабатываются одновременно, следующая
+        стадия начинается после завершения предыдущей.
+        """
+        if not resolved_rules:
+            return
+        
+        # Соединения пула держат и другие (сам процессор, BitrixClient, потоки записи
+        # конвейера) - потоков не больше, чем соединений свободно прямо сейчас
+        free = self.pool.free
+        if free < 1:
+            logger.warning("Свободных соединений в пуле нет, пересчёт underprice выполняется последовательно")
+            self.process_rules_serial(resolved_rules, product_ids)
+            return
+        workers = min(self.workers, free)
+        if workers < self.workers:
+            logger.warning(f"Потоков underprice {self.workers} больше, чем свободно соединений в пуле; используем {workers}")
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='underprice') as executor:
+            if self.mode == 'matrix' or (self.mode == 'rows' and self.fusion):
+                partitions = self.get_partitions({rule.iblock_id for rule, _, _ in resolved_rules}, None, product_ids)
+                logger.info(f"⚡ Параллельный пересчёт: партиций {len(partitions)}, потоков {workers}")
+                self._run_stage(executor, [(resolved_rules, partition) for partition in partitions])
+                return
             
-            self.updated_count += rule_updated
+            stages = self.plan_rule_stages(resolved_rules, self.load_section_tree())
+            for stage_number, stage in enumerate(stages, 1):
+                tasks = [
+                    ([(rule, price_from_id, price_to_id)], partition)
+                    for rule, price_from_id, price_to_id in stage
+                    for partition in self.get_partitions([rule.iblock_id], rule.section_id, product_ids)
+                ]
+                logger.info(f"⚡ Стадия {stage_number}/{len(stages)}: правил {len(stage)}, "
+                            f"партиций {len(tasks)}, потоков {workers}")
+                self._run_stage(executor, tasks)
+    
+    def _run_stage(self, executor: ThreadPoolExecutor, tasks: List[Tuple[List, Partition]]):
+        futures = [(executor.submit(self._run_partition, rules, partition), partition) for rules, partition in tasks]
+        for future, partition in futures:
+            try:
+                processed, updated, failed = future.result()
+                self.processed_count += processed
+                self.updated_count += updated
+                self.failed_updates += failed
+            except Exception as e:
+                self.failed_partitions += 1
+                logger.error(f"Ошибка партиции ID {partition.first_id}-{partition.last_id}: {e}")
+    
+    def _run_partition(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]],
+                       partition: Partition) -> Tuple[int, int, int]:
+        """Выполнение правил в партиции на отдельном соединении с повтором при взаимоблокировке
         
-        duration = (datetime.now() - start_time).total_seconds()
-        logger.info(f"✅ Обработка underprice завершена за {duration:.1f}с")
-        logger.info(f"📈 Итого: обработано {self.processed_count}, обновлено {self.updated_count}")
+        Возвращает (обработано, обновлено, ошибок записи).
+        """
+        attempt = 0
+        while True:
+            connection = self.pool.acquire()
+            worker = UnderpriceProcessor(mode=self.mode, workers=1, partition_size=self.partition_size)
+            worker.connection = connection
+            worker.pool = self.pool
+            worker.metadata = self.metadata
+            worker.section_tree = self.section_tree
+            worker.fusion = self.fusion
+            worker.propagate_errors = True
+            try:
+                worker.process_partition(resolved_rules, partition)
+                return worker.processed_count, worker.updated_count, worker.failed_updates
+            except Error as e:
+                if not is_retryable_error(e) or attempt >= self.deadlock_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Взаимоблокировка в партиции ID {partition.first_id}-{partition.last_id}, "
+                               f"повтор {attempt}/{self.deadlock_retries}")
+                time.sleep(0.1 * 2 ** attempt)
+            finally:
+                self.pool.release(connection)
+    
+    def process_partition(self, resolved_rules: List[Tuple[UnderpriceRule, int, int]], partition: Partition):
+        """Выполнение правил (в заданном порядке) для одной партиции на соединении процессора"""
+        id_range = (partition.first_id, partition.last_id)
+        if self.mode == 'matrix':
+            self.process_rules_matrix(resolved_rules, partition.product_ids, id_range)
+            return
+        if self.mode == 'rows' and self.fusion:
+            self.process_rules_fused(resolved_rules, partition.product_ids, id_range)
+            return
+        
+        for rule, price_from_id, price_to_id in resolved_rules:
+            if self.mode == 'sql':
+                processed, updated = self.process_rule_sql(rule, price_from_id, price_to_id, partition.product_ids, id_range)
+            else:
+                processed, updated = self.process_rule_rows(rule, price_from_id, price_to_id, partition.product_ids, id_range)
+            self.processed_count += processed
+            self.updated_count += updated
     
     def get_products_batch(self, iblock_id: int, section_id: Optional[int], 
                           min_id: int, limit: int) -> List[ProductInfo]:
@@ -361,11 +1175,12 @@ class UnderpriceProcessor:
             "e.IBLOCK_ID = %s", 
             "e.ID > %s"
         ]
-        params = [iblock_id, min_id]
+        params = [self.get_article_property_id(iblock_id), iblock_id, min_id]
         
         if section_id:
-            where_conditions.append("e.IBLOCK_SECTION_ID = %s")
-            params.append(section_id)
+            section_sql, section_params = self.section_condition(section_id)
+            where_conditions.append(section_sql)
+            params.extend(section_params)
         
         where_conditions.append("cat.PURCHASING_PRICE IS NOT NULL")
         
@@ -378,11 +1193,7 @@ class UnderpriceProcessor:
             cat.PURCHASING_PRICE
         FROM b_iblock_element e
         LEFT JOIN b_iblock_element_property prop ON (
-            e.ID = prop.IBLOCK_ELEMENT_ID 
-            AND prop.IBLOCK_PROPERTY_ID = (
-                SELECT ID FROM b_iblock_property 
-                WHERE IBLOCK_ID = e.IBLOCK_ID AND CODE = 'CML2_ARTICLE'
-            )
+            e.ID = prop.IBLOCK_ELEMENT_ID AND prop.IBLOCK_PROPERTY_ID = %s
         )
         LEFT JOIN b_catalog_product cat ON e.ID = cat.ID
         WHERE {' AND '.join(where_conditions)}
@@ -431,22 +1242,96 @@ class UnderpriceProcessor:
             return True
             
         except Error as e:
+            if self.propagate_errors and is_retryable_error(e):
+                raise
             logger.error(f"Ошибка обновления закупочной цены товара {product_id}: {e}")
+            self.failed_updates += 1
             return False
         finally:
             cursor.close()
 
+class UnderpriceDebouncer:
+    """Накапливает ID товаров с изменёнными ценами и пересчитывает underprice одним запуском
+    
+    add() вызывается после каждой записи цен, flush() - в конце синхронизации
+    или пачки; min_interval не даёт запускать пересчёт чаще заданного.
+    """
+    
+    def __init__(self, min_interval: float = 0.0):
+        self.min_interval = min_interval
+        self.pending: Set[int] = set()
+        self.lock = threading.Lock()
+        self.run_lock = threading.Lock()
+        self.last_run = 0.0
+        self.runs = 0
+    
+    def add(self, product_ids: Iterable[int]):
+        with self.lock:
+            self.pending.update(product_ids)
+    
+    def flush(self, force: bool = True) -> bool:
+        """Пересчёт для накопленных товаров; False - если отложен или завершился ошибкой"""
+        with self.run_lock:
+            if not force and time.monotonic() - self.last_run < self.min_interval:
+                return False
+            
+            with self.lock:
+                product_ids = self.pending
+                self.pending = set()
+            
+            if not product_ids:
+                return True
+            
+            processor = UnderpriceProcessor()
+            try:
+                processor.connect()
+                processor.process_underprice_rules(product_ids)
+                self.runs += 1
+                if processor.failures:
+                    # Ошибки записи не прерывают пересчёт - какие товары не пересчитаны,
+                    # неизвестно, поэтому в очередь возвращается вся пачка
+                    logger.warning(f"Пересчет underprice с ошибками ({processor.failures}), "
+                                   f"товары возвращены в очередь: {len(product_ids)}")
+                    self.add(product_ids)
+                    return False
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка пересчета underprice: {e}")
+                # Возвращаем товары в очередь, чтобы не потерять пересчёт
+                self.add(product_ids)
+                return False
+            finally:
+                processor.disconnect()
+                self.last_run = time.monotonic()
+
+
 def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Underprice Processor')
+    parser.add_argument('--mode', choices=EXECUTION_MODES, help='Режим выполнения правил (по умолчанию UNDERPRICE_MODE или rows)')
+    parser.add_argument('--workers', type=int, help='Количество параллельных потоков (по умолчанию UNDERPRICE_WORKERS или 1)')
+    parser.add_argument('--partition-size', type=int, help='Размер партиции - диапазон ID товаров (по умолчанию UNDERPRICE_PARTITION_SIZE)')
+    parser.add_argument('--no-fusion', action='store_true', help='Режим rows: выполнять правила по одному без слияния цепочек')
+    parser.add_argument('--incremental', action='store_true', help='Пересчитать только товары с изменившимися ценами')
+    parser.add_argument('--full', action='store_true', help='Полный пересчет с обновлением водяного знака инкрементального режима')
+    args = parser.parse_args()
+    
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     
-    processor = UnderpriceProcessor()
+    processor = UnderpriceProcessor(mode=args.mode, workers=args.workers, partition_size=args.partition_size)
+    if args.no_fusion:
+        processor.fusion = False
     
     try:
         processor.connect()
-        processor.process_underprice_rules()
+        if args.incremental or args.full:
+            processor.process_incremental(force_full=args.full)
+        else:
+            processor.process_underprice_rules()
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
         return 1